@@ -7,16 +7,20 @@ from .function import function, _get_hither_function_wrapper
 from ._config import Config, UseConfig
 from ._job import Job
 from ._safe_pickle import _safe_pickle, _safe_unpickle
+from ._serialization import Serializer, register_serializer, _serialize_to_file, _deserialize_from_file
 from .paralleljobhandler import ParallelJobHandler
 from .slurmjobhandler import SlurmJobHandler
 from ._job_manager import wait
 from ._job_cache import JobCache
+from ._job_cache_stats import get_job_cache_stats, print_job_cache_stats, set_job_cache_stats_report_interval
+from ._prefetch_job_cache import prefetch_job_cache
 from ._job_handler import JobHandler
+from ._concurrency import set_concurrency_limit, get_concurrency_limit
 from .function import get_function
 from .scriptdir_runner import ScriptDirRunner
 from .run_scriptdir import run_scriptdir
 from .log import Log, LogReader
-from .consolecapture import ConsoleCapture
+from .consolecapture import ConsoleCapture, ConsoleLines, _ConsoleStreamWriter
 from ._endprocesswhenfiledisappears import EndProcessWhenFileDisappears
 from ._bindmount import BindMount
 from .runtimehook import RuntimeHook, PreContainerContext, PostContainerContext, PreRunContext, PostRunContext
@@ -0,0 +1,39 @@
+import os
+from multiprocessing.connection import Connection, wait
+from typing import Set
+
+# Written to from background threads (job handler workers, job cache checks) when there is
+# something for the job manager to do, so that it does not need to poll
+_wakeup_read_fd, _wakeup_write_fd = os.pipe()
+os.set_blocking(_wakeup_read_fd, False)
+os.set_blocking(_wakeup_write_fd, False)
+
+# connections to other processes (e.g., worker processes of a job handler) that also end the wait
+# when there is something to receive
+_activity_connections: Set[Connection] = set()
+
+def _notify_activity():
+    try:
+        os.write(_wakeup_write_fd, b'\0')
+    except BlockingIOError:
+        # the pipe is full, so the next wait ends anyway
+        pass
+
+def _watch_connection(conn: Connection):
+    _activity_connections.add(conn)
+
+def _unwatch_connection(conn: Connection):
+    _activity_connections.discard(conn)
+
+def _clear_activity():
+    # called by the job manager before it checks for work, so that a notification
+    # arriving while the work is being handled ends the next wait
+    try:
+        while len(os.read(_wakeup_read_fd, 4096)) > 0:
+            pass
+    except BlockingIOError:
+        pass
+
+def _wait_for_activity(timeout_sec: float):
+    # returns immediately if there was a notification since the last _clear_activity
+    wait([_wakeup_read_fd] + [c for c in _activity_connections if not c.closed], timeout_sec)
@@ -1,59 +1,183 @@
-from typing import Any, Callable, Dict, List, Union
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple, Union
 from .function import FunctionWrapper
-from ._job_cache import JobCache, _compute_job_hash, job_cache_version
+from ._job_cache import JobCache, _compute_job_hash, _compute_job_dag_hash, job_cache_version
 from ._job import JobResult, Job
+from ._config import Inherit
+from ._job_cache_stats import global_job_cache_stats
+from ._activity import _notify_activity
 
-def _batch_check_job_cache(jobs: List[Job]):
-    # max number to check at a time
-    batch_size = 50
-    if len(jobs) > batch_size:
-        for i in range(0, len(jobs), batch_size):
-            _batch_check_job_cache(jobs[i:i+batch_size])
-        return
+# maximum number of jobs looked up with a single watch_for_new_messages call
+_max_probe_batch_size = 100
+
+class _JobCacheChecker:
+    # Checks the job cache in a small pool of threads so that the job manager is not blocked.
+    # The jobs to check in an iteration are looked up in batches (one request for each batch),
+    # and they are in the 'checking_cache' state until the check of their batch returns.
+    def __init__(self, num_threads: int=8):
+        self._num_threads = num_threads
+        self._executor: Union[ThreadPoolExecutor, None] = None
+        # job_id -> (job, job_hash, future of the batch)
+        self._checks: Dict[str, Tuple[Job, str, Future]] = {}
+    @property
+    def num_checks_in_progress(self):
+        return len(self._checks)
+    def start_checks(self, jobs: List[Job]):
+        to_probe: Dict[int, Tuple[JobCache, List[Tuple[Job, str]]]] = {}
+        for job in jobs:
+            jc = job.config.job_cache
+            if jc is None:
+                continue
+            job._job_cache_checked = True
+            job_hash = _compute_job_hash_for_job(job, jc)
+            pending_result = jc._get_pending_job_result(job_hash)
+            if pending_result is not None:
+                # this result is still waiting to be written to the job cache
+                print(f'Using cached result for {job.function_name} ({job.function_version})')
+                global_job_cache_stats._record_lookup(job.function_name, job.function_version, hit=True, latency_sec=0, original_runtime_sec=None)
+                job._set_finished_with_result(pending_result, result_is_from_cache=True)
+                continue
+            job._set_checking_cache()
+            if id(jc) not in to_probe:
+                to_probe[id(jc)] = (jc, [])
+            to_probe[id(jc)][1].append((job, job_hash))
+        for jc, a in to_probe.values():
+            # spread over the threads, but with as few requests as possible
+            batch_size = min(_max_probe_batch_size, -(-len(a) // self._num_threads))
+            for i in range(0, len(a), batch_size):
+                batch = a[i:i + batch_size]
+                future = self._get_executor().submit(_timed_probe_job_cache_batch, jc, [job_hash for _, job_hash in batch])
+                future.add_done_callback(lambda f: _notify_activity())
+                for job, job_hash in batch:
+                    self._checks[job.job_id] = (job, job_hash, future)
+    def collect_completed_checks(self) -> int:
+        # returns the number of completed checks
+        hits_by_cache: Dict[int, Tuple[JobCache, List[str]]] = {}
+        num_completed = 0
+        while True:
+            # a job that was held back for its consumers may be released by the checks completed in a pass
+            n = self._collect_completed_checks(hits_by_cache)
+            if n == 0:
+                break
+            num_completed += n
+        # record the access times (used for garbage collection of the job cache)
+        for jc, job_hashes in hits_by_cache.values():
+            try:
+                jc._record_accesses(job_hashes)
+            except Exception as e:
+                print('Warning: problem recording job cache accesses:', e)
+        return num_completed
+    def _collect_completed_checks(self, hits_by_cache: Dict[int, Tuple[JobCache, List[str]]]) -> int:
+        num_completed = 0
+        for job_id in list(self._checks.keys()):
+            job, job_hash, future = self._checks[job_id]
+            if not future.done():
+                continue
+            check_error: Union[Exception, None] = None
+            try:
+                job_results, latency_sec = future.result()
+                job_result = job_results[job_hash]
+            except Exception as e:
+                check_error = e
+                job_result, latency_sec = None, 0
+            hit = (job_result is not None) and (job_result.status == 'finished')
+            if (not hit) and (not job.cancel_pending) and _consumers_are_being_checked(job):
+                # dag hashing mode: the job is not needed if its consumers are all found in the cache,
+                # so it stays in the 'checking_cache' state until they have been checked
+                continue
+            del self._checks[job_id]
+            num_completed += 1
+            if check_error is not None:
+                print('Warning: problem checking job cache:', check_error)
+            if job.cancel_pending:
+                # cancelled while the job cache was being checked
+                job._set_error(Exception('Job cancelled while pending.'))
+                continue
+            global_job_cache_stats._record_lookup(
+                job.function_name, job.function_version,
+                hit=hit, latency_sec=latency_sec, original_runtime_sec=job_result._original_runtime_sec if hit else None
+            )
+            if hit:
+                assert job_result is not None
+                print(f'Using cached result for {job.function_name} ({job.function_version})')
+                job_result._stats_key = (job.function_name, job.function_version)
+                job._set_finished_with_result(job_result, result_is_from_cache=True)
+                jc = job.config.job_cache
+                assert jc is not None
+                if id(jc) not in hits_by_cache:
+                    hits_by_cache[id(jc)] = (jc, [])
+                hits_by_cache[id(jc)][1].append(job_hash)
+            else:
+                # not in the cache, the job is ready to be dispatched
+                job._set_pending()
+        return num_completed
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._num_threads)
+        return self._executor
+
+def _consumers_are_being_checked(job: Job) -> bool:
+    jc = job.config.job_cache
+    if (jc is None) or (jc.hash_mode != 'dag'):
+        return False
+    for c in job._consumers:
+        if c.status == 'checking_cache':
+            return True
+        if (c.status == 'pending') and (not c._job_cache_checked) and (c.config.job_cache is not None) and (c.config.job_cache.hash_mode == 'dag'):
+            # to be checked in the next iteration
+            return True
+    return False
+
+def _timed_probe_job_cache_batch(job_cache: JobCache, job_hashes: List[str]) -> Tuple[Dict[str, Union[JobResult, None]], float]:
+    timer = time.time()
+    job_results = _probe_job_cache_batch(job_cache, job_hashes)
+    return job_results, time.time() - timer
+
+def _probe_job_cache(job_cache: JobCache, job_hash: str) -> Union[JobResult, None]:
+    return _probe_job_cache_batch(job_cache, [job_hash])[job_hash]
+
+def _probe_job_cache_batch(job_cache: JobCache, job_hashes: List[str]) -> Dict[str, Union[JobResult, None]]:
+    # runs in a worker thread
+    # all of the jobs are looked up with a single request
     import kachery_client as kc
-    watches = {}
-    jobs_by_id: Dict[str, Job] = {}
-    for job in jobs:
-        jc = job.config.job_cache
-        if jc is not None:
-            jobs_by_id[job.job_id] = job
-            job_hash = _compute_job_hash(function_name=job.function_name, function_version=job.function_version, kwargs=job.get_resolved_kwargs())
-            jc._feed
-            watches[job.job_id] = {
-                'feedId': jc._feed.feed_id,
-                'subfeedName': {'jobHash': job_hash},
-                'position': 0
-            }
-    while True:
-        got_something = False
-        if len(watches.keys()) > 0:
-            new_messages = kc.watch_for_new_messages(watches, wait_msec=0)
-        else:
-            new_messages = {}
-        for job_id, messages in new_messages.items():
-            job = jobs_by_id[job_id]
-            if len(messages) > 0:
-                got_something = True
-                del watches[job_id]
-                obj = messages[-1] # last message
-                if obj.get('jobCacheVersion', None) == job_cache_version:
-                    try:
-                        job_result = JobResult.from_cache_dict(
-                            obj['jobResult']
-                        )
-                    except Exception as e:
-                        print('Warning: problem retrieving cached result:', e)
-                        job_result = None
-                    if job_result is not None:
-                        if job_result.status == 'finished':
-                            print(f'Using cached result for {job.function_name} ({job.function_version})')
-                            if job_result.console_lines is not None:
-                                job._set_console_lines(job_result.console_lines)
-                            job._set_finished(job_result.return_value, result_is_from_cache=True)
-                else:
-                    print('Warning: incorrect job cache version')
-        if not got_something:
-            break
+    unique_job_hashes = list(dict.fromkeys(job_hashes))
+    watches = {
+        f'job{i}': {
+            'feedId': job_cache._get_feed(job_hash).feed_id,
+            'subfeedName': {'jobHash': job_hash},
+            'position': 0
+        }
+        for i, job_hash in enumerate(unique_job_hashes)
+    }
+    new_messages = kc.watch_for_new_messages(watches, wait_msec=0)
+    return {
+        job_hash: _get_job_result_from_messages(new_messages.get(f'job{i}', []), stored_locally=job_cache._get_feed(job_hash).is_writeable())
+        for i, job_hash in enumerate(unique_job_hashes)
+    }
+
+def _get_job_result_from_messages(messages: List[dict], stored_locally: bool) -> Union[JobResult, None]:
+    # stored_locally: the job cache is written by this node, so the files of its results are in the local
+    # kachery storage (the files of other job caches are loaded when first accessed)
+    if len(messages) == 0:
+        return None
+    obj = messages[-1] # last message
+    if obj.get('evicted', False):
+        # removed by garbage collection of the job cache
+        return None
+    if obj.get('jobCacheVersion', None) != job_cache_version:
+        print('Warning: incorrect job cache version')
+        return None
+    try:
+        # lazy: the return value is only loaded when it is actually consumed
+        return JobResult.from_cache_dict(
+            obj['jobResult'],
+            lazy=True,
+            stored_locally=stored_locally
+        )
+    except Exception as e:
+        print('Warning: problem retrieving cached result:', e)
+        return None
 
 def _check_job_cache(function_name: str, function_version: str, kwargs: Dict[str, Any], job_cache: JobCache):
     job_hash: Union[str, None] = _compute_job_hash(function_name=function_name, function_version=function_version, kwargs=kwargs)
@@ -63,7 +187,20 @@ def _check_job_cache(function_name: str, function_version: str, kwargs: Dict[str
             if job_result.status == 'finished':
                 return job_result
 
-def _write_result_to_job_cache(job_result: JobResult, function_name: str, function_version: str, kwargs: Dict[str, Any], job_cache: JobCache):
-    job_hash: Union[str, None] = _compute_job_hash(function_name=function_name, function_version=function_version, kwargs=kwargs)
+def _compute_job_hash_for_job(job: Job, job_cache: JobCache):
+    if job_cache.hash_mode == 'dag':
+        return _compute_job_dag_hash(job)
+    else:
+        return _compute_job_hash(function_name=job.function_name, function_version=job.function_version, kwargs=job.get_resolved_kwargs())
+
+def _write_result_to_job_cache(job: Job, job_result: JobResult, job_cache: JobCache):
+    job_hash: Union[str, None] = _compute_job_hash_for_job(job, job_cache)
     if job_hash is not None:
-        job_cache._cache_job_result(job_hash, job_result)
\ No newline at end of file
+        compression = job.function_wrapper.cache_compression
+        if isinstance(compression, Inherit):
+            compression = job_cache.compression
+        if (job.timestamp_started is not None) and (job.timestamp_completed is not None):
+            runtime_sec = job.timestamp_completed - job.timestamp_started
+        else:
+            runtime_sec = None
+        job_cache._store_job_result(job_hash, job_result, compression=compression, function_name=job.function_name, function_version=job.function_version, runtime_sec=runtime_sec, serializer=job.function_wrapper.serializer)
\ No newline at end of file
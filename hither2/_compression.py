@@ -0,0 +1,55 @@
+from typing import Union
+
+compression_codecs = ['zlib', 'lz4', 'zstd']
+
+def _check_compression_codec(codec: Union[str, None]):
+    if (codec is not None) and (codec not in compression_codecs):
+        raise Exception(f'Unsupported compression codec: {codec}')
+
+def _choose_compression_codec(codec: Union[str, None], size: int, min_size: int) -> Union[str, None]:
+    # small payloads are stored uncompressed
+    if size < min_size:
+        return None
+    return codec
+
+def _compress(data: bytes, codec: Union[str, None]) -> bytes:
+    if codec is None:
+        return data
+    elif codec == 'zlib':
+        import zlib
+        return zlib.compress(data, 1)
+    elif codec == 'lz4':
+        try:
+            import lz4.frame
+        except:
+            raise Exception('lz4 python package not installed.')
+        return lz4.frame.compress(data)
+    elif codec == 'zstd':
+        try:
+            import zstandard
+        except:
+            raise Exception('zstandard python package not installed.')
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    else:
+        raise Exception(f'Unsupported compression codec: {codec}')
+
+def _decompress(data: bytes, codec: Union[str, None]) -> bytes:
+    if codec is None:
+        return data
+    elif codec == 'zlib':
+        import zlib
+        return zlib.decompress(data)
+    elif codec == 'lz4':
+        try:
+            import lz4.frame
+        except:
+            raise Exception('lz4 python package not installed.')
+        return lz4.frame.decompress(data)
+    elif codec == 'zstd':
+        try:
+            import zstandard
+        except:
+            raise Exception('zstandard python package not installed.')
+        return zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raise Exception(f'Unsupported compression codec: {codec}')
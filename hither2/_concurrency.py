@@ -0,0 +1,25 @@
+from typing import Dict, Union
+
+# Limits on the number of jobs of each concurrency group (see hi.function) that are queued or
+# running at the same time, across all job handlers. Groups without a limit are not constrained.
+_concurrency_limits: Dict[str, int] = {}
+
+def set_concurrency_limit(group: str, limit: Union[int, None]):
+    if limit is None:
+        if group in _concurrency_limits:
+            del _concurrency_limits[group]
+        return
+    if (not isinstance(limit, int)) or (limit < 1):
+        raise Exception(f'Invalid concurrency limit for group {group}: {limit}')
+    _concurrency_limits[group] = limit
+
+def get_concurrency_limit(group: str) -> Union[int, None]:
+    return _concurrency_limits.get(group, None)
+
+def _concurrency_group_has_room(group: Union[str, None], active_counts: Dict[str, int]):
+    if group is None:
+        return True
+    limit = _concurrency_limits.get(group, None)
+    if limit is None:
+        return True
+    return active_counts.get(group, 0) < limit
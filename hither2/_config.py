@@ -2,21 +2,25 @@ from enum import Enum
 from .log import Log
 from typing import Union
 from collections import deque
-from typing import Deque, Union
+from typing import Deque, Dict, Union
 from ._job_handler import JobHandler
 from ._job_cache import JobCache
+from ._resources import _check_resources
 
 class Inherit(Enum):
     INHERIT = ''
 
 class ConfigEntry:
-    def __init__(self, use_container: bool, job_handler: Union[JobHandler, None], job_cache: Union[JobCache, None], log: Union[Log, None], show_console: bool, job_timeout_sec: Union[None, float]):
+    def __init__(self, use_container: bool, job_handler: Union[JobHandler, None], job_cache: Union[JobCache, None], log: Union[Log, None], show_console: bool, job_timeout_sec: Union[None, float], console_max_lines: Union[int, None]=None, console_overflow: str='spill', resources: Union[Dict[str, float], None]=None):
         self._use_container = use_container
         self._job_handler = job_handler
         self._job_cache = job_cache
         self._log = log
         self._show_console = show_console
         self._job_timeout_sec = job_timeout_sec
+        self._console_max_lines = console_max_lines
+        self._console_overflow = console_overflow
+        self._resources = resources
     @property
     def use_container(self):
         return self._use_container
@@ -35,6 +39,15 @@ class ConfigEntry:
     @property
     def job_timeout_sec(self):
         return self._job_timeout_sec
+    @property
+    def console_max_lines(self):
+        return self._console_max_lines
+    @property
+    def console_overflow(self):
+        return self._console_overflow
+    @property
+    def resources(self):
+        return self._resources
 
 class UseConfig:
     def __init__(self, config: ConfigEntry):
@@ -53,8 +66,17 @@ class Config:
         job_cache: Union[JobCache, None, Inherit]=Inherit.INHERIT,
         log: Union[Log, None, Inherit]=Inherit.INHERIT,
         show_console: Union[bool, Inherit]=Inherit.INHERIT,
-        job_timeout_sec: Union[float, None, Inherit]=Inherit.INHERIT
+        job_timeout_sec: Union[float, None, Inherit]=Inherit.INHERIT,
+        console_max_lines: Union[int, None, Inherit]=Inherit.INHERIT,
+        console_overflow: Union[str, Inherit]=Inherit.INHERIT,
+        resources: Union[Dict[str, float], None, Inherit]=Inherit.INHERIT
     ):
+        """
+        console_max_lines: maximum number of console lines of a job to keep in memory (None means no limit)
+        console_overflow: what to do with older lines beyond console_max_lines:
+            'spill' (write them to a temporary file) or 'truncate' (discard them)
+        resources: resources required by the jobs (e.g., {'cpus': 2}), overriding those declared in hi.function
+        """
         old_config = Config.config_stack[-1] # throws if no default set
         self.new_config = ConfigEntry(
             use_container=use_container if not isinstance(use_container, Inherit) else old_config.use_container,
@@ -63,6 +85,9 @@ class Config:
             log=log if not isinstance(log, Inherit) else old_config.log,
             show_console=show_console if not isinstance(show_console, Inherit) else old_config.show_console,
             job_timeout_sec=job_timeout_sec if not isinstance(job_timeout_sec, Inherit) else old_config.job_timeout_sec,
+            console_max_lines=console_max_lines if not isinstance(console_max_lines, Inherit) else old_config.console_max_lines,
+            console_overflow=console_overflow if not isinstance(console_overflow, Inherit) else old_config.console_overflow,
+            resources=_check_resources(resources) if not isinstance(resources, Inherit) else old_config.resources,
         )
 
     @staticmethod
@@ -77,7 +102,10 @@ class Config:
             job_cache=None,
             log=None,
             show_console=False,
-            job_timeout_sec=None
+            job_timeout_sec=None,
+            console_max_lines=None,
+            console_overflow='spill',
+            resources=None
         )
 
     def __enter__(self):
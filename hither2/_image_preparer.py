@@ -0,0 +1,40 @@
+import concurrent.futures
+import threading
+from typing import Dict, Tuple
+from .dockerimage import DockerImage
+from ._activity import _notify_activity
+
+# Images are prepared (pulled or built) in background threads, as soon as a job that needs them is
+# created, so that the job manager is not blocked and jobs using other images keep being dispatched.
+# Preparations of the same image (object) are shared, and those of different objects for the same
+# image run one at a time, so that the second one finds the image already prepared.
+
+_num_image_preparation_workers = 4
+
+class _ImagePreparer:
+    def __init__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=_num_image_preparation_workers, thread_name_prefix='hither-prepare-image')
+        self._lock = threading.Lock()
+        # id of image -> (image, future); the image is kept so that its id is not reused
+        self._futures: Dict[int, Tuple[DockerImage, concurrent.futures.Future]] = {}
+        self._key_locks: Dict[str, threading.Lock] = {}
+    def start(self, image: DockerImage) -> concurrent.futures.Future:
+        with self._lock:
+            x = self._futures.get(id(image), None)
+            if (x is not None) and not (x[1].done() and (x[1].exception() is not None)):
+                # (a failed preparation is attempted again)
+                return x[1]
+            key = image._get_preparation_key()
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            key_lock = self._key_locks[key]
+            f = self._executor.submit(_prepare_image, image, key_lock)
+            f.add_done_callback(lambda f: _notify_activity())
+            self._futures[id(image)] = (image, f)
+            return f
+
+def _prepare_image(image: DockerImage, key_lock: threading.Lock):
+    with key_lock:
+        image.prepare()
+
+global_image_preparer = _ImagePreparer()
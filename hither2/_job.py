@@ -1,11 +1,24 @@
 from hither2.runtimehook import PreContainerContext
 from .run_scriptdir_in_container import DockerImage
+import concurrent.futures
 import time
 import uuid
-from typing import Any, Callable, Dict, List, Union, cast
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union, cast
+from .consolecapture import ConsoleLines, _fmt_time
 
 class JobResult:
-    def __init__(self, *, return_value: Any=None, error: Union[Exception, None]=None, console_lines: List[dict], status: str):
+    def __init__(self, *,
+        return_value: Any=None,
+        error: Union[Exception, None]=None,
+        console_lines: Union[List[dict], None]=None,
+        status: str,
+        _return_value_uri: Union[str, None]=None,
+        _return_value_format: str='pkl',
+        _return_value_codec: Union[str, None]=None,
+        _console_lines_uri: Union[str, None]=None,
+        _console_lines_codec: Union[str, None]=None,
+        _original_runtime_sec: Union[float, None]=None
+    ):
         if status == 'finished':
             assert error == None, 'Error must be None if status is finished'
         elif status == 'error':
@@ -16,48 +29,213 @@ class JobResult:
         self._error = error
         self._console_lines = console_lines
         self._status = status
+        # for lazy (cached) results, the values are loaded from these uris when first accessed
+        self._return_value_uri = _return_value_uri
+        self._return_value_format = _return_value_format
+        self._return_value_codec = _return_value_codec
+        self._console_lines_uri = _console_lines_uri
+        self._console_lines_codec = _console_lines_codec
+        self._return_value_loaded = _return_value_uri is None
+        # runtime of the job that originally produced a cached result
+        self._original_runtime_sec = _original_runtime_sec
+        # (function_name, function_version) for reporting job cache stats when a cached result is loaded
+        self._stats_key: Union[None, Tuple[str, str]] = None
     @property
     def return_value(self):
+        if not self._return_value_loaded:
+            assert self._return_value_uri is not None
+            timer = time.time()
+            self._return_value, num_bytes = _load_cached_return_value(self._return_value_uri, self._return_value_format, self._return_value_codec)
+            self._return_value_loaded = True
+            if self._stats_key is not None:
+                from ._job_cache_stats import global_job_cache_stats
+                global_job_cache_stats._record_load(self._stats_key[0], self._stats_key[1], num_bytes=num_bytes, elapsed_sec=time.time() - timer)
         return self._return_value
     @property
+    def return_value_is_loaded(self):
+        return self._return_value_loaded
+    @property
     def error(self):
         return self._error
     @property
-    def console_lines(self):
+    def console_lines(self) -> List[dict]:
+        if self._console_lines is None:
+            if self._console_lines_uri is not None:
+                cl = _load_cached_console_lines(self._console_lines_uri, self._console_lines_codec)
+            else:
+                cl = None
+            self._console_lines = cl if cl is not None else []
         return self._console_lines
     @property
     def status(self):
         return self._status
-    def to_cache_dict(self):
+    def to_cache_dict(self, compression: Union[str, None]=None, compression_min_size: int=0, runtime_sec: Union[float, None]=None, serializer: Union[str, None]=None):
         import kachery_client as kc
+        import pickle
+        import json
+        import os
+        from ._mmap_result import _extract_arrays, _collect_npy_uris
+        from ._compression import _choose_compression_codec, _compress
+        from ._serialization import _select_serializer, _serialize
+        return_value = self.return_value
+        rv_format = 'pkl'
+        rv_codec: Union[str, None] = None
+        blob_uris: List[str] = []
+        if return_value is None:
+            rv_uri = None
+        elif _select_serializer(return_value, serializer=serializer).name != 'pickle':
+            data = _serialize(return_value, serializer=serializer)
+            rv_format = 'serialized'
+            rv_codec = _choose_compression_codec(compression, len(data), compression_min_size)
+            rv_uri = _store_bytes(_compress(data, rv_codec))
+        elif compression is None:
+            # large arrays are stored as separate .npy files so that cache hits can memory-map them
+            rv, has_arrays = _extract_arrays(return_value)
+            rv_uri = kc.store_pkl(rv)
+            rv_format = 'npy' if has_arrays else 'pkl'
+            blob_uris.extend(_collect_npy_uris(rv))
+        else:
+            # compressed results cannot be memory-mapped, so the arrays stay in the pickle
+            data = pickle.dumps(return_value)
+            rv_codec = _choose_compression_codec(compression, len(data), compression_min_size)
+            rv_uri = _store_bytes(_compress(data, rv_codec))
+        if self._console_lines_uri is not None:
+            cl_uri = self._console_lines_uri
+            cl_codec = self._console_lines_codec
+        elif isinstance(self.console_lines, ConsoleLines):
+            # written to a file directly, so that lines spilled to disk are not all loaded into memory
+            with kc.TemporaryDirectory() as tmpdir:
+                fname = f'{tmpdir}/console_lines.json'
+                with open(fname, 'w') as f:
+                    self.console_lines._write_json(f)
+                cl_codec = _choose_compression_codec(compression, os.path.getsize(fname), compression_min_size)
+                if cl_codec is None:
+                    cl_uri = kc.store_file(fname)
+                else:
+                    with open(fname, 'rb') as f:
+                        cl_uri = _store_bytes(_compress(f.read(), cl_codec))
+        else:
+            console_lines = self.console_lines
+            cl_data = json.dumps(console_lines).encode('utf-8')
+            cl_codec = _choose_compression_codec(compression, len(cl_data), compression_min_size)
+            if cl_codec is None:
+                cl_uri = kc.store_json(console_lines)
+            else:
+                cl_uri = _store_bytes(_compress(cl_data, cl_codec))
         return {
-            'returnValueUri': kc.store_pkl(self._return_value) if self._return_value is not None else None,
+            'returnValueUri': rv_uri,
+            'returnValueFormat': rv_format,
+            'returnValueCodec': rv_codec,
             'errorMessage': str(self._error) if self._error is not None else None,
-            'consoleLinesUri': kc.store_json(self._console_lines),
-            'status': self._status
+            'consoleLinesUri': cl_uri,
+            'consoleLinesCodec': cl_codec,
+            'status': self._status,
+            'runtimeSec': runtime_sec,
+            # all stored files, used for garbage collection of the job cache
+            'blobUris': ([rv_uri] if rv_uri is not None else []) + blob_uris + [cl_uri]
         }
     @staticmethod
-    def from_cache_dict(x: dict):
-        import kachery_client as kc
+    def from_cache_dict(x: dict, lazy: bool=False, stored_locally: bool=True):
+        from ._compression import _check_compression_codec
         rv_uri = x.get('returnValueUri', None)
+        rv_format = x.get('returnValueFormat', 'pkl')
+        rv_codec = x.get('returnValueCodec', None)
         e = x.get('errorMessage', None)
         cl_uri = x.get('consoleLinesUri', None)
+        cl_codec = x.get('consoleLinesCodec', None)
         s = x.get('status', '')
+        runtime_sec = x.get('runtimeSec', None)
         if rv_uri is None:
             raise Exception('No returnValueUri')
-        if kc.load_file(rv_uri) is None:
-            raise Exception('Unable to load cached return value')
-        return_value = kc.load_pkl(rv_uri)
-        if cl_uri is not None:
-            cl = cast(List[dict], kc.load_json(cl_uri))
-        else:
-            cl = None
-        return JobResult(
-            return_value=return_value,
+        if rv_format not in ['pkl', 'npy', 'serialized']:
+            raise Exception(f'Unexpected return value format: {rv_format}')
+        _check_compression_codec(rv_codec)
+        _check_compression_codec(cl_codec)
+        jr = JobResult(
             error=Exception(e) if e is not None else None,
-            console_lines=cl if cl is not None else [],
-            status=s
+            status=s,
+            _return_value_uri=rv_uri,
+            _return_value_format=rv_format,
+            _return_value_codec=rv_codec,
+            _console_lines_uri=cl_uri,
+            _console_lines_codec=cl_codec,
+            _original_runtime_sec=runtime_sec
         )
+        if not lazy:
+            jr.return_value
+            jr.console_lines
+        elif stored_locally:
+            # the return value is only loaded when it is consumed, but its files (including the .npy files
+            # of its arrays) must still be available; they are not loaded here
+            array_uris = [u for u in x.get('blobUris', []) if u not in [rv_uri, cl_uri]] if rv_format == 'npy' else []
+            for u in [rv_uri] + array_uris:
+                if not _is_stored_locally(u):
+                    raise Exception(f'Unable to load cached return value: {u}')
+        return jr
+
+def _load_cached_return_value(rv_uri: str, rv_format: str, rv_codec: Union[str, None]) -> Tuple[Any, int]:
+    # returns the return value and the number of bytes read (or memory-mapped)
+    import pickle
+    import os
+    from ._mmap_result import _restore_arrays
+    from ._compression import _decompress
+    from ._serialization import _deserialize, _deserialize_from_file
+    if rv_codec is None:
+        import kachery_client as kc
+        rv_path = kc.load_file(rv_uri)
+        if rv_path is None:
+            raise Exception('Unable to load cached return value')
+        if rv_format == 'serialized':
+            return_value = _deserialize_from_file(rv_path)
+        else:
+            with open(rv_path, 'rb') as f:
+                return_value = pickle.load(f)
+        num_bytes = os.path.getsize(rv_path)
+    else:
+        data = _load_bytes(rv_uri)
+        if rv_format == 'serialized':
+            return_value = _deserialize(_decompress(data, rv_codec))
+        else:
+            return_value = pickle.loads(_decompress(data, rv_codec))
+        num_bytes = len(data)
+    if rv_format == 'npy':
+        file_sizes: List[int] = []
+        return_value = _restore_arrays(return_value, file_sizes)
+        num_bytes += sum(file_sizes)
+    return return_value, num_bytes
+
+def _load_cached_console_lines(cl_uri: str, cl_codec: Union[str, None]) -> Union[List[dict], None]:
+    import json
+    from ._compression import _decompress
+    if cl_codec is None:
+        import kachery_client as kc
+        return cast(Union[List[dict], None], kc.load_json(cl_uri))
+    else:
+        return json.loads(_decompress(_load_bytes(cl_uri), cl_codec).decode('utf-8'))
+
+def _is_stored_locally(uri: str) -> bool:
+    # whether a file is in the local kachery storage (it is not loaded from other nodes)
+    from kachery_client._load_file import _load_file
+    try:
+        return _load_file(uri, local_only=True) is not None
+    except:
+        return False
+
+def _store_bytes(data: bytes) -> str:
+    import kachery_client as kc
+    with kc.TemporaryDirectory() as tmpdir:
+        fname = f'{tmpdir}/data.bin'
+        with open(fname, 'wb') as f:
+            f.write(data)
+        return kc.store_file(fname)
+
+def _load_bytes(uri: str) -> bytes:
+    import kachery_client as kc
+    path = kc.load_file(uri)
+    if path is None:
+        raise Exception(f'Unable to load file: {uri}')
+    with open(path, 'rb') as f:
+        return f.read()
 
 class Job:
     def __init__(self, function: Callable, kwargs: dict):
@@ -80,7 +258,16 @@ class Job:
         self._cancel_pending = False
         self._result: Union[JobResult, None] = None
         self._result_is_from_cache: bool = False
-        self._console_lines: Union[None, List[dict]] = None
+        self._console_lines: Union[None, ConsoleLines, List[dict]] = None
+        self._job_cache_checked: bool = False
+        self._dag_hash: Union[str, None] = None
+        self._demanded: bool = False
+        self._consumers: List[Job] = []
+        for input_job in _get_input_jobs(kwargs):
+            input_job._consumers.append(self)
+        self._image_preparation: Union[concurrent.futures.Future, None] = None
+        # start preparing the image now, even if the job will only be ready to run much later
+        self._start_image_preparation()
 
         self._job_manager._add_job(self)
         if self._config.log:
@@ -107,15 +294,43 @@ class Job:
     def image(self) -> Union[DockerImage, bool, None]:
         return self._function_wrapper.image
     @property
+    def resources(self) -> Dict[str, float]:
+        # the resources declared in hi.function, with the overrides from the config
+        if self._config.resources is None:
+            return self._function_wrapper.resources
+        return {**self._function_wrapper.resources, **self._config.resources}
+    @property
     def timestamp_started(self):
         return self._timestamp_started
     @property
     def timestamp_completed(self):
         return self._timestamp_completed
-    def _prepare(self, kwargs: Dict[str, Any]):
-        image = self.get_image(kwargs)
-        if image is not None:
-            image.prepare()
+    def _start_image_preparation(self, resolve_kwargs: bool=False):
+        # the image is prepared in the background; when it is determined by precontainer hooks,
+        # this has to wait until the kwargs can be resolved
+        from ._image_preparer import global_image_preparer
+        if (self._image_preparation is not None) or (not self.config.use_container):
+            return
+        image = self._function_wrapper.image
+        if isinstance(image, bool):
+            if (not image) or (not resolve_kwargs):
+                return
+            image = self.get_image(self.get_resolved_kwargs())
+        if (image is None) or image.is_prepared():
+            return
+        self._image_preparation = global_image_preparer.start(image)
+    def _prepare(self) -> bool:
+        # returns whether the job is ready to be dispatched (raises if the image could not be prepared)
+        self._start_image_preparation(resolve_kwargs=True)
+        f = self._image_preparation
+        if f is None:
+            return True
+        if not f.done():
+            return False
+        e = f.exception()
+        if e is not None:
+            raise e
+        return True
     def get_image(self, kwargs: Dict[str, Any]) -> Union[DockerImage, None]:
         if not self.config.use_container:
             return None
@@ -154,6 +369,10 @@ class Job:
     @property
     def log(self):
         return self.config.log
+    def _set_checking_cache(self):
+        self._status = 'checking_cache'
+    def _set_pending(self):
+        self._status = 'pending'
     def _set_queued(self):
         self._status = 'queued'
         if self.log:
@@ -164,9 +383,14 @@ class Job:
         if self.log:
             self.log._report_job_running(self)
     def _set_finished(self, return_value: Any, result_is_from_cache: bool=False):
+        self._set_finished_with_result(
+            JobResult(return_value=return_value, status='finished', console_lines=self._console_lines if self._console_lines is not None else []),
+            result_is_from_cache=result_is_from_cache
+        )
+    def _set_finished_with_result(self, result: JobResult, result_is_from_cache: bool=False):
         self._timestamp_completed = time.time() - 0
         self._status = 'finished'
-        self._result = JobResult(return_value=return_value, status='finished', console_lines=self._console_lines if self._console_lines is not None else [])
+        self._result = result
         self._result_is_from_cache = result_is_from_cache
         if self.log:
             self.log._report_job_finished(self)
@@ -176,9 +400,28 @@ class Job:
         self._result = JobResult(error=error, status='error', console_lines=self._console_lines if self._console_lines is not None else [])
         if self.log:
             self.log._report_job_error(self)
-    def _set_console_lines(self, lines: List[dict]=[]):
+    def _set_console_lines(self, lines: Union[ConsoleLines, List[dict]]=[]):
         self._console_lines = lines
+    def _get_console_lines_buffer(self) -> ConsoleLines:
+        # the lines received while the job runs
+        if not isinstance(self._console_lines, ConsoleLines):
+            lines = ConsoleLines(max_lines_in_memory=self.config.console_max_lines, overflow=self.config.console_overflow)
+            if self._console_lines is not None:
+                lines._extend_rows([(a['timestamp'], 1 if a.get('stderr', False) else 0, a['text']) for a in self._console_lines])
+            self._console_lines = lines
+        return self._console_lines
+    def _append_console_rows(self, rows: List[Tuple[float, int, str]]):
+        self._get_console_lines_buffer()._extend_rows(rows)
+    def console_stream(self) -> 'ConsoleStream':
+        """
+        Returns a stream of the console lines of the job, which are available while the job is running.
+        Iterating over the stream yields the lines (dicts with keys timestamp, text and stderr) as they arrive,
+        until the job has completed (and runs the job, like wait()). Use read() to get the lines that have
+        arrived so far without waiting.
+        """
+        return ConsoleStream(self)
     def wait(self, timeout_sec: Union[float, None]=None):
+        self._job_manager._demand_job(self)
         timer = time.time()
         while True:
             self._job_manager._iterate()
@@ -192,7 +435,7 @@ class Job:
                 raise Exception(f'Error in {self.function_name} ({self.function_version}): {str(e)}')
             else:
                 if timeout_sec is None or timeout_sec > 0:
-                    time.sleep(0.05)
+                    self._job_manager._wait_for_activity(0.05)
             if timeout_sec is not None:
                 elapsed = time.time() - timer
                 if (elapsed > timeout_sec) or (timeout_sec == 0):
@@ -200,10 +443,44 @@ class Job:
     def print_console(self, label: Union[None, str]=None):
         if label is None:
             label = self.function_name
-        lines = self._console_lines
+        lines = self._result.console_lines if self._result is not None else self._console_lines
         if lines is not None:
             _print_console_lines(lines, label=label)
 
+class ConsoleStream:
+    def __init__(self, job: Job):
+        self._job = job
+        self._position = 0
+    def read(self, max_lines: int=10000) -> List[dict]:
+        # the lines that have arrived since the last read (at most max_lines)
+        j = self._job
+        lines = j._result.console_lines if j._result is not None else j._console_lines
+        if lines is None:
+            return []
+        if isinstance(lines, ConsoleLines):
+            rows, self._position = lines._read(self._position, max_lines)
+            return [dict(timestamp=t, text=txt, stderr=s == 1) for t, s, txt in rows]
+        else:
+            # for example, from the job cache
+            ret = lines[self._position:self._position + max_lines]
+            self._position += len(ret)
+            return ret
+    def __iter__(self) -> Iterator[dict]:
+        j = self._job
+        j._job_manager._demand_job(j)
+        while True:
+            j._job_manager._iterate()
+            done = j.status in ['finished', 'error']
+            while True:
+                lines = self.read()
+                if len(lines) == 0:
+                    break
+                for line in lines:
+                    yield line
+            if done:
+                return
+            j._job_manager._wait_for_activity(0.05)
+
 def _print_console_lines(lines: List[dict], *, label: str=''):
     if lines is None:
         return
@@ -231,6 +508,12 @@ def _resolve_kwargs(x: Any):
     else:
         return x
 
-def _fmt_time(t):
-    import datetime
-    return datetime.datetime.fromtimestamp(t).isoformat()
\ No newline at end of file
+def _get_input_jobs(x: Any) -> List[Job]:
+    if isinstance(x, Job):
+        return [x]
+    elif isinstance(x, dict):
+        return [j for v in x.values() for j in _get_input_jobs(v)]
+    elif isinstance(x, (list, tuple)):
+        return [j for a in x for j in _get_input_jobs(a)]
+    else:
+        return []
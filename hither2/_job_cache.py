@@ -1,53 +1,270 @@
 import hashlib
 import json
-from typing import Any, Dict, Union
-from ._job import JobResult
+import os
+import time
+import queue
+import threading
+import atexit
+from typing import Any, Dict, List, Tuple, Union
+from ._job import JobResult, Job
 
 job_cache_version = '0.1.1'
 
 class JobCache:
-    def __init__(self, *, feed_name: Union[str, None]=None, feed_uri: Union[str, None]=None):
+    def __init__(self, *,
+        feed_name: Union[str, None]=None,
+        feed_uri: Union[str, None]=None,
+        num_shards: int=1,
+        feed_uris: Union[List[str], None]=None,
+        hash_mode: str='value',
+        write_behind: bool=True,
+        write_queue_size: int=100,
+        compression: Union[str, None]=None,
+        compression_min_size: int=16 * 1024
+    ):
+        """
+        num_shards: if > 1, entries are distributed over the feeds {feed_name}.0, {feed_name}.1, ... by job hash prefix
+        feed_uris: alternatively, the uris of the feeds of a sharded cache (one per shard)
+        hash_mode='value': the job hash is computed from the values of the (resolved) kwargs
+        hash_mode='dag': input jobs contribute their own job hashes rather than their return values,
+            so jobs can be looked up in the cache before their inputs have been computed or loaded.
+            This assumes that hither functions are deterministic for a given version.
+        write_behind: if True, results are written to the cache by a background thread.
+            At most write_queue_size results wait to be written; beyond that, the writing job manager blocks.
+            Pending writes are flushed by hi.wait() and at exit. Each shard has its own writer.
+        compression: codec used for cached return values and console lines ('zlib', 'lz4', 'zstd' or None).
+            Payloads smaller than compression_min_size bytes are stored uncompressed.
+            Can be overridden per function via hi.function(..., cache_compression=...).
+            Note that compressed arrays are loaded into memory rather than memory-mapped.
+        """
         import kachery_client as kc
-        if (feed_name is not None) and (feed_uri is not None):
-            raise Exception('You cannot specify both feed_name and feed_id')
+        from ._compression import _check_compression_codec
+        _check_compression_codec(compression)
+        self._compression = compression
+        self._compression_min_size = compression_min_size
+        if hash_mode not in ['value', 'dag']:
+            raise Exception(f'Invalid hash_mode for job cache: {hash_mode}')
+        self._hash_mode = hash_mode
+        if len([a for a in [feed_name, feed_uri, feed_uris] if a is not None]) > 1:
+            raise Exception('You can only specify one of feed_name, feed_uri and feed_uris')
+        if num_shards < 1:
+            raise Exception(f'Invalid number of shards for job cache: {num_shards}')
         if feed_name is not None:
-            feed = kc.load_feed(feed_name, create=True)
+            if num_shards == 1:
+                feeds = [kc.load_feed(feed_name, create=True)]
+            else:
+                feeds = [kc.load_feed(f'{feed_name}.{i}', create=True) for i in range(num_shards)]
         elif feed_uri is not None:
-            feed = kc.load_feed(feed_uri)
+            if num_shards != 1:
+                raise Exception('Use feed_uris rather than feed_uri for a sharded job cache')
+            feeds = [kc.load_feed(feed_uri)]
+        elif feed_uris is not None:
+            if len(feed_uris) == 0:
+                raise Exception('feed_uris is empty')
+            feeds = [kc.load_feed(uri) for uri in feed_uris]
         else:
             raise Exception('You must specify a feed_name or a feed_uri')
-        self._feed = feed
-    def _cache_job_result(self, job_hash: str, job_result: JobResult):
-        import kachery_client as kc
+        self._feeds = feeds
+        self._writers: Union[List[_JobCacheWriter], None] = [
+            _JobCacheWriter(self, max_queue_size=write_queue_size)
+            for _ in feeds
+        ] if write_behind else None
+        _all_job_caches.append(self)
+    @property
+    def hash_mode(self):
+        return self._hash_mode
+    @property
+    def compression(self):
+        return self._compression
+    @property
+    def num_shards(self):
+        return len(self._feeds)
+    def flush(self):
+        # wait for all pending writes to complete
+        if self._writers is not None:
+            for w in self._writers:
+                w.flush()
+    def _get_shard_index(self, job_hash: str) -> int:
+        if len(self._feeds) == 1:
+            return 0
+        return int(job_hash[:8], 16) % len(self._feeds)
+    def _get_feed(self, job_hash: str):
+        return self._feeds[self._get_shard_index(job_hash)]
+    def _get_pending_job_result(self, job_hash: str) -> Union[JobResult, None]:
+        return self._writers[self._get_shard_index(job_hash)].get_pending_result(job_hash) if self._writers is not None else None
+    def _store_job_result(self, job_hash: str, job_result: JobResult, *, compression: Union[str, None], function_name: str, function_version: str, runtime_sec: Union[float, None], serializer: Union[str, None]=None):
+        x = dict(job_hash=job_hash, job_result=job_result, compression=compression, function_name=function_name, function_version=function_version, runtime_sec=runtime_sec, serializer=serializer)
+        if self._writers is not None:
+            self._writers[self._get_shard_index(job_hash)].put(x)
+        else:
+            self._cache_job_result(**x)
+    def _cache_job_result(self, job_hash: str, job_result: JobResult, *, compression: Union[str, None], function_name: str, function_version: str, runtime_sec: Union[float, None], serializer: Union[str, None]=None):
+        self._append_cached_results([self._prepare_cached_result(job_hash, job_result, compression=compression, function_name=function_name, function_version=function_version, runtime_sec=runtime_sec, serializer=serializer)])
+    def _prepare_cached_result(self, job_hash: str, job_result: JobResult, *, compression: Union[str, None], function_name: str, function_version: str, runtime_sec: Union[float, None], serializer: Union[str, None]=None) -> Tuple[str, dict, dict]:
+        # stores the files of the result; returns the job hash, the message for the job subfeed and the message for the index
         cached_result = {
             'jobCacheVersion': job_cache_version,
             'jobHash': job_hash,
-            'jobResult': job_result.to_cache_dict()
+            'jobResult': job_result.to_cache_dict(compression=compression, compression_min_size=self._compression_min_size, runtime_sec=runtime_sec, serializer=serializer)
         }
-
-        obj = cached_result
-        sf = self._feed.load_subfeed({'jobHash': job_hash})
-        sf.append_message(obj)
+        # the index is used for garbage collection of the job cache
+        blob_uris: List[str] = cached_result['jobResult']['blobUris']
+        size_bytes = sum([_get_blob_size(uri) for uri in blob_uris])
+        index_message = {
+            'type': 'stored',
+            'timestamp': time.time() - 0,
+            'jobHash': job_hash,
+            'functionName': function_name,
+            'functionVersion': function_version,
+            'sizeBytes': size_bytes,
+            'blobUris': blob_uris
+        }
+        return job_hash, cached_result, index_message
+    def _append_cached_results(self, prepared: List[Tuple[str, dict, dict]]):
+        # a single append per job subfeed, and per shard for the index messages
+        from ._job_cache_stats import global_job_cache_stats
+        messages_by_job_hash: Dict[str, List[dict]] = {}
+        index_messages_by_shard: Dict[int, List[dict]] = {}
+        for job_hash, cached_result, index_message in prepared:
+            messages_by_job_hash.setdefault(job_hash, []).append(cached_result)
+            index_messages_by_shard.setdefault(self._get_shard_index(job_hash), []).append(index_message)
+        for job_hash, messages in messages_by_job_hash.items():
+            self._get_feed(job_hash).load_subfeed({'jobHash': job_hash}).append_messages(messages)
+        for i, index_messages in index_messages_by_shard.items():
+            self._index_subfeed(i).append_messages(index_messages)
+        for _, _, m in prepared:
+            global_job_cache_stats._record_write(m['functionName'], m['functionVersion'], num_bytes=m['sizeBytes'])
+    def _record_accesses(self, job_hashes: List[str]):
+        # a single message per shard for a batch of cache hits
+        job_hashes_by_shard: Dict[int, List[str]] = {}
+        for job_hash in job_hashes:
+            i = self._get_shard_index(job_hash)
+            if i not in job_hashes_by_shard:
+                job_hashes_by_shard[i] = []
+            job_hashes_by_shard[i].append(job_hash)
+        for i, hashes in job_hashes_by_shard.items():
+            self._index_subfeed(i).append_message({
+                'type': 'accessed',
+                'timestamp': time.time() - 0,
+                'jobHashes': hashes
+            })
+    def _index_subfeed(self, shard_index: int):
+        return self._feeds[shard_index].load_subfeed('jobCacheIndex')
+    def gc(self, *, max_size_bytes: int, pinned_functions: List[str]=[], dry_run: bool=False):
+        """
+        Evict least-recently-used entries until the total size of the cache is at most max_size_bytes.
+        pinned_functions: entries of these functions are never evicted ('name' or 'name:version')
+        Evicted entries are tombstoned; their files are not deleted from kachery storage, since they may be shared.
+        Returns a dict with statistics of the gc pass, including the URIs of the files that are no longer
+        referenced by the cache (unreferenced_file_uris).
+        """
+        from ._job_cache_gc import _gc_job_cache
+        self.flush()
+        return _gc_job_cache(self, max_size_bytes=max_size_bytes, pinned_functions=pinned_functions, dry_run=dry_run)
+    def _evict(self, job_hash: str):
+        sf = self._get_feed(job_hash).load_subfeed({'jobHash': job_hash})
+        sf.append_message({
+            'jobCacheVersion': job_cache_version,
+            'jobHash': job_hash,
+            'evicted': True
+        })
+        self._index_subfeed(self._get_shard_index(job_hash)).append_message({
+            'type': 'evicted',
+            'timestamp': time.time() - 0,
+            'jobHash': job_hash
+        })
 
     def _fetch_cached_job_result(self, job_hash:str) -> Union[JobResult, None]:
         import kachery_client as kc
-        sf = self._feed.load_subfeed({'jobHash': job_hash})
+        sf = self._get_feed(job_hash).load_subfeed({'jobHash': job_hash})
         messages =  sf.get_next_messages(wait_msec=0)
         if len(messages) > 0:
             obj = messages[-1] # last message
+            if obj.get('evicted', False):
+                return None
             if obj.get('jobCacheVersion', None) != job_cache_version:
                 print('Warning: incorrect job cache version')
                 return None
             try:
-                return JobResult.from_cache_dict(
+                jr = JobResult.from_cache_dict(
                     obj['jobResult']
                 )
+                self._record_accesses([job_hash])
+                return jr
             except Exception as e:
                 print('Warning: problem retrieving cached result:', e)
                 return None
         else:
             return None
 
+class _JobCacheWriter:
+    def __init__(self, job_cache: JobCache, max_queue_size: int):
+        self._job_cache = job_cache
+        # a bounded queue: put() blocks when the writer falls behind
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._thread: Union[threading.Thread, None] = None
+        self._lock = threading.Lock()
+        # results that have been queued but not yet written, so lookups in this process can still find them
+        self._pending_results: Dict[str, JobResult] = {}
+    def put(self, x: Dict[str, Any]):
+        # x contains the keyword arguments of JobCache._cache_job_result
+        self._start_if_needed()
+        with self._lock:
+            self._pending_results[x['job_hash']] = x['job_result']
+        self._queue.put(x)
+    def get_pending_result(self, job_hash: str) -> Union[JobResult, None]:
+        with self._lock:
+            return self._pending_results.get(job_hash, None)
+    def flush(self):
+        if self._thread is not None:
+            self._queue.join()
+    def _start_if_needed(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+    def _run(self):
+        batch_size = 50
+        while True:
+            # wait for the next item, then take whatever else is already queued
+            items: List[Dict[str, Any]] = [self._queue.get()]
+            while len(items) < batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # the files of each result are stored first; then the messages of the batch are appended together
+            prepared: List[Tuple[str, dict, dict]] = []
+            for x in items:
+                try:
+                    prepared.append(self._job_cache._prepare_cached_result(**x))
+                except Exception as e:
+                    print('Warning: problem writing result to job cache:', e)
+            try:
+                self._job_cache._append_cached_results(prepared)
+            except Exception as e:
+                print('Warning: problem writing results to job cache:', e)
+            with self._lock:
+                for x in items:
+                    if self._pending_results.get(x['job_hash'], None) is x['job_result']:
+                        del self._pending_results[x['job_hash']]
+            for _ in items:
+                self._queue.task_done()
+
+_all_job_caches: List[JobCache] = []
+def flush_all():
+    for jc in _all_job_caches:
+        jc.flush()
+
+atexit.register(flush_all)
+
+def _get_blob_size(uri: str) -> int:
+    import kachery_client as kc
+    path = kc.load_file(uri)
+    if path is None:
+        return 0
+    return os.path.getsize(path)
+
 def _hash_kwargs(kwargs: Any):
     if _is_jsonable(kwargs):
         return _get_object_hash(kwargs)
@@ -81,6 +298,27 @@ def _compute_job_hash(
         hash_object['kwargs_hash'] = _hash_kwargs(kwargs)
     return _get_object_hash(hash_object)
 
+def _compute_job_dag_hash(job: Job) -> str:
+    if job._dag_hash is None:
+        job._dag_hash = _compute_job_hash(
+            function_name=job.function_name,
+            function_version=job.function_version,
+            kwargs={'dag_kwargs': _replace_jobs_by_dag_hashes(job._kwargs)}
+        )
+    return job._dag_hash
+
+def _replace_jobs_by_dag_hashes(x: Any):
+    if isinstance(x, Job):
+        return {'_hither_job_dag_hash': _compute_job_dag_hash(x)}
+    elif isinstance(x, dict):
+        return {k: _replace_jobs_by_dag_hashes(v) for k, v in x.items()}
+    elif isinstance(x, list):
+        return [_replace_jobs_by_dag_hashes(a) for a in x]
+    elif isinstance(x, tuple):
+        return tuple([_replace_jobs_by_dag_hashes(a) for a in x])
+    else:
+        return x
+
 def _get_object_hash(hash_object: dict):
     return _sha1_of_object(hash_object)
 
@@ -0,0 +1,99 @@
+from typing import Dict, List, Set
+from ._job_cache import JobCache
+
+class _JobCacheEntry:
+    def __init__(self, *, job_hash: str, function_name: str, function_version: str, size_bytes: int, blob_uris: List[str], timestamp: float):
+        self.job_hash = job_hash
+        self.function_name = function_name
+        self.function_version = function_version
+        self.size_bytes = size_bytes
+        self.blob_uris = blob_uris
+        self.last_access = timestamp
+
+def _gc_job_cache(job_cache: JobCache, *, max_size_bytes: int, pinned_functions: List[str], dry_run: bool):
+    entries = _load_job_cache_entries(job_cache)
+    num_entries = len(entries)
+    total_size = sum([e.size_bytes for e in entries.values()])
+    evicted: List[_JobCacheEntry] = []
+    size = total_size
+    # least recently used first
+    for e in sorted(entries.values(), key=lambda e: e.last_access):
+        if size <= max_size_bytes:
+            break
+        if _is_pinned(e, pinned_functions):
+            continue
+        evicted.append(e)
+        size -= e.size_bytes
+    if not dry_run:
+        for e in evicted:
+            job_cache._evict(e.job_hash)
+    # Evicted entries are only tombstoned. Their files are content addressed, so they can also be referenced
+    # by other job caches or by anything else stored in kachery, and are therefore not deleted.
+    evicted_hashes = set([e.job_hash for e in evicted])
+    referenced_uris: Set[str] = set([uri for e in entries.values() if e.job_hash not in evicted_hashes for uri in e.blob_uris])
+    unreferenced_uris: List[str] = []
+    for e in evicted:
+        for uri in e.blob_uris:
+            if uri not in referenced_uris:
+                unreferenced_uris.append(uri)
+                referenced_uris.add(uri) # don't list it twice
+    return {
+        'num_entries': num_entries,
+        'num_evicted': len(evicted),
+        'unreferenced_file_uris': unreferenced_uris,
+        'size_bytes_before': total_size,
+        'size_bytes_after': size
+    }
+
+def _load_job_cache_entries(job_cache: JobCache) -> Dict[str, _JobCacheEntry]:
+    entries: Dict[str, _JobCacheEntry] = {}
+    for shard_index in range(job_cache.num_shards):
+        _load_job_cache_entries_from_index(job_cache._index_subfeed(shard_index), entries)
+    return entries
+
+def _load_job_cache_entries_from_index(sf, entries: Dict[str, _JobCacheEntry]):
+    while True:
+        messages = sf.get_next_messages(wait_msec=0)
+        if len(messages) == 0:
+            break
+        for m in messages:
+            t = m.get('type', None)
+            if t == 'stored':
+                job_hash = m['jobHash']
+                entries[job_hash] = _JobCacheEntry(
+                    job_hash=job_hash,
+                    function_name=m.get('functionName', ''),
+                    function_version=m.get('functionVersion', ''),
+                    size_bytes=m.get('sizeBytes', 0),
+                    blob_uris=m.get('blobUris', []),
+                    timestamp=m.get('timestamp', 0)
+                )
+            elif t == 'accessed':
+                for job_hash in m.get('jobHashes', []):
+                    if job_hash in entries:
+                        entries[job_hash].last_access = max(entries[job_hash].last_access, m.get('timestamp', 0))
+            elif t == 'evicted':
+                job_hash = m['jobHash']
+                if job_hash in entries:
+                    del entries[job_hash]
+
+def _is_pinned(e: _JobCacheEntry, pinned_functions: List[str]):
+    for p in pinned_functions:
+        if ':' in p:
+            name, version = p.split(':', 1)
+            if (e.function_name == name) and (e.function_version == version):
+                return True
+        elif e.function_name == p:
+            return True
+    return False
+
+def _parse_size(x: str) -> int:
+    # for example: 1000, 500MB, 10GB
+    units = {'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3, 'TB': 1000 ** 4, 'KIB': 1024, 'MIB': 1024 ** 2, 'GIB': 1024 ** 3, 'TIB': 1024 ** 4}
+    y = x.strip().upper()
+    for u in sorted(units.keys(), key=lambda u: -len(u)):
+        if y.endswith(u):
+            return int(float(y[:-len(u)]) * units[u])
+    if y.endswith('B'):
+        y = y[:-1]
+    return int(float(y))
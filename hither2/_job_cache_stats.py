@@ -0,0 +1,141 @@
+import threading
+import time
+from typing import Dict, List, Tuple, Union
+
+# upper bounds (sec) of the lookup latency histogram buckets (the last bucket is unbounded)
+_latency_buckets_sec = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10]
+
+class _FunctionCacheStats:
+    def __init__(self):
+        self.num_lookups = 0
+        self.num_hits = 0
+        self.latency_counts = [0 for _ in range(len(_latency_buckets_sec) + 1)]
+        self.latency_total_sec = 0.0
+        self.latency_max_sec = 0.0
+        self.num_loads = 0
+        self.bytes_read = 0
+        self.load_time_sec = 0.0
+        self.num_writes = 0
+        self.bytes_written = 0
+        self.original_runtime_of_hits_sec = 0.0
+    def latency_percentile(self, p: float) -> Union[float, None]:
+        # approximate: the upper bound of the bucket containing the percentile
+        n = sum(self.latency_counts)
+        if n == 0:
+            return None
+        target = p * n
+        count = 0
+        for i, c in enumerate(self.latency_counts):
+            count += c
+            if count >= target:
+                return _latency_buckets_sec[i] if i < len(_latency_buckets_sec) else self.latency_max_sec
+        return self.latency_max_sec
+
+class JobCacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[Tuple[str, str], _FunctionCacheStats] = {}
+        self._report_interval_sec: Union[float, None] = None
+        self._last_report_timestamp = time.time()
+    def _get(self, function_name: str, function_version: str) -> _FunctionCacheStats:
+        k = (function_name, function_version)
+        s = self._stats.get(k, None)
+        if s is None:
+            s = _FunctionCacheStats()
+            self._stats[k] = s
+        return s
+    def _record_lookup(self, function_name: str, function_version: str, *, hit: bool, latency_sec: float, original_runtime_sec: Union[float, None]):
+        with self._lock:
+            s = self._get(function_name, function_version)
+            s.num_lookups += 1
+            if hit:
+                s.num_hits += 1
+                if original_runtime_sec is not None:
+                    s.original_runtime_of_hits_sec += original_runtime_sec
+            i = 0
+            while (i < len(_latency_buckets_sec)) and (latency_sec > _latency_buckets_sec[i]):
+                i += 1
+            s.latency_counts[i] += 1
+            s.latency_total_sec += latency_sec
+            s.latency_max_sec = max(s.latency_max_sec, latency_sec)
+    def _record_load(self, function_name: str, function_version: str, *, num_bytes: int, elapsed_sec: float):
+        with self._lock:
+            s = self._get(function_name, function_version)
+            s.num_loads += 1
+            s.bytes_read += num_bytes
+            s.load_time_sec += elapsed_sec
+    def _record_write(self, function_name: str, function_version: str, *, num_bytes: int):
+        with self._lock:
+            s = self._get(function_name, function_version)
+            s.num_writes += 1
+            s.bytes_written += num_bytes
+    def get(self) -> List[dict]:
+        ret: List[dict] = []
+        with self._lock:
+            for (function_name, function_version), s in self._stats.items():
+                ret.append({
+                    'function_name': function_name,
+                    'function_version': function_version,
+                    'num_lookups': s.num_lookups,
+                    'num_hits': s.num_hits,
+                    'hit_ratio': s.num_hits / s.num_lookups if s.num_lookups > 0 else None,
+                    'lookup_latency_sec': {
+                        'mean': s.latency_total_sec / s.num_lookups if s.num_lookups > 0 else None,
+                        'p50': s.latency_percentile(0.5),
+                        'p90': s.latency_percentile(0.9),
+                        'p99': s.latency_percentile(0.99),
+                        'max': s.latency_max_sec,
+                        'histogram': {
+                            'bucket_upper_bounds_sec': _latency_buckets_sec + [None],
+                            'counts': [c for c in s.latency_counts]
+                        }
+                    },
+                    'bytes_read': s.bytes_read,
+                    'bytes_written': s.bytes_written,
+                    'num_writes': s.num_writes,
+                    'load_time_sec': s.load_time_sec,
+                    # runtime of the original jobs minus the time spent looking up and loading the cached results
+                    'time_saved_sec': s.original_runtime_of_hits_sec - s.latency_total_sec - s.load_time_sec
+                })
+        return ret
+    def print(self):
+        x = self.get()
+        if len(x) == 0:
+            return
+        lines: List[str] = ['HITHER JOB CACHE STATS:']
+        for a in x:
+            hit_ratio = a['hit_ratio']
+            hit_pct = f'{hit_ratio * 100:.0f}%' if hit_ratio is not None else '-'
+            p50 = a['lookup_latency_sec']['p50']
+            p50_txt = f'{p50 * 1000:.0f} ms' if p50 is not None else '-'
+            lines.append(
+                f'  {a["function_name"]} ({a["function_version"]}): {a["num_lookups"]} lookups; {hit_pct} hits; p50 latency {p50_txt}; '
+                f'{a["bytes_read"]} bytes read; {a["bytes_written"]} bytes written; {a["time_saved_sec"]:.1f} sec saved'
+            )
+        print('\n'.join(lines))
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+    def _set_report_interval(self, interval_sec: Union[float, None]):
+        self._report_interval_sec = interval_sec
+        self._last_report_timestamp = time.time()
+    def _handle_periodic_report(self):
+        if self._report_interval_sec is None:
+            return
+        elapsed = time.time() - self._last_report_timestamp
+        if elapsed < self._report_interval_sec:
+            return
+        self._last_report_timestamp = time.time()
+        self.print()
+
+global_job_cache_stats = JobCacheStats()
+
+def get_job_cache_stats() -> List[dict]:
+    return global_job_cache_stats.get()
+
+def print_job_cache_stats():
+    global_job_cache_stats.print()
+
+def set_job_cache_stats_report_interval(interval_sec: Union[float, None]):
+    # print the job cache stats periodically while jobs are being managed (None to disable)
+    global_job_cache_stats._set_report_interval(interval_sec)
@@ -1,13 +1,17 @@
 import time
 from typing import Any, Dict, List, Union
 
-from ._check_job_cache import (_batch_check_job_cache,
+from ._check_job_cache import (_JobCacheChecker,
                                _write_result_to_job_cache)
-from ._job import Job
+from ._job import Job, _get_input_jobs
 from ._job_handler import JobHandler
+from ._job_cache import flush_all as _flush_job_caches
+from ._job_cache_stats import global_job_cache_stats
 from ._run_function import _run_function
 from .function import _get_hither_function_wrapper
 from .log import Log
+from ._activity import _clear_activity, _wait_for_activity
+from ._concurrency import _concurrency_group_has_room
 
 
 class JobManager:
@@ -19,21 +23,54 @@ class JobManager:
         self._num_errored = 0
         self._num_cache_hits = 0
         self._current_log: Union[None, Log] = None
+        # pending jobs that are not needed because all of their consumers were found in the job cache
+        self._pruned_jobs: Dict[str, Job] = {}
+        self._job_cache_checker = _JobCacheChecker()
     def _add_job(self, job: Job):
         self._jobs[job.job_id] = job
+        for input_job in _get_input_jobs(job._kwargs):
+            self._restore_pruned_job(input_job)
+    def _demand_job(self, job: Job):
+        job._demanded = True
+        self._restore_pruned_job(job)
+    def _restore_pruned_job(self, job: Job):
+        if job.job_id in self._pruned_jobs:
+            del self._pruned_jobs[job.job_id]
+            self._jobs[job.job_id] = job
+            for input_job in _get_input_jobs(job._kwargs):
+                self._restore_pruned_job(input_job)
+    def _prune_unneeded_jobs(self):
+        # In dag hashing mode, downstream jobs can be found in the cache before their inputs have run.
+        # Input jobs that are then no longer needed by any consumer are set aside (unless waited on directly).
+        # Iterate in reverse order of creation so that entire upstream subgraphs are pruned in one pass.
+        for job in reversed(list(self._jobs.values())):
+            if (job.status == 'pending') and (not job._demanded) and (len(job._consumers) > 0):
+                jc = job.config.job_cache
+                if (jc is not None) and (jc.hash_mode == 'dag'):
+                    if all([(c.status == 'finished') or (c.job_id in self._pruned_jobs) for c in job._consumers]):
+                        del self._jobs[job.job_id]
+                        self._pruned_jobs[job.job_id] = job
     def _iterate(self):
+        # activity reported from now on ends the next wait
+        _clear_activity()
         self._handle_status_report()
+        global_job_cache_stats._handle_periodic_report()
 
         deletion_job_ids: List[str] = []
 
         # check job cache for the pending jobs that are ready to run
-        # important to do this in a single batch (instead of individual checks)
-        jobs_to_check = [job for job in self._jobs.values() if (job.status == 'pending') and (job.config.job_cache is not None) and (_job_is_ready_to_run(job))]
-        if len(jobs_to_check) > 0:
-            with Timer('check-job-cache'):
-                _batch_check_job_cache(jobs_to_check)
+        # (or for all pending jobs in dag hashing mode, starting with the final stages)
+        # the checks run in background threads (in batches), and each job is dispatched as soon as the check of its batch returns
+        with Timer('check-job-cache'):
+            num_completed = self._job_cache_checker.collect_completed_checks()
+            if num_completed > 0:
+                self._prune_unneeded_jobs()
+            jobs_to_check = [job for job in reversed(list(self._jobs.values())) if (job.status == 'pending') and (job.config.job_cache is not None) and (not job._job_cache_checked) and (_job_is_ready_for_cache_check(job))]
+            if len(jobs_to_check) > 0:
+                self._job_cache_checker.start_checks(jobs_to_check)
 
         with Timer('manage-pending-jobs'):
+            active_counts = self._count_active_jobs_by_concurrency_group()
             job_ids = list(self._jobs.keys())
             for job_id in job_ids:
                 job = self._jobs[job_id]
@@ -46,13 +83,25 @@ class JobManager:
                         raise Exception('Unexpected: no function wrapper')
                     if job.cancel_pending:
                         job._set_error(Exception('Job cancelled while pending.'))
-                    elif _job_is_ready_to_run(job):
-                        job._prepare(job.get_resolved_kwargs())
+                    elif _job_is_ready_to_run(job) and ((job.config.job_cache is None) or job._job_cache_checked):
+                        try:
+                            if not job._prepare():
+                                # the image is being prepared in the background (other jobs are not held up)
+                                continue
+                        except Exception as e:
+                            job._set_error(Exception(f'Problem preparing image: {str(e)}'))
+                            continue
+                        g = fw.concurrency_group
+                        if not _concurrency_group_has_room(g, active_counts):
+                            # stays pending until a job of the same group completes (other groups are not held up)
+                            continue
                         jh = job.config.job_handler
                         if jh is not None:
                             # we have a job handler
                             jh.queue_job(job)
                             job._set_queued()
+                            if g is not None:
+                                active_counts[g] = active_counts.get(g, 0) + 1
                         else:
                             kwargs = job.get_resolved_kwargs()
                             image = job.image if job.config.use_container else None
@@ -63,7 +112,8 @@ class JobManager:
                                 function_wrapper=fw,
                                 image=job.get_image(kwargs),
                                 kwargs=kwargs,
-                                show_console=job.config.show_console
+                                show_console=job.config.show_console,
+                                console_lines=job._get_console_lines_buffer()
                             )
                             if console_lines is not None:
                                 job._set_console_lines(console_lines)
@@ -86,6 +136,8 @@ class JobManager:
                         if jh is not None:
                             jh.cancel_job(job.job_id, 'Canceled')
                 if job.status == 'running':
+                    if job.log is not None:
+                        job.log._report_job_console(job)
                     if job.config._job_timeout_sec is not None:
                         ts_started = job.timestamp_started
                         assert ts_started is not None
@@ -109,7 +161,7 @@ class JobManager:
                         if jc is not None:
                             jr = job.result
                             if jr is not None:
-                                _write_result_to_job_cache(job_result=jr, function_name=fw.name, function_version=fw.version, kwargs=job.get_resolved_kwargs(), job_cache=jc)
+                                _write_result_to_job_cache(job=job, job_result=jr, job_cache=jc)
                     deletion_job_ids.append(job_id)
         
         with Timer('manage-error-jobs'):
@@ -142,18 +194,30 @@ class JobManager:
                         job_handlers_to_iterate[jh._get_internal_id()] = jh
             for jh in job_handlers_to_iterate.values():
                 jh.iterate()
+    def _count_active_jobs_by_concurrency_group(self) -> Dict[str, int]:
+        ret: Dict[str, int] = {}
+        for job in self._jobs.values():
+            g = job.function_wrapper.concurrency_group
+            if (g is not None) and (job.status in ['queued', 'running']):
+                ret[g] = ret.get(g, 0) + 1
+        return ret
     def wait(self, timeout_sec: Union[float, None]):
         timer = time.time()
         while True:
             self._iterate()
             if len(self._jobs.keys()) == 0:
+                _flush_job_caches()
                 return
             else:
-                time.sleep(0.05)
+                self._wait_for_activity(0.05)
             if timeout_sec is not None:
                 elaped = time.time() - timer
                 if elaped > timeout_sec:
                     return
+    def _wait_for_activity(self, timeout_sec: float):
+        # sleep, but wake up early when a job cache check or a job handler has reported activity
+        # since the start of the last iteration (which must precede the wait)
+        _wait_for_activity(timeout_sec)
     def _handle_status_report(self, force: bool=False):
         elapsed = time.time() - self._last_status_report_timestamp
         if (not force) and (elapsed <= 2): return
@@ -166,7 +230,9 @@ class JobManager:
         num_pending = job_counts_by_status.get('pending', 0)
         num_queued = job_counts_by_status.get('queued', 0)
         num_running = job_counts_by_status.get('running', 0)
-        status_txt = f'HITHER JOBS: {num_pending} pending; {num_queued} queued; {num_running} running; {self._num_finished} finished; {self._num_errored} errored; {self._num_cache_hits} cache hits'
+        num_checking_cache = job_counts_by_status.get('checking_cache', 0)
+        checking_cache_txt = f' {num_checking_cache} checking cache;' if num_checking_cache > 0 else ''
+        status_txt = f'HITHER JOBS: {num_pending} pending;{checking_cache_txt} {num_queued} queued; {num_running} running; {self._num_finished} finished; {self._num_errored} errored; {self._num_cache_hits} cache hits'
         if self._current_log is not None:
             status_txt = status_txt + '\n' + f'hither-log print --log-id {self._current_log.log_id} --follow'
         if (force) or (status_txt != self._last_status_text):
@@ -174,12 +240,20 @@ class JobManager:
             self._last_status_text = status_txt
 
 
+def _job_is_ready_for_cache_check(job: Job):
+    jc = job.config.job_cache
+    if (jc is not None) and (jc.hash_mode == 'dag'):
+        # the dag hash does not depend on the results of the input jobs
+        return True
+    return _job_is_ready_to_run(job)
+
 def _job_is_ready_to_run(job: Job):
-    return _kwargs_are_all_resolved(job.get_resolved_kwargs())
+    # use the unresolved kwargs so that (lazy) results of finished input jobs are not loaded here
+    return _kwargs_are_all_resolved(job._kwargs)
 
 def _kwargs_are_all_resolved(x: Any):
     if isinstance(x, Job):
-        return False
+        return x.status == 'finished'
     elif isinstance(x, dict):
         for k, v in x.items():
             if not _kwargs_are_all_resolved(v):
@@ -197,7 +271,7 @@ def _kwargs_are_all_resolved(x: Any):
     return True
 
 def _get_job_input_error(job: Job):
-    return _get_kwargs_job_error(job.get_resolved_kwargs())
+    return _get_kwargs_job_error(job._kwargs)
 
 def _get_kwargs_job_error(x: Any):
     if isinstance(x, Job):
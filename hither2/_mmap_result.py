@@ -0,0 +1,77 @@
+from typing import Any, List, Tuple, Union
+
+# arrays smaller than this are left inline in the pickled structure
+mmap_min_array_size_bytes = 1024 * 1024
+
+class _NpyRef:
+    def __init__(self, uri: str):
+        self.uri = uri
+
+def _extract_arrays(x: Any) -> Tuple[Any, bool]:
+    # Replace large numpy arrays by references to .npy files in kachery storage
+    # Returns the new structure and whether any arrays were extracted
+    if _is_mmappable_array(x):
+        import kachery_client as kc
+        return _NpyRef(kc.store_npy(x)), True
+    elif isinstance(x, dict):
+        y = {}
+        found = False
+        for k, v in x.items():
+            y[k], a = _extract_arrays(v)
+            found = found or a
+        return (y, True) if found else (x, False)
+    elif isinstance(x, list):
+        z = [_extract_arrays(a) for a in x]
+        if any([a[1] for a in z]):
+            return [a[0] for a in z], True
+        return x, False
+    elif isinstance(x, tuple):
+        z = [_extract_arrays(a) for a in x]
+        if any([a[1] for a in z]):
+            return tuple([a[0] for a in z]), True
+        return x, False
+    else:
+        return x, False
+
+def _restore_arrays(x: Any, file_sizes: Union[List[int], None]=None) -> Any:
+    # Replace the .npy references by read-only memory maps
+    # If file_sizes is provided, the sizes of the mapped files are appended
+    if isinstance(x, _NpyRef):
+        import kachery_client as kc
+        import numpy as np
+        import os
+        path = kc.load_file(x.uri)
+        if path is None:
+            raise Exception(f'Unable to load cached array: {x.uri}')
+        if file_sizes is not None:
+            file_sizes.append(os.path.getsize(path))
+        return np.load(path, mmap_mode='r')
+    elif isinstance(x, dict):
+        return {k: _restore_arrays(v, file_sizes) for k, v in x.items()}
+    elif isinstance(x, list):
+        return [_restore_arrays(a, file_sizes) for a in x]
+    elif isinstance(x, tuple):
+        return tuple([_restore_arrays(a, file_sizes) for a in x])
+    else:
+        return x
+
+def _is_mmappable_array(x: Any) -> bool:
+    try:
+        import numpy as np
+    except:
+        return False
+    if not isinstance(x, np.ndarray):
+        return False
+    if x.dtype.hasobject:
+        return False
+    return x.nbytes >= mmap_min_array_size_bytes
+
+def _collect_npy_uris(x: Any) -> List[str]:
+    if isinstance(x, _NpyRef):
+        return [x.uri]
+    elif isinstance(x, dict):
+        return [u for v in x.values() for u in _collect_npy_uris(v)]
+    elif isinstance(x, (list, tuple)):
+        return [u for a in x for u in _collect_npy_uris(a)]
+    else:
+        return []
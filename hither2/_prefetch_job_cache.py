@@ -0,0 +1,154 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Set, Tuple, Union
+from ._job import Job, JobResult, _get_input_jobs
+from ._job_cache import JobCache, _compute_job_hash, _compute_job_dag_hash
+from ._check_job_cache import _probe_job_cache
+from ._mmap_result import _collect_npy_uris
+
+def prefetch_job_cache(jobs: List[Job], *, num_threads: int=8) -> dict:
+    """
+    Look up a constructed (not yet executed) pipeline in the job cache and download the
+    files of all cache hits into local kachery storage, so that the run itself proceeds at local disk speed.
+    jobs: the final jobs of the pipeline (input jobs are included automatically)
+    Returns a summary including the number of jobs that will need to be computed.
+    """
+    all_jobs = _get_job_graph(jobs)
+    results: Dict[str, Union[JobResult, None]] = {}
+    num_bytes_prefetched = 0
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        remaining = [job for job in all_jobs]
+        while len(remaining) > 0:
+            # in value hashing mode a job can only be looked up once the results of its inputs are known
+            wave: List[Tuple[Job, JobCache, str]] = []
+            remaining2: List[Job] = []
+            for job in remaining:
+                x = _get_job_hash_if_possible(job, results)
+                if x is None:
+                    remaining2.append(job)
+                elif x == 'miss':
+                    results[job.job_id] = None
+                else:
+                    wave.append((job, x[0], x[1]))
+            if len(wave) == 0:
+                # the rest depend on inputs that are not in the cache
+                for job in remaining2:
+                    results[job.job_id] = None
+                break
+            futures = [executor.submit(_probe_and_prefetch, jc, job_hash) for job, jc, job_hash in wave]
+            for (job, jc, job_hash), future in zip(wave, futures):
+                try:
+                    job_result, num_bytes = future.result()
+                except Exception as e:
+                    print('Warning: problem prefetching from job cache:', e)
+                    job_result, num_bytes = None, 0
+                if (job_result is not None) and (job_result.status != 'finished'):
+                    job_result = None
+                results[job.job_id] = job_result
+                num_bytes_prefetched += num_bytes
+            remaining = remaining2
+
+    # determine which jobs will actually need to run
+    # (in dag hashing mode, inputs of jobs found in the cache are not run unless waited on directly)
+    needed: Set[str] = set()
+    for job in reversed(all_jobs):
+        if job.status == 'finished' or results.get(job.job_id, None) is not None:
+            continue
+        jc = job.config.job_cache
+        dag_mode = (jc is not None) and (jc.hash_mode == 'dag')
+        if (not dag_mode) or job._demanded or (len(job._consumers) == 0) or any([c.job_id in needed for c in job._consumers]):
+            needed.add(job.job_id)
+    num_hits = len([r for r in results.values() if r is not None])
+    num_already_finished = len([job for job in all_jobs if job.status == 'finished'])
+    ret = {
+        'num_jobs': len(all_jobs),
+        'num_already_finished': num_already_finished,
+        'num_cache_hits': num_hits,
+        'num_to_compute': len(needed),
+        'num_skipped': len(all_jobs) - num_already_finished - num_hits - len(needed),
+        'bytes_prefetched': num_bytes_prefetched
+    }
+    print(f'Job cache prefetch: {ret["num_jobs"]} jobs; {num_hits} cache hits; {ret["num_to_compute"]} to compute; {ret["bytes_prefetched"]} bytes prefetched')
+    return ret
+
+def _get_job_graph(jobs: List[Job]) -> List[Job]:
+    # all jobs and their inputs, inputs first
+    ret: List[Job] = []
+    visited: Set[str] = set()
+    def visit(job: Job):
+        if job.job_id in visited:
+            return
+        visited.add(job.job_id)
+        for input_job in _get_input_jobs(job._kwargs):
+            visit(input_job)
+        ret.append(job)
+    for job in jobs:
+        visit(job)
+    return ret
+
+def _get_job_hash_if_possible(job: Job, results: Dict[str, Union[JobResult, None]]) -> Union[None, str, Tuple[JobCache, str]]:
+    # returns (job_cache, job_hash), 'miss' if the job cannot be found in the cache, or None if not yet known
+    if job.status == 'finished':
+        return 'miss'
+    jc = job.config.job_cache
+    if jc is None:
+        return 'miss'
+    if jc.hash_mode == 'dag':
+        return (jc, _compute_job_dag_hash(job))
+    for input_job in _get_input_jobs(job._kwargs):
+        if input_job.status == 'finished':
+            continue
+        if input_job.job_id not in results:
+            return None
+        if results[input_job.job_id] is None:
+            return 'miss'
+    kwargs = _resolve_kwargs_from_results(job._kwargs, results)
+    return (jc, _compute_job_hash(function_name=job.function_name, function_version=job.function_version, kwargs=kwargs))
+
+def _resolve_kwargs_from_results(x: Any, results: Dict[str, Union[JobResult, None]]):
+    if isinstance(x, Job):
+        if x.status == 'finished':
+            return x.result.return_value
+        r = results[x.job_id]
+        assert r is not None
+        return r.return_value
+    elif isinstance(x, dict):
+        return {k: _resolve_kwargs_from_results(v, results) for k, v in x.items()}
+    elif isinstance(x, list):
+        return [_resolve_kwargs_from_results(a, results) for a in x]
+    elif isinstance(x, tuple):
+        return tuple([_resolve_kwargs_from_results(a, results) for a in x])
+    else:
+        return x
+
+def _probe_and_prefetch(job_cache: JobCache, job_hash: str) -> Tuple[Union[JobResult, None], int]:
+    # runs in a worker thread
+    import os
+    import kachery_client as kc
+    job_result = _probe_job_cache(job_cache, job_hash)
+    if job_result is None:
+        return None, 0
+    uris: List[str] = []
+    if job_result._return_value_uri is not None:
+        uris.append(job_result._return_value_uri)
+    if job_result._console_lines_uri is not None:
+        uris.append(job_result._console_lines_uri)
+    num_bytes = 0
+    for uri in uris:
+        path = kc.load_file(uri)
+        if path is None:
+            # the cached files are not available
+            return None, 0
+        num_bytes += os.path.getsize(path)
+    if (job_result._return_value_format == 'npy') and (job_result._return_value_uri is not None):
+        # the arrays are stored in separate files
+        path = kc.load_file(job_result._return_value_uri)
+        assert path is not None
+        with open(path, 'rb') as f:
+            structure = pickle.load(f)
+        for uri in _collect_npy_uris(structure):
+            path = kc.load_file(uri)
+            if path is None:
+                return None, 0
+            num_bytes += os.path.getsize(path)
+    return job_result, num_bytes
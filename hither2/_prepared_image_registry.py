@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+from typing import List, Union
+
+# A persistent record of the images that have been prepared (pulled, built or found), so that other
+# driver processes can skip the preparation. An entry is trusted as long as the local image still has
+# the recorded digest (image ID). After HITHER_PREPARED_IMAGE_TTL_SEC, an entry for a remote image is
+# revalidated against the registry (without pulling), and the image is only pulled again if the tag moved.
+
+_registry_lock = threading.Lock()
+
+def _prepared_images_path():
+    return os.getenv('HITHER_PREPARED_IMAGES_FILE', os.path.expanduser('~/.hither/prepared_images.json'))
+
+def _prepared_image_ttl_sec():
+    return float(os.getenv('HITHER_PREPARED_IMAGE_TTL_SEC', '3600'))
+
+def _prepared_image_key(kind: str, name: str, tag: str):
+    backend = 'singularity' if os.getenv('HITHER_USE_SINGULARITY', None) in ['1', 'TRUE'] else 'docker'
+    return f'{backend}:{kind}:{name}:{tag}'
+
+def _load_registry() -> dict:
+    path = _prepared_images_path()
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            x = json.load(f)
+        return x if isinstance(x, dict) else {}
+    except:
+        print(f'Warning: unable to read prepared image registry: {path}')
+        return {}
+
+def _get_prepared_image_entry(key: str) -> Union[dict, None]:
+    with _registry_lock:
+        return _load_registry().get(key, None)
+
+def _set_prepared_image_entry(key: str, *, name: str, tag: str, digest: Union[str, None], repo_digests: List[str]=[]):
+    path = _prepared_images_path()
+    with _registry_lock:
+        x = _load_registry()
+        x[key] = {
+            'name': name,
+            'tag': tag,
+            'digest': digest,
+            'repo_digests': repo_digests,
+            'timestamp': time.time()
+        }
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # write atomically, since other driver processes may read it at the same time
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(x, f, indent=2)
+            os.rename(tmp_path, path)
+        except Exception as e:
+            print(f'Warning: unable to write prepared image registry: {path}: {str(e)}')
+
+def _entry_is_fresh(entry: dict):
+    return time.time() - entry.get('timestamp', 0) < _prepared_image_ttl_sec()
+
+def _inspect_local_docker_image(name_tag: str) -> Union[dict, None]:
+    # returns the image ID and repo digests, or None if the image (or docker) is not available
+    try:
+        import docker
+        client = docker.from_env()
+        image = client.images.get(name_tag)
+        return {'digest': image.id, 'repo_digests': image.attrs.get('RepoDigests', [])}
+    except:
+        return None
+
+def _remote_docker_image_digest(name_tag: str) -> Union[str, None]:
+    # the digest of the tag in the registry (without pulling the image)
+    try:
+        import docker
+        client = docker.from_env()
+        return client.images.get_registry_data(name_tag).id
+    except:
+        return None
+
+def _docker_image_is_prepared(key: str, name_tag: str, *, remote: bool) -> bool:
+    entry = _get_prepared_image_entry(key)
+    if entry is None:
+        return False
+    local = _inspect_local_docker_image(name_tag)
+    if (local is None) or (local['digest'] != entry.get('digest', None)):
+        return False
+    if _entry_is_fresh(entry):
+        return True
+    if not remote:
+        return False
+    remote_digest = _remote_docker_image_digest(name_tag)
+    if (remote_digest is not None) and any([a.endswith('@' + remote_digest) for a in local['repo_digests']]):
+        # the tag has not moved
+        _set_prepared_image_entry(key, name=entry['name'], tag=entry['tag'], digest=local['digest'], repo_digests=local['repo_digests'])
+        return True
+    return False
+
+def _register_prepared_docker_image(key: str, *, name: str, tag: str):
+    local = _inspect_local_docker_image(f'{name}:{tag}')
+    if local is None:
+        return
+    _set_prepared_image_entry(key, name=name, tag=tag, digest=local['digest'], repo_digests=local['repo_digests'])
+
+def _singularity_image_is_prepared(key: str) -> bool:
+    # singularity keeps its own cache, so the entry is only trusted until it expires
+    entry = _get_prepared_image_entry(key)
+    return (entry is not None) and _entry_is_fresh(entry)
@@ -0,0 +1,33 @@
+from typing import Dict, Union
+
+# Resources are given as a dict of amounts, for example {'cpus': 8, 'memory_gb': 32}.
+# Resources that are not listed for a job are not required by that job, and resources that
+# are not listed in the capacity of a job handler are not constrained by that job handler.
+
+def _check_resources(resources: Union[Dict[str, float], None]) -> Dict[str, float]:
+    if resources is None:
+        return {}
+    if not isinstance(resources, dict):
+        raise Exception(f'Resources must be a dict, for example {{"cpus": 8, "memory_gb": 32}}: {resources}')
+    ret: Dict[str, float] = {}
+    for k, v in resources.items():
+        if not isinstance(k, str):
+            raise Exception(f'Invalid resource name: {k}')
+        if isinstance(v, bool) or (not isinstance(v, (int, float))) or (v < 0):
+            raise Exception(f'Invalid amount for resource {k}: {v}')
+        ret[k] = v
+    return ret
+
+def _resources_fit(required: Dict[str, float], available: Dict[str, float]):
+    for k, v in required.items():
+        if (k in available) and (v > available[k]):
+            return False
+    return True
+
+def _add_resources(a: Dict[str, float], b: Dict[str, float], sign: int=1):
+    for k, v in b.items():
+        if k in a:
+            a[k] = a[k] + sign * v
+
+def _format_resources(resources: Dict[str, float]):
+    return ', '.join([f'{k}={v}' for k, v in resources.items()])
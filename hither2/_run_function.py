@@ -4,7 +4,7 @@ from typing import Any, Callable, List, Tuple, Union
 from ._job_cache import JobCache
 from ._check_job_cache import _check_job_cache
 from .run_function_in_container import run_function_in_container
-from .consolecapture import ConsoleCapture
+from .consolecapture import ConsoleCapture, ConsoleLines
 from .runtimehook import PostContainerContext, PreContainerContext, RuntimeHook, PreRunContext, PostRunContext
 
 
@@ -12,8 +12,11 @@ def _run_function(*,
     function_wrapper: FunctionWrapper,
     image: Union[DockerImage, bool, None],
     kwargs: dict,
-    show_console: bool
-) -> Tuple[Any, Union[None, Exception], Union[None, List[dict]]]:
+    show_console: bool,
+    console_max_lines: Union[int, None]=None,
+    console_overflow: str='spill',
+    console_lines: Union[ConsoleLines, None]=None
+) -> Tuple[Any, Union[None, Exception], Union[None, ConsoleLines, List[dict]]]:
     # fw = function_wrapper
     # if job_cache is not None:
     #     cache_result = _check_job_cache(function_name=fw.name, function_version=fw.version, kwargs=kwargs, job_cache=job_cache)
@@ -29,6 +32,9 @@ def _run_function(*,
             image=image,
             kwargs=kwargs,
             show_console=show_console,
+            console_max_lines=console_max_lines,
+            console_overflow=console_overflow,
+            console_lines=console_lines,
             _environment={},
             _bind_mounts=[],
             _kachery_support=function_wrapper.kachery_support,
@@ -37,7 +43,7 @@ def _run_function(*,
 
         return return_value, exc, console_lines
     else:
-        with ConsoleCapture(show_console=show_console) as cc:
+        with ConsoleCapture(show_console=show_console, max_lines_in_memory=console_max_lines, overflow=console_overflow, lines=console_lines) as cc:
             try:
                 # prerun
                 prerun_context = PreRunContext(kwargs=kwargs)
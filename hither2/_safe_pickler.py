@@ -0,0 +1,277 @@
+from typing import Any, Callable, Dict, List, Union
+import copyreg
+import pickle
+import types
+from ._safe_pickle import RestrictedUnpickler
+
+# The pickler and unpickler used by the safe_pickle serializer. They accept the same values as
+# _check_safe_for_pickling / RestrictedUnpickler in _safe_pickle.py (which is synced from other projects),
+# but the whitelist is enforced while pickling (single pass), and arrays may be pickled with protocol 5.
+
+_global_types = (type, types.FunctionType, types.BuiltinFunctionType)
+
+class _SafePickler(pickle.Pickler):
+    # Pickler that only accepts the same types as _check_safe_for_pickling
+    # As in _check_safe_for_pickling, dict keys are not checked (but what they contain is).
+    # Other objects that are not whitelisted (bytes, dtypes, classes and functions) are only accepted
+    # as part of the reduction of a whitelisted object, such as the data of a numpy array.
+    # min_buffer_size: with protocol 5 and a buffer_callback, the data of arrays of at least this size
+    # is passed as a PickleBuffer (smaller arrays are pickled in-band, as with protocol 4)
+    def __init__(self, file, protocol: Union[int, None]=None, buffer_callback: Union[Callable[[pickle.PickleBuffer], Any], None]=None, min_buffer_size: int=0):
+        self._protocol = protocol if protocol is not None else pickle.DEFAULT_PROTOCOL
+        self._min_buffer_size = min_buffer_size if (self._protocol >= 5) and (buffer_callback is not None) else None
+        # objects that are part of a reduction made here, by id
+        # (they are kept until they are saved, so that the ids are not reused)
+        self._trusted: Dict[int, Any] = {}
+        # the dicts that were pickled (to recognize their keys)
+        self._dicts: List[dict] = []
+        # the safe globals, and the classes of the whitelisted objects, which appear in their reductions
+        self._safe_globals: Dict[int, Any] = dict(_get_safe_globals())
+        # read by the pickler when it is initialized
+        self.dispatch_table = _SafeDispatchTable(self)
+        super().__init__(file, protocol=protocol, buffer_callback=buffer_callback)
+    def persistent_id(self, obj):
+        # called for every object before it is pickled
+        t = type(obj)
+        if t in _accepted_types:
+            if t is dict:
+                self._dicts.append(obj)
+            return None
+        i = id(obj)
+        if (self._trusted.pop(i, None) is None) and (i not in self._safe_globals):
+            self._check_object(t, obj)
+        return None
+    def _check_object(self, t: type, obj: Any):
+        kind = _get_safe_type_kind(t)
+        if (kind != _UNSAFE) and (kind != _GLOBAL):
+            _accepted_types.add(t)
+            return
+        # dict keys are not checked (only their contents are)
+        for d in reversed(self._dicts):
+            if _is_key_of(obj, d):
+                return
+        raise Exception(f'Not safe for pickling: ({t}). Perhaps this type should be whitelisted.')
+    def _reduce_array(self, obj):
+        # (_reconstruct, (ndarray, (0,), b'b'), (1, shape, dtype, is_fortran, data)), as numpy reduces arrays,
+        # but made here, which is much faster (numpy is only used for object arrays, whose items are checked
+        # as usual, and for the PickleBuffer of protocol 5: (_frombuffer, (PickleBuffer, dtype, shape, order)))
+        # A memmap (e.g., the result of a job that was loaded from a file) is pickled as its data.
+        trusted = self._trusted
+        if type(obj) is not _get_numpy_safe_types()[0]:
+            obj = obj.view(_get_numpy_safe_types()[0])
+        dtype = obj.dtype
+        trusted[id(dtype)] = dtype
+        if dtype.hasobject or ((self._min_buffer_size is not None) and (obj.nbytes >= self._min_buffer_size)):
+            rv = obj.__reduce_ex__(self._protocol)
+            if len(rv) > 2:
+                a, data = rv[1][2], rv[2][-1]
+                trusted[id(a)] = a
+            else:
+                data = rv[1][0]
+            if type(data) is not list:
+                trusted[id(data)] = data
+            return rv
+        flags = obj.flags
+        is_fortran = flags.f_contiguous and not flags.c_contiguous
+        data = obj.tobytes('F' if is_fortran else 'C')
+        trusted[id(data)] = data
+        return (_get_numpy_reconstruct(), (_get_numpy_safe_types()[0], (0,), b'b'), (1, obj.shape, dtype, is_fortran, data))
+    def _reduce_numpy_scalar(self, obj):
+        t = type(obj)
+        x = _numpy_number_reductions.get(t, None)
+        if x is None:
+            rv = obj.__reduce_ex__(self._protocol)
+            a = rv[1]
+            self._trusted[id(a[0])] = a[0]
+            self._trusted[id(a[1])] = a[1]
+            if isinstance(obj, str) or (a[1] != obj.tobytes()):
+                return rv
+            x = _numpy_number_reductions[t] = (rv[0], a[0])
+        # the other numbers of this type are reduced by _number_reducer
+        self.dispatch_table[t] = f = self._number_reducer(x[0], x[1])
+        return f(obj)
+    def _number_reducer(self, reconstruct: Any, dtype: Any):
+        # (scalar, (dtype, data)), as numpy reduces numbers (the reconstructor and the dtype are the same
+        # for all the numbers of a type)
+        trusted = self._trusted
+        def reduce(obj):
+            data = obj.tobytes()
+            trusted[id(dtype)] = dtype
+            trusted[id(data)] = data
+            return (reconstruct, (dtype, data))
+        return reduce
+    def _reduce_dtype(self, obj):
+        rv = obj.__reduce_ex__(self._protocol)
+        if (obj.fields is not None) or (obj.subdtype is not None):
+            # structured and subarray dtypes contain other dtypes
+            for b in _iter_reduction_items(rv):
+                if _is_numpy_dtype(b):
+                    self._trusted[id(b)] = b
+        return rv
+    def _reduce_subclass(self, obj):
+        # subclasses of the whitelisted types, and range, complex and slice
+        # The reduction may only refer to the standard reconstructors and to the classes of the object
+        # (a subclass could reduce to anything); everything else (e.g., the items of a subclass of tuple)
+        # is checked as usual.
+        t = type(obj)
+        reduce = copyreg.dispatch_table.get(t, None)
+        if reduce is not None:
+            rv = reduce(obj)
+        else:
+            rv = obj.__reduce_ex__(self._protocol)
+        if not isinstance(rv, tuple):
+            return rv
+        if not self._trust_global(t, rv[0]):
+            raise Exception(f'Not safe for pickling: ({t}). Perhaps this type should be whitelisted.')
+        for b in _iter_reduction_items(rv):
+            if isinstance(b, type):
+                self._trust_global(t, b)
+        return rv
+    def _trust_global(self, t: type, a: Any) -> bool:
+        if id(a) in self._safe_globals:
+            return True
+        if isinstance(a, type) and (a in t.__mro__):
+            self._safe_globals[id(a)] = a
+            return True
+        return False
+
+class _SafeDispatchTable(dict):
+    # the reduction functions of a _SafePickler by type (looked up by the pickler for objects that it
+    # does not handle natively); a missing type is added when it is first looked up
+    def __init__(self, pickler: _SafePickler):
+        super().__init__()
+        self._pickler = pickler
+    def __missing__(self, t: type):
+        kind = _get_safe_type_kind(t)
+        if kind == _NUMPY_ARRAY:
+            f = self._pickler._reduce_array
+        elif (kind == _NUMPY_SCALAR) and (t in _numpy_number_reductions):
+            f = self._pickler._number_reducer(*_numpy_number_reductions[t])
+        elif kind == _NUMPY_SCALAR:
+            f = self._pickler._reduce_numpy_scalar
+        elif kind == _SAFE:
+            f = self._pickler._reduce_subclass
+        elif _is_numpy_dtype_type(t):
+            f = self._pickler._reduce_dtype
+        else:
+            # the default reduction (e.g., of functions, which are accepted by persistent_id)
+            raise KeyError(t)
+        self[t] = f
+        return f
+
+def _is_key_of(obj: Any, d: dict) -> bool:
+    try:
+        if obj not in d:
+            return False
+    except TypeError:
+        # not hashable
+        return False
+    return any(k is obj for k in d)
+
+def _iter_reduction_items(rv: tuple):
+    # the items in the (nested) tuples and dicts of the arguments and state of a reduction
+    stack = [a for a in rv[1:3] if type(a) in (tuple, dict)]
+    while len(stack) > 0:
+        a = stack.pop()
+        for b in (a.values() if type(a) is dict else a):
+            if type(b) in (tuple, dict):
+                stack.append(b)
+            else:
+                yield b
+
+class _SafeUnpickler(RestrictedUnpickler):
+    # also accepts the module names of numpy 2 and the reconstructor of arrays pickled with protocol 5
+    def find_class(self, module, name):
+        if (module == 'numpy._core.multiarray') and (name in ['_reconstruct', 'scalar']):
+            return pickle.Unpickler.find_class(self, module, name)
+        if (module in ['numpy.core.numeric', 'numpy._core.numeric']) and (name == '_frombuffer'):
+            return pickle.Unpickler.find_class(self, module, name)
+        return super().find_class(module, name)
+
+_UNSAFE = 0
+_SAFE = 1
+_NUMPY_ARRAY = 2 # exactly ndarray, or memmap (pickled as an ndarray)
+_NUMPY_SCALAR = 3 # numpy number and string types
+_GLOBAL = 4 # classes and functions (only accepted as part of a reduction)
+_safe_type_kind_cache: Dict[type, int] = {}
+# the types whose instances are accepted (the reductions of those that are not pickled natively are checked)
+_accepted_types = set([int, float, str, bool, type(None), dict, list, tuple, range, complex, slice])
+
+def _get_safe_type_kind(t: type) -> int:
+    ret = _safe_type_kind_cache.get(t, None)
+    if ret is None:
+        np_types = _get_numpy_safe_types()
+        if (len(np_types) > 0) and ((t is np_types[0]) or _is_numpy_memmap_type(t)):
+            ret = _NUMPY_ARRAY
+        elif (len(np_types) > 0) and (t.__module__ == 'numpy') and issubclass(t, np_types[1:] + (str,)):
+            ret = _NUMPY_SCALAR
+        elif issubclass(t, _global_types):
+            ret = _GLOBAL
+        elif issubclass(t, (int, float, str, bool, type(None), range, complex, slice, dict, list, tuple)) or issubclass(t, np_types):
+            ret = _SAFE
+        else:
+            ret = _UNSAFE
+        _safe_type_kind_cache[t] = ret
+    return ret
+
+_numpy_reconstruct: Any = None
+
+def _get_numpy_reconstruct():
+    global _numpy_reconstruct
+    if _numpy_reconstruct is None:
+        import numpy as np
+        _numpy_reconstruct = np.zeros(1).__reduce_ex__(2)[0]
+    return _numpy_reconstruct
+
+def _is_numpy_dtype(x: Any) -> bool:
+    if len(_get_numpy_safe_types()) == 0:
+        return False
+    import numpy as np
+    return isinstance(x, np.dtype)
+
+def _is_numpy_memmap_type(t: type) -> bool:
+    import numpy as np
+    return t is np.memmap
+
+def _is_numpy_dtype_type(t: type) -> bool:
+    if len(_get_numpy_safe_types()) == 0:
+        return False
+    import numpy as np
+    return issubclass(t, np.dtype)
+
+_safe_globals: Union[Dict[int, Any], None] = None
+# numpy number type -> (reconstructor, dtype)
+_numpy_number_reductions: Dict[type, tuple] = {}
+
+def _get_safe_globals() -> Dict[int, Any]:
+    # the functions used to reconstruct subclasses of the whitelisted types, and numpy arrays, dtypes and numbers,
+    # and other constants in their reductions (by id)
+    global _safe_globals
+    if _safe_globals is None:
+        a: List[Any] = [copyreg.__newobj__, copyreg.__newobj_ex__, copyreg._reconstructor]
+        try:
+            import numpy as np
+            a.append(np.ndarray)
+            a.append(np.dtype)
+            a.append(_get_numpy_reconstruct())
+            # (in the reductions of arrays)
+            a.append(b'b')
+            a.append(np.zeros(1).__reduce_ex__(5)[0])
+            a.append(np.float64(0).__reduce_ex__(2)[0])
+        except:
+            pass
+        _safe_globals = {id(f): f for f in a}
+    return _safe_globals
+
+_numpy_safe_types: Union[tuple, None] = None
+
+def _get_numpy_safe_types() -> tuple:
+    # the numpy lookup is only done once
+    global _numpy_safe_types
+    if _numpy_safe_types is None:
+        try:
+            import numpy as np
+            _numpy_safe_types = (np.ndarray, np.integer, np.floating, np.complexfloating)
+        except:
+            _numpy_safe_types = ()
+    return _numpy_safe_types
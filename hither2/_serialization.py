@@ -0,0 +1,279 @@
+from abc import abstractmethod
+import io
+import json
+import mmap
+import os
+import pickle
+from typing import Any, BinaryIO, Dict, List, Tuple, Union
+
+# serialized values start with this marker followed by the name of the serializer
+# (plain pickles never start with 0x93, so files written before the registry existed are still readable)
+_magic = b'\x93HSER'
+
+# array buffers smaller than this are kept in the pickle stream
+oob_min_buffer_size_bytes = 64 * 1024
+_oob_alignment = 64
+# a pickle stream always ends with b'.', so this footer cannot be mistaken for the end of a pickle
+_oob_footer = b'HSEROOB1'
+
+class Serializer:
+    """
+    Converts values to and from bytes. The same serializers are used for every path that
+    return values take: the job handler pipes, the scriptdir files (including those copied
+    out of containers) and the job cache.
+
+    name: unique name, stored along with the serialized data
+    safe: whether untrusted data can be deserialized without the risk of executing arbitrary code.
+        Only safe serializers are used for values that come out of containers.
+    """
+    name: str = ''
+    safe: bool = False
+    def can_serialize(self, x: Any) -> bool:
+        return True
+    @abstractmethod
+    def serialize(self, x: Any) -> bytes:
+        pass
+    @abstractmethod
+    def deserialize(self, data: bytes) -> Any:
+        pass
+    def dump_file(self, x: Any, f: BinaryIO):
+        f.write(self.serialize(x))
+    def load_file(self, path: str, offset: int) -> Any:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return self.deserialize(f.read())
+
+class PickleSerializer(Serializer):
+    name = 'pickle'
+    safe = False
+    def serialize(self, x: Any) -> bytes:
+        return pickle.dumps(x)
+    def deserialize(self, data: bytes) -> Any:
+        return pickle.loads(data)
+    def dump_file(self, x: Any, f: BinaryIO):
+        pickle.dump(x, f)
+    def load_file(self, path: str, offset: int) -> Any:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return pickle.load(f)
+
+class SafePickleSerializer(Serializer):
+    # only the types accepted by _check_safe_for_pickling
+    # When writing to a file, large array buffers are written out-of-band (pickle protocol 5)
+    # after the pickle stream, aligned so that they can be memory-mapped when loading.
+    name = 'safe_pickle'
+    safe = True
+    def serialize(self, x: Any) -> bytes:
+        from ._safe_pickler import _SafePickler
+        f = io.BytesIO()
+        _SafePickler(f).dump(x)
+        return f.getvalue()
+    def deserialize(self, data: bytes) -> Any:
+        from ._safe_pickler import _SafeUnpickler
+        return _SafeUnpickler(io.BytesIO(data)).load()
+    def dump_file(self, x: Any, f: BinaryIO):
+        from ._safe_pickler import _SafePickler
+        buffers: List[pickle.PickleBuffer] = []
+        def buffer_callback(b: pickle.PickleBuffer):
+            if b.raw().nbytes < oob_min_buffer_size_bytes:
+                return True # in-band
+            buffers.append(b)
+            return False
+        stream = io.BytesIO()
+        _SafePickler(stream, protocol=5, buffer_callback=buffer_callback, min_buffer_size=oob_min_buffer_size_bytes).dump(x)
+        f.write(stream.getbuffer())
+        if len(buffers) == 0:
+            return
+        table: List[Tuple[int, int]] = []
+        for b in buffers:
+            m = b.raw()
+            f.write(bytes(-f.tell() % _oob_alignment))
+            table.append((f.tell(), m.nbytes))
+            f.write(m)
+        table_data = json.dumps(table).encode('utf-8')
+        f.write(table_data)
+        f.write(len(table_data).to_bytes(8, 'little'))
+        f.write(_oob_footer)
+    def load_file(self, path: str, offset: int) -> Any:
+        from ._safe_pickler import _SafeUnpickler
+        with open(path, 'rb') as f:
+            buffers: Union[List[memoryview], None] = None
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size - offset >= 16 + len(_oob_footer):
+                f.seek(size - 8 - len(_oob_footer))
+                tail = f.read()
+                if tail.endswith(_oob_footer):
+                    table_size = int.from_bytes(tail[:8], 'little')
+                    f.seek(size - 8 - len(_oob_footer) - table_size)
+                    table = json.loads(f.read(table_size))
+                    # copy-on-write mapping, so the arrays are writable as before but are not copied unless modified
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+                    buffers = [memoryview(mm)[o:o + n] for o, n in table]
+            f.seek(offset)
+            return _SafeUnpickler(f, buffers=buffers).load()
+
+class JsonSerializer(Serializer):
+    # plain data only (so that the value is reconstructed exactly)
+    name = 'json'
+    safe = True
+    def can_serialize(self, x: Any) -> bool:
+        return _is_plain_json(x)
+    def serialize(self, x: Any) -> bytes:
+        return json.dumps(x).encode('utf-8')
+    def deserialize(self, data: bytes) -> Any:
+        return json.loads(data)
+
+class NpySerializer(Serializer):
+    # a single numpy array; when read from a file, the array is memory-mapped
+    # The npy data is preceded by zero padding so that it starts at a multiple of _oob_alignment in the file
+    # (numpy pads the npy header so that the array data is then aligned as well).
+    name = 'npy'
+    safe = True
+    def can_serialize(self, x: Any) -> bool:
+        try:
+            import numpy as np
+        except:
+            return False
+        return isinstance(x, np.ndarray) and (not x.dtype.hasobject)
+    def serialize(self, x: Any) -> bytes:
+        # padded as if preceded by the serializer header (see _serialize)
+        h = _magic_header(self.name)
+        f = io.BytesIO()
+        f.write(h)
+        self.dump_file(x, f)
+        return f.getvalue()[len(h):]
+    def deserialize(self, data: bytes) -> Any:
+        import numpy as np
+        # skip the padding without copying the data
+        head = data[:_oob_alignment]
+        f = io.BytesIO(data)
+        f.seek(len(head) - len(head.lstrip(b'\x00')))
+        return np.load(f, allow_pickle=False)
+    def dump_file(self, x: Any, f: BinaryIO):
+        import numpy as np
+        f.write(bytes(-f.tell() % _oob_alignment))
+        np.save(f, x, allow_pickle=False)
+    def load_file(self, path: str, offset: int) -> Any:
+        import numpy as np
+        with open(path, 'rb') as f:
+            # skip the padding (the npy magic string does not start with a zero byte)
+            f.seek(offset)
+            padding = f.read(_oob_alignment)
+            offset += len(padding) - len(padding.lstrip(b'\x00'))
+            f.seek(offset)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            else:
+                f.seek(offset)
+                return self.deserialize(f.read())
+            data_offset = f.tell()
+        if dtype.hasobject:
+            raise Exception('Unexpected object array in npy data')
+        order = 'F' if fortran_order else 'C'
+        if 0 in shape:
+            # empty arrays cannot be memory-mapped
+            return np.zeros(shape, dtype=dtype, order=order)
+        return np.memmap(path, dtype=dtype, mode='r', offset=data_offset, shape=shape, order=order)
+
+_serializers: Dict[str, Serializer] = {}
+# (type, serializer name), most recently registered first
+_type_serializers: List[Tuple[type, str]] = []
+
+def register_serializer(serializer: Serializer, *, types: List[type]=[]):
+    """
+    Register a serializer so that it can be selected by name via hi.function(..., serializer=<name>).
+    If types are given, the serializer is also used by default for values of those types.
+    The serializer must also be registered in containers (e.g., when the module defining the function is imported).
+    """
+    if not serializer.name:
+        raise Exception('Serializer must have a name')
+    if len(serializer.name.encode('utf-8')) > 255:
+        raise Exception(f'Serializer name is too long: {serializer.name}')
+    _serializers[serializer.name] = serializer
+    for t in types:
+        _type_serializers.insert(0, (t, serializer.name))
+
+def _get_serializer(name: str) -> Serializer:
+    s = _serializers.get(name, None)
+    if s is None:
+        raise Exception(f'Serializer not registered: {name}')
+    return s
+
+def _select_serializer(x: Any, *, serializer: Union[str, None]=None, safe: bool=False) -> Serializer:
+    s: Union[Serializer, None] = None
+    if serializer is not None:
+        s = _get_serializer(serializer)
+        if not s.can_serialize(x):
+            s = None
+    if s is None:
+        for t, name in _type_serializers:
+            if isinstance(x, t):
+                s2 = _serializers[name]
+                if s2.can_serialize(x):
+                    s = s2
+                    break
+    if (s is None) and _serializers['npy'].can_serialize(x):
+        s = _serializers['npy']
+    if (s is None) or (safe and (not s.safe)):
+        s = _serializers['safe_pickle'] if safe else _serializers['pickle']
+    return s
+
+def _serialize(x: Any, *, serializer: Union[str, None]=None, safe: bool=False) -> bytes:
+    s = _select_serializer(x, serializer=serializer, safe=safe)
+    return _magic_header(s.name) + s.serialize(x)
+
+def _deserialize(data: bytes, *, safe: bool=False) -> Any:
+    s, offset = _parse_header(data[:len(_magic) + 256], safe=safe)
+    return s.deserialize(data[offset:])
+
+def _serialize_to_file(fname: str, x: Any, *, serializer: Union[str, None]=None, safe: bool=False):
+    s = _select_serializer(x, serializer=serializer, safe=safe)
+    try:
+        with open(fname, 'wb') as f:
+            f.write(_magic_header(s.name))
+            s.dump_file(x, f)
+    except:
+        if os.path.exists(fname):
+            os.unlink(fname)
+        raise
+
+def _deserialize_from_file(fname: str, *, safe: bool=False) -> Any:
+    with open(fname, 'rb') as f:
+        head = f.read(len(_magic) + 256)
+    s, offset = _parse_header(head, safe=safe)
+    return s.load_file(fname, offset)
+
+def _magic_header(name: str) -> bytes:
+    a = name.encode('utf-8')
+    return _magic + bytes([len(a)]) + a
+
+def _parse_header(head: bytes, *, safe: bool) -> Tuple[Serializer, int]:
+    if not head.startswith(_magic):
+        # written before the serializer registry existed
+        return _serializers['safe_pickle' if safe else 'pickle'], 0
+    n = head[len(_magic)]
+    name = head[len(_magic) + 1:len(_magic) + 1 + n].decode('utf-8')
+    s = _get_serializer(name)
+    if safe and (not s.safe):
+        raise Exception(f'Refusing to deserialize untrusted data with unsafe serializer: {name}')
+    return s, len(_magic) + 1 + n
+
+def _is_plain_json(x: Any) -> bool:
+    t = type(x)
+    if (t is str) or (t is int) or (t is float) or (t is bool) or (x is None):
+        return True
+    elif t is list:
+        return all([_is_plain_json(a) for a in x])
+    elif t is dict:
+        return all([(type(k) is str) and _is_plain_json(v) for k, v in x.items()])
+    else:
+        return False
+
+register_serializer(PickleSerializer())
+register_serializer(SafePickleSerializer())
+register_serializer(JsonSerializer())
+register_serializer(NpySerializer())
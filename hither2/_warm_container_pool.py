@@ -0,0 +1,321 @@
+import atexit
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Dict, List, Tuple, Union, cast
+from ._bindmount import BindMount
+from .consolecapture import ConsoleLines, _ConsoleStreamReader, _console_stream_fname
+
+# When HITHER_WARM_CONTAINERS=1, containerized jobs are run in long-lived containers (one for each
+# image, set of bind mounts and nvidia support) rather than in a new container for each job.
+# Each warm container runs a worker loop that has already imported hither2, kachery_client and numpy,
+# and that forks a process for each job placed in the pool directory (bind-mounted at /hither-pool).
+# The outputs and the console stream of the job are written back through that same directory.
+
+def _warm_containers_enabled():
+    return os.getenv('HITHER_WARM_CONTAINERS', None) in ['TRUE', '1']
+
+def _warm_container_idle_sec():
+    # a warm container is stopped after it has not been used for this long
+    return float(os.getenv('HITHER_WARM_CONTAINER_IDLE_SEC', '120'))
+
+# The host process of a job touches the job's running.txt while it waits for the job. When it stops doing so
+# (for example, the job handler terminated it because the job timed out or was cancelled), the worker kills
+# the job and exits, so that the container is not reused.
+_heartbeat_interval_sec = 1
+_lost_host_sec = 10
+
+_worker_script = '''
+import os
+import sys
+import time
+import runpy
+import signal
+import traceback
+
+pool_dir = os.getenv('HITHER_POOL_DIR', '/hither-pool')
+jobs_dir = f'{pool_dir}/jobs'
+sys.path.append(f'{pool_dir}/modules')
+sys.dont_write_bytecode = True
+
+# these are imported once, and are then already loaded in the process forked for each job
+import hither2
+import kachery_client
+try:
+    import numpy
+except:
+    pass
+
+# in case the host process went away without stopping this container
+idle_timeout_sec = float(sys.argv[1])
+# a job whose running.txt was not touched by its host process for this long is killed
+lost_host_sec = float(sys.argv[2])
+
+def run_job(job_dir):
+    os.chdir(job_dir)
+    with open(f'{job_dir}/env', 'r') as f:
+        for line in f.read().split('\\n'):
+            if line.startswith('export '):
+                k, v = line[len('export '):].split('=', 1)
+                os.environ[k] = v.strip('"')
+    os.environ['HITHER_RUNNING_FILE'] = f'{job_dir}/running.txt'
+    sys.argv = [f'{job_dir}/run']
+    runpy.run_path(f'{job_dir}/run', run_name='__main__')
+
+def host_is_gone(job_dir):
+    try:
+        return time.time() - os.path.getmtime(f'{job_dir}/running.txt') > lost_host_sec
+    except OSError:
+        return True
+
+def kill_job(pid):
+    # the job runs in its own process group, which includes the processes it started
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+    os.waitpid(pid, 0)
+
+def main():
+    children = {}
+    started = set()
+    last_active = time.time()
+    while os.path.exists(f'{pool_dir}/running.txt'):
+        names = [name for name in os.listdir(jobs_dir) if not name.endswith('.tmp')]
+        started = started.intersection(names)
+        for name in sorted(names):
+            if name in started:
+                continue
+            started.add(name)
+            job_dir = f'{jobs_dir}/{name}'
+            pid = os.fork()
+            if pid == 0:
+                os.setpgid(0, 0)
+                code = 0
+                try:
+                    run_job(job_dir)
+                except BaseException:
+                    traceback.print_exc()
+                    code = 1
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+            children[pid] = job_dir
+        for pid in list(children.keys()):
+            pid2, _ = os.waitpid(pid, os.WNOHANG)
+            if pid2 != 0:
+                job_dir = children[pid]
+                del children[pid]
+                try:
+                    with open(f'{job_dir}/status.tmp', 'w') as f:
+                        f.write('complete')
+                    os.rename(f'{job_dir}/status.tmp', f'{job_dir}/status')
+                except OSError:
+                    # the job was abandoned by the host
+                    pass
+        if any([host_is_gone(job_dir) for job_dir in children.values()]):
+            # the host process went away, or a job timed out or was cancelled (see host_is_gone)
+            break
+        if len(children) > 0:
+            last_active = time.time()
+        elif time.time() - last_active > idle_timeout_sec:
+            break
+        time.sleep(0.01)
+    for pid in children.keys():
+        kill_job(pid)
+
+if __name__ == '__main__':
+    main()
+'''
+
+class _WarmContainer:
+    def __init__(self, *, image_name: str, bind_mounts: List[BindMount], nvidia_support: bool):
+        import kachery_client as kc
+        from .create_scriptdir_for_function_run import _copy_py_module_dir
+        with kc.TemporaryDirectory(remove=False) as tmpdir:
+            self._pool_dir = tmpdir
+        self._image_name = image_name
+        self._timestamp_last_used = time.time()
+        self._timestamp_last_alive_check = time.time()
+        self._num_running_jobs = 0
+        self._container = None
+        self._script = None
+        os.mkdir(f'{self._pool_dir}/jobs')
+        os.mkdir(f'{self._pool_dir}/modules')
+        for module in ['hither2', 'kachery_client']:
+            module_path = os.path.dirname(__import__(module).__file__)
+            _copy_py_module_dir(module_path, f'{self._pool_dir}/modules/{module}')
+        with open(f'{self._pool_dir}/worker.py', 'w') as f:
+            f.write(_worker_script)
+        with open(f'{self._pool_dir}/running.txt', 'w') as f:
+            f.write('Warm container will stop if this file is deleted.')
+        kc.ShellScript(f'''
+        #!/bin/bash
+
+        set -e
+
+        export PYTHONUNBUFFERED=1
+        export PYTHONDONTWRITEBYTECODE=1
+
+        exec python3 /hither-pool/worker.py {_warm_container_idle_sec() + 60} {_lost_host_sec}
+        ''').write(f'{self._pool_dir}/entry.sh')
+
+        all_bind_mounts = [BindMount(source=self._pool_dir, target='/hither-pool', read_only=False)] + bind_mounts
+        use_singularity = os.getenv('HITHER_USE_SINGULARITY', None)
+        if use_singularity in [None, 'FALSE', '0']:
+            import docker
+            from docker.types import Mount
+            from docker.models.containers import Container
+            client = docker.from_env()
+            mounts = [
+                Mount(target=x.target, source=x.source, type='bind', read_only=x.read_only)
+                for x in all_bind_mounts
+            ]
+            self._container = cast(Container, client.containers.run(
+                image_name,
+                ['/hither-pool/entry.sh'],
+                mounts=mounts,
+                network_mode='host',
+                detach=True,
+                auto_remove=True
+            ))
+        elif use_singularity in ['TRUE', '1']:
+            bind_opts = ' '.join([
+                f'--bind {bm.source}:{bm.target}'
+                for bm in all_bind_mounts
+            ])
+            nv_opts = '--nv' if nvidia_support else ''
+            self._script = kc.ShellScript(f'''
+            #!/bin/bash
+
+            exec singularity exec {bind_opts} {nv_opts} docker://{image_name} /hither-pool/entry.sh
+            ''')
+            self._script.start()
+        else:
+            raise Exception('Unexpected value of HITHER_USE_SINGULARITY environment variable')
+    @property
+    def timestamp_last_used(self):
+        return self._timestamp_last_used
+    @property
+    def num_running_jobs(self):
+        return self._num_running_jobs
+    def is_alive(self):
+        if self._container is not None:
+            try:
+                self._container.reload()
+            except:
+                # removed (auto_remove) after exiting
+                return False
+            return self._container.status in ['created', 'running']
+        elif self._script is not None:
+            return self._script.wait(timeout=0) is None
+        return False
+    def run_job(self, *, scriptdir: str, output_dir: str, console_lines: Union[ConsoleLines, None], show_console: bool):
+        # scriptdir: created by create_scriptdir_for_function_run without an image
+        # (the number of running jobs was incremented in _get_warm_container)
+        try:
+            job_dir = f'{self._pool_dir}/jobs/j-{str(uuid.uuid4())[-12:]}'
+            shutil.copytree(scriptdir, job_dir + '.tmp')
+            with open(job_dir + '.tmp/running.txt', 'w') as f:
+                f.write('Job will stop if this file is deleted.')
+            # the worker only picks up the job once it has been renamed
+            os.rename(job_dir + '.tmp', job_dir)
+            stream_reader = _ConsoleStreamReader(f'{job_dir}/output/{_console_stream_fname}')
+            timestamp_last_heartbeat = time.time()
+            while True:
+                complete = os.path.exists(f'{job_dir}/status')
+                rows = stream_reader.read_new()
+                if console_lines is not None:
+                    console_lines._extend_rows(rows)
+                if show_console and (self._container is not None):
+                    # (with singularity, the console output of the worker goes directly to the console)
+                    for row in rows:
+                        print(row[2])
+                if complete:
+                    break
+                if time.time() - timestamp_last_heartbeat > _heartbeat_interval_sec:
+                    timestamp_last_heartbeat = time.time()
+                    os.utime(f'{job_dir}/running.txt')
+                if time.time() - self._timestamp_last_alive_check > 2:
+                    self._timestamp_last_alive_check = time.time()
+                    if not self.is_alive():
+                        raise Exception(f'Warm container for {self._image_name} exited unexpectedly')
+                time.sleep(0.01)
+            for fname in os.listdir(f'{job_dir}/output'):
+                if fname != _console_stream_fname:
+                    shutil.move(f'{job_dir}/output/{fname}', f'{output_dir}/{fname}')
+            shutil.rmtree(job_dir, ignore_errors=True)
+        except BaseException:
+            # for example, interrupted: the job is killed (the worker exits), and the container is not reused
+            _recycle_warm_container(self)
+            raise
+        finally:
+            with _warm_containers_lock:
+                self._num_running_jobs -= 1
+                self._timestamp_last_used = time.time()
+    def stop(self):
+        running_path = f'{self._pool_dir}/running.txt'
+        if os.path.exists(running_path):
+            os.unlink(running_path)
+        if self._container is not None:
+            try:
+                self._container.stop(timeout=5)
+            except:
+                pass
+        elif self._script is not None:
+            if self._script.wait(timeout=5) is None:
+                self._script.stop()
+        shutil.rmtree(self._pool_dir, ignore_errors=True)
+
+_warm_containers_lock = threading.Lock()
+_warm_containers: Dict[Tuple, _WarmContainer] = {}
+
+def _get_warm_container(*, image_name: str, bind_mounts: List[BindMount], nvidia_support: bool) -> _WarmContainer:
+    key = (image_name, tuple(sorted([(bm.source, bm.target, bm.read_only) for bm in bind_mounts])), nvidia_support)
+    with _warm_containers_lock:
+        _stop_idle_warm_containers()
+        c = _warm_containers.get(key, None)
+        if (c is not None) and (not c.is_alive()):
+            c.stop()
+            c = None
+        if c is None:
+            c = _WarmContainer(image_name=image_name, bind_mounts=bind_mounts, nvidia_support=nvidia_support)
+            _warm_containers[key] = c
+        # so that it is not stopped as idle before the job is placed
+        c._num_running_jobs += 1
+        return c
+
+def _recycle_warm_container(c: _WarmContainer):
+    with _warm_containers_lock:
+        for key in list(_warm_containers.keys()):
+            if _warm_containers[key] is c:
+                del _warm_containers[key]
+    c.stop()
+
+def _stop_idle_warm_containers():
+    t = time.time()
+    for key in list(_warm_containers.keys()):
+        c = _warm_containers[key]
+        if (c.num_running_jobs == 0) and (t - c.timestamp_last_used > _warm_container_idle_sec()):
+            del _warm_containers[key]
+            c.stop()
+
+def _run_scriptdir_in_warm_container(*, scriptdir: str, console_lines: Union[ConsoleLines, None], show_console: bool):
+    # scriptdir: created by create_scriptdir_for_function_run with an image
+    with open(f'{scriptdir}/bind_mounts.json', 'r') as f:
+        bind_mounts = [BindMount.deserialize(a) for a in json.load(f)]
+    with open(f'{scriptdir}/container.json', 'r') as f:
+        container_info = json.load(f)
+    c = _get_warm_container(image_name=container_info['image_name'], bind_mounts=bind_mounts, nvidia_support=container_info['nvidia_support'])
+    c.run_job(scriptdir=f'{scriptdir}/incontainer_scriptdir', output_dir=f'{scriptdir}/output', console_lines=console_lines, show_console=show_console)
+
+def stop_all_warm_containers():
+    with _warm_containers_lock:
+        for c in _warm_containers.values():
+            c.stop()
+        _warm_containers.clear()
+
+atexit.register(stop_all_warm_containers)
@@ -1,45 +1,384 @@
-from typing import Any, Dict, List, Union
+from typing import Callable, Iterator, List, Tuple, Union
+from array import array
+import contextvars
+import json
+import os
 import sys
+import tempfile
+import threading
 import time
-import io
+import weakref
+
+_pending_batch_size = 1024
+
+class ConsoleLines():
+    """
+    Console lines captured from a job, stored compactly (timestamp, text and stderr flag columns).
+    Behaves like a list of dicts with keys timestamp, text and stderr; the dicts are only created when accessed.
+
+    max_lines_in_memory: if set, limits the number of lines kept in memory. What happens to older lines depends on overflow:
+        'spill': they are moved to a temporary file (nothing is lost)
+        'truncate': they are dropped, so that only the most recent max_lines_in_memory lines are kept
+    """
+    def __init__(self, *, max_lines_in_memory: Union[int, None]=None, overflow: str='spill'):
+        if overflow not in ['spill', 'truncate']:
+            raise Exception(f'Invalid console overflow option: {overflow}')
+        if (max_lines_in_memory is not None) and (max_lines_in_memory < 1):
+            raise Exception(f'Invalid max_lines_in_memory: {max_lines_in_memory}')
+        self._max_lines_in_memory = max_lines_in_memory
+        self._overflow = overflow
+        self._timestamps = array('d')
+        self._texts: List[str] = []
+        self._stderr = bytearray()
+        self._num_dropped = 0
+        self._spill_path: Union[str, None] = None
+        self._num_spilled = 0
+        # byte offset of each line in the spill file
+        self._spill_line_offsets = array('q')
+        # new lines are first appended here as tuples (a single append, so no lock is needed when writing)
+        # and moved to the columns in batches
+        self._pending: List[Tuple[float, int, str]] = []
+        self._lock = threading.Lock()
+    def append(self, timestamp: float, text: str, stderr: bool=False):
+        self._pending.append((timestamp, 1 if stderr else 0, text))
+        if len(self._pending) >= _pending_batch_size:
+            with self._lock:
+                self._flush_pending()
+    def _extend_rows(self, rows: List[Tuple[float, int, str]]):
+        # rows of (timestamp, stderr flag, text), for example received from a worker
+        self._pending.extend(rows)
+        if len(self._pending) >= _pending_batch_size:
+            with self._lock:
+                self._flush_pending()
+    def _read(self, position: int, max_lines: int=10000) -> Tuple[List[Tuple[float, int, str]], int]:
+        # Rows (timestamp, stderr flag, text) starting at position (the number of lines appended before them),
+        # and the position following them. Lines that have been dropped are skipped.
+        with self._lock:
+            self._flush_pending()
+            position = max(position, self._num_dropped + self._num_hidden())
+            rows = self._read_rows(position, max_lines)
+            return rows, position + len(rows)
+    def _read_rows(self, position: int, max_lines: int) -> List[Tuple[float, int, str]]:
+        # the lock must be held
+        rows: List[Tuple[float, int, str]] = []
+        if position < self._num_spilled:
+            rows = self._read_spilled(position, max_lines)
+            position += len(rows)
+        i1 = position - self._num_dropped - self._num_spilled
+        i2 = min(len(self._texts), i1 + max_lines - len(rows))
+        if i2 > i1:
+            rows.extend(zip(self._timestamps[i1:i2], self._stderr[i1:i2], self._texts[i1:i2]))
+        return rows
+    def _read_spilled(self, position: int, max_lines: int) -> List[Tuple[float, int, str]]:
+        assert self._spill_path is not None
+        n = min(max_lines, self._num_spilled - position)
+        rows: List[Tuple[float, int, str]] = []
+        with open(self._spill_path, 'rb') as f:
+            f.seek(self._spill_line_offsets[position])
+            for _ in range(n):
+                a = json.loads(f.readline())
+                rows.append((a[0], a[1], a[2]))
+        return rows
+    @property
+    def num_dropped(self) -> int:
+        with self._lock:
+            self._flush_pending()
+            return self._num_dropped + self._num_hidden()
+    def to_list(self) -> List[dict]:
+        return [a for a in self]
+    def __len__(self) -> int:
+        with self._lock:
+            self._flush_pending()
+            return self._num_spilled + len(self._texts) - self._num_hidden()
+    def __iter__(self) -> Iterator[dict]:
+        # the spilled lines are read in chunks, and lines appended while iterating are not included
+        with self._lock:
+            self._flush_pending()
+            position = self._num_dropped + self._num_hidden()
+            end = self._num_dropped + self._num_spilled + len(self._texts)
+        while position < end:
+            rows, position = self._read(position, max_lines=min(10000, end - position))
+            if len(rows) == 0:
+                return
+            for t, s, txt in rows:
+                yield dict(timestamp=t, text=txt, stderr=s == 1)
+    def __getitem__(self, i):
+        with self._lock:
+            self._flush_pending()
+            offset = self._num_dropped + self._num_hidden()
+            n = self._num_spilled + len(self._texts) - self._num_hidden()
+            if isinstance(i, slice):
+                indices = range(*i.indices(n))
+                if len(indices) == 0:
+                    return []
+                i1 = min(indices[0], indices[-1])
+                rows = self._read_rows(offset + i1, abs(indices[-1] - indices[0]) + 1)
+                return [dict(timestamp=rows[j - i1][0], text=rows[j - i1][2], stderr=rows[j - i1][1] == 1) for j in indices]
+            if i < 0:
+                i += n
+            if (i < 0) or (i >= n):
+                raise IndexError('console line index out of range')
+            t, s, txt = self._read_rows(offset + i, 1)[0]
+            return dict(timestamp=t, text=txt, stderr=s == 1)
+    def _write_json(self, f):
+        # writes the lines to the text file f as a JSON list of dicts, without loading all the spilled lines at once
+        f.write('[')
+        for i, a in enumerate(self):
+            if i > 0:
+                f.write(', ')
+            f.write(json.dumps(a))
+        f.write(']')
+    def __reduce__(self):
+        return (_console_lines_from_serializable, (self._to_serializable(),))
+    def _to_serializable(self) -> dict:
+        timestamps, texts, stderr = self._get_columns()
+        return dict(timestamps=list(timestamps), texts=texts, stderr=bytes(stderr))
+    def _get_columns(self):
+        with self._lock:
+            self._flush_pending()
+            timestamps = array('d')
+            texts: List[str] = []
+            stderr = bytearray()
+            if self._spill_path is not None:
+                with open(self._spill_path, 'r') as f:
+                    for line in f:
+                        a = json.loads(line)
+                        timestamps.append(a[0])
+                        stderr.append(a[1])
+                        texts.append(a[2])
+            i1 = self._num_hidden()
+            timestamps.extend(self._timestamps[i1:])
+            texts.extend(self._texts[i1:])
+            stderr.extend(self._stderr[i1:])
+            return timestamps, texts, stderr
+    def _num_hidden(self) -> int:
+        # in truncate mode, up to 25% more lines than the limit are kept in memory
+        if (self._max_lines_in_memory is None) or (self._overflow != 'truncate'):
+            return 0
+        return max(0, len(self._texts) - self._max_lines_in_memory)
+    def _flush_pending(self):
+        # other threads may append while this runs, so only remove what was copied
+        n = len(self._pending)
+        if n == 0:
+            return
+        batch = self._pending[:n]
+        del self._pending[:n]
+        timestamps, stderr, texts = zip(*batch)
+        self._timestamps.extend(timestamps)
+        self._stderr.extend(stderr)
+        self._texts.extend(texts)
+        if self._max_lines_in_memory is not None:
+            self._handle_overflow()
+    def _handle_overflow(self):
+        assert self._max_lines_in_memory is not None
+        n = len(self._texts)
+        if self._overflow == 'spill':
+            if n > self._max_lines_in_memory:
+                self._spill()
+        elif n > self._max_lines_in_memory + max(1, self._max_lines_in_memory // 4):
+            # drop in chunks rather than one line at a time
+            self._drop(n - self._max_lines_in_memory)
+    def _drop(self, n: int):
+        del self._timestamps[:n]
+        del self._texts[:n]
+        del self._stderr[:n]
+        self._num_dropped += n
+    def _spill(self):
+        if self._spill_path is None:
+            fd, self._spill_path = tempfile.mkstemp(prefix='hither_console_', suffix='.jsonl')
+            os.close(fd)
+            weakref.finalize(self, _remove_file, self._spill_path)
+        with open(self._spill_path, 'ab') as f:
+            offset = f.tell()
+            lines = [(json.dumps([t, s, txt]) + '\n').encode('utf-8') for t, s, txt in zip(self._timestamps, self._stderr, self._texts)]
+            for line in lines:
+                self._spill_line_offsets.append(offset)
+                offset += len(line)
+            f.write(b''.join(lines))
+        self._num_spilled += len(self._texts)
+        del self._timestamps[:]
+        del self._texts[:]
+        del self._stderr[:]
+
+def _remove_file(path: str):
+    try:
+        os.unlink(path)
+    except:
+        pass
+
+# Console lines are streamed from running jobs as JSON lines [timestamp, stderr flag, text],
+# appended to this file in the output directory of the scriptdir
+_console_stream_fname = 'console_stream.jsonl'
+# or, in docker containers, written to stdout with this prefix (and appended to the file by the runner)
+_console_stream_marker = 'HITHER-CONSOLE-STREAM: '
+console_stream_interval_sec = 1.0
+
+class _ConsoleStreamWriter():
+    # Periodically sends the new lines from a background thread, and the remaining lines on exit.
+    # By default they are appended to the file at path (or written to stdout if path is None).
+    def __init__(self, lines: ConsoleLines, path: Union[str, None]=None, send: Union[Callable[[List[Tuple[float, int, str]]], None], None]=None):
+        self._lines = lines
+        self._path = path
+        self._send = send
+        self._position = 0
+        self._stop_event = threading.Event()
+        self._thread: Union[threading.Thread, None] = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._write()
+
+    def _run(self):
+        while not self._stop_event.wait(console_stream_interval_sec):
+            self._write()
+
+    def _write(self):
+        while True:
+            rows, self._position = self._lines._read(self._position)
+            if len(rows) == 0:
+                return
+            if self._send is not None:
+                self._send(rows)
+            elif self._path is not None:
+                with open(self._path, 'a') as f:
+                    f.write(''.join([json.dumps(r) + '\n' for r in rows]))
+            else:
+                sys.__stdout__.write(''.join([_console_stream_marker + json.dumps(r) + '\n' for r in rows]))
+                sys.__stdout__.flush()
+
+class _ConsoleStreamReader():
+    # Reads the rows appended to a console stream file since the last call
+    def __init__(self, path: str):
+        self._path = path
+        self._offset = 0
+        self._partial = b''
+
+    def read_new(self) -> List[Tuple[float, int, str]]:
+        if not os.path.isfile(self._path):
+            return []
+        with open(self._path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        self._offset += len(data)
+        # the last line may not be complete yet
+        a = (self._partial + data).split(b'\n')
+        self._partial = a.pop()
+        rows: List[Tuple[float, int, str]] = []
+        for line in a:
+            if line:
+                x = json.loads(line)
+                rows.append((x[0], x[1], x[2]))
+        return rows
+
+def _console_lines_from_serializable(x: dict) -> ConsoleLines:
+    ret = ConsoleLines()
+    ret._timestamps = array('d', x['timestamps'])
+    ret._texts = x['texts']
+    ret._stderr = bytearray(x['stderr'])
+    return ret
 
 class CustomStdout():
-    def __init__(self, label: str, lines: List[dict], original_stdout, stderr: bool=False, show_console: bool=True):
+    def __init__(self, label: str, lines: ConsoleLines, original_stdout, stderr: bool=False, show_console: bool=True):
         self._label = label
         self._lines = lines
         self._original_stdout = original_stdout
-        self._stderr = False
+        self._stderr = stderr
         self._show_console = show_console
 
     def write(self, data: str) -> None:
         lines = data.splitlines(keepends=False)
+        if len(lines) == 1:
+            # the usual case (print() writes the text and the newline separately)
+            if not lines[0].strip():
+                return
+        else:
+            lines = [line for line in lines if line.strip()]
+            if len(lines) == 0:
+                return
+        # one timestamp per write
+        timestamp = time.time()
         for line in lines:
-            if line.strip():
-                a: Dict[str, Union[float, str, bool]] = dict(
-                    timestamp=time.time() - 0,
-                    text=line,
-                    stderr=self._stderr
-                )
-                self._lines.append(a)
-                if self._show_console:
-                    print('{} {}: {}'.format(self._label, _fmt_time(a['timestamp']), a['text']), file=self._original_stdout)
-        
+            self._lines.append(timestamp, line, self._stderr)
+        if self._show_console:
+            for line in lines:
+                print('{} {}: {}'.format(self._label, _fmt_time(timestamp), line), file=self._original_stdout)
+
     def flush(self) -> None:
         pass
 
+# the formatted time up to the second is cached, since consecutive lines are usually printed within the same second
+# (second, text) is replaced as a whole so that it is consistent across threads
+_fmt_time_cache: Tuple[Union[int, None], str] = (None, '')
+
 def _fmt_time(t):
-    import datetime
-    return datetime.datetime.fromtimestamp(t).isoformat()
+    global _fmt_time_cache
+    second = int(t)
+    cached_second, text = _fmt_time_cache
+    if cached_second != second:
+        import datetime
+        text = datetime.datetime.fromtimestamp(second).isoformat()
+        _fmt_time_cache = (second, text)
+    microsecond = round((t - second) * 1e6)
+    if microsecond == 0:
+        return text
+    if microsecond == 1000000:
+        import datetime
+        return datetime.datetime.fromtimestamp(t).isoformat()
+    return '{}.{:06d}'.format(text, microsecond)
+
+# The capture that applies to the code currently running (each thread and asyncio task has its own context).
+# Threads started within a capture do not inherit it, unless started via contextvars.copy_context().run
+_current_capture: contextvars.ContextVar = contextvars.ContextVar('hither_console_capture', default=None)
+_install_lock = threading.Lock()
+
+class _ConsoleProxy():
+    # Installed once as sys.stdout / sys.stderr. Writes are routed to the console capture of the
+    # current context, so that jobs running concurrently in threads each capture their own lines.
+    def __init__(self, original, stderr: bool):
+        self._original = original
+        self._stderr = stderr
+
+    def write(self, data: str):
+        cc = _current_capture.get()
+        if cc is None:
+            return self._original.write(data)
+        (cc._stderr_target if self._stderr else cc._stdout_target).write(data)
+        return len(data)
+
+    def flush(self) -> None:
+        if _current_capture.get() is None:
+            self._original.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._original, name)
+
+def _install_console_proxy():
+    # also reinstalls the proxy if sys.stdout or sys.stderr has been replaced in the meantime
+    with _install_lock:
+        if not isinstance(sys.stdout, _ConsoleProxy):
+            sys.stdout = _ConsoleProxy(sys.stdout, stderr=False)
+        if not isinstance(sys.stderr, _ConsoleProxy):
+            sys.stderr = _ConsoleProxy(sys.stderr, stderr=True)
+        return sys.stdout, sys.stderr
 
 class ConsoleCapture():
-    def __init__(self, label: str='', show_console: bool=True):
+    def __init__(self, label: str='', show_console: bool=True, max_lines_in_memory: Union[int, None]=None, overflow: str='spill', lines: Union[ConsoleLines, None]=None):
+        # lines: capture into an existing ConsoleLines (for example one that is being streamed)
         self._label = label
-        self._lines: List[dict] = []
+        self._lines = lines if lines is not None else ConsoleLines(max_lines_in_memory=max_lines_in_memory, overflow=overflow)
         self._time_start = None
         self._time_stop = None
-        self._original_stdout = sys.stdout
-        self._original_stderr = sys.stderr
         self._show_console = show_console
+        self._stdout_target: Union[CustomStdout, None] = None
+        self._stderr_target: Union[CustomStdout, None] = None
+        self._token: Union[contextvars.Token, None] = None
 
     def __enter__(self):
         self._start_capturing()
@@ -50,20 +389,27 @@ class ConsoleCapture():
 
     def _start_capturing(self) -> None:
         self._time_start = time.time()
-        sys.stdout = CustomStdout(self._label, self._lines, self._original_stdout, show_console=self._show_console)
-        sys.stderr = CustomStdout(self._label, self._lines, self._original_stderr, stderr=True, show_console=self._show_console)
+        stdout_proxy, stderr_proxy = _install_console_proxy()
+        enclosing = _current_capture.get()
+        if enclosing is not None:
+            # nested capture: the displayed lines are captured by the enclosing capture
+            original_stdout, original_stderr = enclosing._stdout_target, enclosing._stderr_target
+        else:
+            original_stdout, original_stderr = stdout_proxy._original, stderr_proxy._original
+        self._stdout_target = CustomStdout(self._label, self._lines, original_stdout, show_console=self._show_console)
+        self._stderr_target = CustomStdout(self._label, self._lines, original_stderr, stderr=True, show_console=self._show_console)
+        self._token = _current_capture.set(self)
 
     def _stop_capturing(self) -> None:
         self._time_stop = time.time()
-        sys.stdout.flush()
-        sys.stderr.flush()
-        sys.stdout = self._original_stdout
-        sys.stderr = self._original_stderr
+        if self._token is not None:
+            _current_capture.reset(self._token)
+            self._token = None
 
     @property
     def label(self):
         return self._label
 
     @property
-    def lines(self) -> List[dict]:
-        return self._lines
\ No newline at end of file
+    def lines(self) -> ConsoleLines:
+        return self._lines
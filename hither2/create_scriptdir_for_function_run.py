@@ -9,7 +9,8 @@ import json
 from copy import deepcopy
 from typing import Dict, List, Union
 import kachery_client as kc
-from ._safe_pickle import _safe_pickle
+from ._serialization import _serialize_to_file
+from .consolecapture import _console_stream_fname
 from ._bindmount import BindMount
 
 def _update_bind_mounts_and_environment_for_kachery_support(
@@ -49,6 +50,8 @@ def create_scriptdir_for_function_run(
     image: Union[DockerImage, bool, None],
     kwargs: dict,
     show_console: bool,
+    console_max_lines: Union[int, None] = None,
+    console_overflow: str = 'spill',
     _bind_mounts: List[BindMount] = [],
     _environment: Dict[str, str] = {},
     _kachery_support: Union[None, bool] = None,
@@ -91,6 +94,8 @@ def create_scriptdir_for_function_run(
             image=None,
             kwargs=new_kwargs,
             show_console=show_console,
+            console_max_lines=console_max_lines,
+            console_overflow=console_overflow,
             _kachery_support = False,
             _nvidia_support = _nvidia_support,
             _environment=_environment
@@ -98,6 +103,9 @@ def create_scriptdir_for_function_run(
         bind_mounts_path = f'{directory}/bind_mounts.json'
         with open(bind_mounts_path, 'w') as f:
             json.dump([x.serialize() for x in _bind_mounts], f)
+        # used when the job is run in a warm container instead (see _warm_container_pool.py)
+        with open(f'{directory}/container.json', 'w') as f:
+            json.dump({'image_name': f'{new_image.get_name()}:{new_image.get_tag()}', 'nvidia_support': _nvidia_support}, f)
         output_path = f'{directory}/output'
         os.mkdir(output_path)
         nvidia_opts = '--nvidia-support' if _nvidia_support else ''
@@ -138,7 +146,7 @@ def create_scriptdir_for_function_run(
     with open(f'{src_dir}/__init__.py', 'w') as f:
         pass
 
-    _safe_pickle(f'{input_dir}/kwargs.pkl', kwargs)
+    _serialize_to_file(f'{input_dir}/kwargs.pkl', kwargs, safe=True)
 
     modules2 = modules + ['hither2', 'kachery_client']
     for module in modules2:
@@ -162,25 +170,27 @@ def create_scriptdir_for_function_run(
     from f_src.{function_source_basename_noext} import {function_name}
 
     def main(): 
-        kwargs = hi._safe_unpickle(f'{{input_dir}}/kwargs.pkl')
+        kwargs = hi._deserialize_from_file(f'{{input_dir}}/kwargs.pkl', safe=True)
         
         with hi.EndProcessWhenFileDisappears(os.getenv('HITHER_RUNNING_FILE', None)):
             function_wrapper = hi._get_hither_function_wrapper({function_name})
-            console_lines = []
-            try:
-                return_value, exc, console_lines = hi._run_function(function_wrapper=function_wrapper, kwargs=kwargs, show_console={show_console}, image=None)
-                if exc:
-                    raise exc
-                error = None
-            except Exception as e:
-                return_value = None
-                error = e
-                print(traceback.format_exc())
+            console_lines = hi.ConsoleLines(max_lines_in_memory={console_max_lines!r}, overflow={console_overflow!r})
+            # the console lines are streamed while the function runs (via stdout in docker containers)
+            stream_path = None if os.getenv('HITHER_CONSOLE_STREAM_TO_STDOUT', None) == '1' else f'{{output_dir}}/{_console_stream_fname}'
+            with hi._ConsoleStreamWriter(console_lines, path=stream_path):
+                try:
+                    return_value, exc, _ = hi._run_function(function_wrapper=function_wrapper, kwargs=kwargs, show_console={show_console}, console_lines=console_lines, image=None)
+                    if exc:
+                        raise exc
+                    error = None
+                except Exception as e:
+                    return_value = None
+                    error = e
+                    print(traceback.format_exc())
             if error is None:
-                hi._safe_pickle(f'{{output_dir}}/return_value.pkl', return_value)
+                hi._serialize_to_file(f'{{output_dir}}/return_value.pkl', return_value, serializer=function_wrapper.serializer, safe=True)
             else:
                 hi._safe_pickle(f'{{output_dir}}/error_message.pkl', str(error))
-            hi._safe_pickle(f'{{output_dir}}/console_lines.pkl', console_lines)
 
     def _get_child_pids(pid):
         x = os.popen(f"pgrep -P {{pid}}").read().split('\\n')
@@ -3,6 +3,7 @@ import os
 from typing import Dict, List, Union
 
 from ._bindmount import BindMount
+from ._prepared_image_registry import _prepared_image_key, _docker_image_is_prepared, _singularity_image_is_prepared, _register_prepared_docker_image, _set_prepared_image_entry
 
 class DockerImage:
     def __init__(self, bind_mounts: List[BindMount]=[], environment: Dict[str, str]={}):
@@ -20,6 +21,9 @@ class DockerImage:
     @abstractmethod
     def get_tag(self) -> str:
         pass
+    def _get_preparation_key(self) -> str:
+        # identifies the image for sharing preparations (may be called before it is prepared)
+        return f'{type(self).__name__}:{self.get_name()}:{self.get_tag()}'
     def get_bind_mounts(self) -> List[BindMount]:
         return self._bind_mounts
     def get_environment(self) -> Dict[str, str]:
@@ -54,6 +58,10 @@ class LocalDockerImage(DockerImage):
             if _use_singularity():
                 raise Exception('Cannot use LocalDockerImage in singularity mode')
             else:
+                key = _prepared_image_key('local', self._name, self._tag)
+                if _docker_image_is_prepared(key, f'{self._name}:{self._tag}', remote=False):
+                    self._prepared = True
+                    return
                 ss = kc.ShellScript(f'''
                 #!/bin/bash
 
@@ -66,7 +74,10 @@ class LocalDockerImage(DockerImage):
                 fi
                 ''')
                 ss.start()
-                ss.wait()
+                retcode = ss.wait()
+                if retcode != 0:
+                    raise Exception(f'Docker image not found: {self._name}:{self._tag}')
+                _register_prepared_docker_image(key, name=self._name, tag=self._tag)
                 self._prepared = True
     def is_prepared(self) -> bool:
         return self._prepared
@@ -98,23 +109,36 @@ class RemoteDockerImage(DockerImage):
     def prepare(self):
         import kachery_client as kc
         if not self._prepared:
+            key = _prepared_image_key('remote', self._name, self._tag)
             if _use_singularity():
+                if _singularity_image_is_prepared(key):
+                    self._prepared = True
+                    return
                 ss = kc.ShellScript(f'''
                 #!/bin/bash
 
                 singularity pull docker://{self._name}
                 ''')
                 ss.start()
-                ss.wait()
+                retcode = ss.wait()
+                if retcode != 0:
+                    raise Exception(f'Problem pulling image with singularity: {self._name}')
+                _set_prepared_image_entry(key, name=self._name, tag=self._tag, digest=None)
                 self._prepared = True
             else:
+                if _docker_image_is_prepared(key, f'{self._name}:{self._tag}', remote=True):
+                    self._prepared = True
+                    return
                 ss = kc.ShellScript(f'''
                 #!/bin/bash
 
                 docker pull {self._name}:{self._tag}
                 ''')
                 ss.start()
-                ss.wait()
+                retcode = ss.wait()
+                if retcode != 0:
+                    raise Exception(f'Problem pulling docker image: {self._name}:{self._tag}')
+                _register_prepared_docker_image(key, name=self._name, tag=self._tag)
                 self._prepared = True
     def is_prepared(self) -> bool:
         return self._prepared
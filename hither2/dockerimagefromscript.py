@@ -3,6 +3,7 @@ from typing import Dict, List, Union
 
 from .dockerimage import DockerImage, _use_singularity
 from ._bindmount import BindMount
+from ._prepared_image_registry import _prepared_image_key, _docker_image_is_prepared, _singularity_image_is_prepared, _register_prepared_docker_image, _set_prepared_image_entry
 
 class DockerImageFromScript(DockerImage):
     def __init__(self, *, name: str, dockerfile: str, bind_mounts: List[BindMount]=[], environment: Dict[str, str]={}):
@@ -30,7 +31,11 @@ class DockerImageFromScript(DockerImage):
             dockerfile_dir = os.path.dirname(self._dockerfile)
             dockerfile_basename = os.path.basename(self._dockerfile)
 
+            key = _prepared_image_key('script', self._name, self._tag)
             if _use_singularity():
+                if _singularity_image_is_prepared(key):
+                    self._prepared = True
+                    return
                 ss = kc.ShellScript(f'''
                 #!/bin/bash
 
@@ -39,9 +44,15 @@ class DockerImageFromScript(DockerImage):
                 singularity exec docker://{self._name}:{self._tag} bash -c "echo preparing"
                 ''')
                 ss.start()
-                ss.wait()
+                retcode = ss.wait()
+                if retcode != 0:
+                    raise Exception(f'Problem preparing image with singularity: {self._name}:{self._tag}')
+                _set_prepared_image_entry(key, name=self._name, tag=self._tag, digest=None)
                 self._prepared = True
             else:
+                if _docker_image_is_prepared(key, f'{self._name}:{self._tag}', remote=False):
+                    self._prepared = True
+                    return
                 try:
                     import docker
                 except:
@@ -57,6 +68,7 @@ class DockerImageFromScript(DockerImage):
                     found_image = False
                 if found_image:
                     # already built
+                    _register_prepared_docker_image(key, name=self._name, tag=self._tag)
                     self._prepared = True
                     return
 
@@ -73,8 +85,14 @@ class DockerImageFromScript(DockerImage):
                 docker build -t {self._name}:{self._tag} -f {dockerfile_basename} .
                 ''')
                 ss.start()
-                ss.wait()
+                retcode = ss.wait()
+                if retcode != 0:
+                    raise Exception(f'Problem building docker image: {self._name}:{self._tag}')
+                _register_prepared_docker_image(key, name=self._name, tag=self._tag)
                 self._prepared = True
+    def _get_preparation_key(self) -> str:
+        # the tag is not known until the Dockerfile is parsed
+        return f'{type(self).__name__}:{self._name}:{os.path.abspath(self._dockerfile)}'
     def is_prepared(self) -> bool:
         return self._prepared
     def get_name(self) -> str:
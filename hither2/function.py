@@ -2,11 +2,13 @@ import os
 import inspect
 from .run_scriptdir_in_container import DockerImage
 from typing import Any, Callable, Dict, List, Type, Union
-from ._config import Config
+from ._config import Config, Inherit
 from ._job import Job
 from ._job import JobResult
 from ._job_cache import JobCache
 from .runtimehook import RuntimeHook, PreContainerContext
+from ._compression import _check_compression_codec
+from ._resources import _check_resources
 
 _global_registered_functions_by_name: Dict[str, Callable] = {}
 
@@ -28,7 +30,11 @@ class FunctionWrapper:
         modules: List[str],
         kachery_support: bool,
         nvidia_support: bool,
-        runtime_hooks: List[RuntimeHook]
+        runtime_hooks: List[RuntimeHook],
+        cache_compression: Union[str, None, Inherit]=Inherit.INHERIT,
+        serializer: Union[str, None]=None,
+        resources: Union[Dict[str, float], None]=None,
+        concurrency_group: Union[str, None]=None
     ) -> None:
         self._f = f
         self._name = name
@@ -38,6 +44,12 @@ class FunctionWrapper:
         self._kachery_support = kachery_support
         self._nvidia_support = nvidia_support
         self._runtime_hooks = runtime_hooks
+        if not isinstance(cache_compression, Inherit):
+            _check_compression_codec(cache_compression)
+        self._cache_compression = cache_compression
+        self._serializer = serializer
+        self._resources = _check_resources(resources)
+        self._concurrency_group = concurrency_group
 
         function_name = self._name
         try:
@@ -73,6 +85,18 @@ class FunctionWrapper:
     @property
     def function_source_path(self) -> str:
         return self._function_source_path
+    @property
+    def cache_compression(self) -> Union[str, None, Inherit]:
+        return self._cache_compression
+    @property
+    def serializer(self) -> Union[str, None]:
+        return self._serializer
+    @property
+    def resources(self) -> Dict[str, float]:
+        return self._resources
+    @property
+    def concurrency_group(self) -> Union[str, None]:
+        return self._concurrency_group
 
 def function(
     name: str,
@@ -82,7 +106,11 @@ def function(
     kachery_support: bool=False,
     nvidia_support: bool=False,
     register_globally=False,
-    runtime_hooks: List[RuntimeHook]=[]
+    runtime_hooks: List[RuntimeHook]=[],
+    cache_compression: Union[str, None, Inherit]=Inherit.INHERIT,
+    serializer: Union[str, None]=None,
+    resources: Union[Dict[str, float], None]=None,
+    concurrency_group: Union[str, None]=None
 ):
     def wrap(f: Callable[..., Any]):
         assert f.__name__ == name, f"Name does not match function name: {name} <> {f.__name__}"
@@ -94,7 +122,11 @@ def function(
             modules=modules,
             kachery_support=kachery_support,
             nvidia_support=nvidia_support,
-            runtime_hooks=runtime_hooks
+            runtime_hooks=runtime_hooks,
+            cache_compression=cache_compression,
+            serializer=serializer,
+            resources=resources,
+            concurrency_group=concurrency_group
         )
         setattr(f, '_hither_function_wrapper', _function_wrapper)
         # register the function
@@ -3,6 +3,7 @@ import uuid
 import kachery_client as kc
 import time
 from ._job import Job, _print_console_lines
+from . import consolecapture
 
 
 class Log:
@@ -12,6 +13,8 @@ class Log:
         logs_subfeed = feed.load_subfeed('logs')
         logs_subfeed.append_message({'log_id': self._log_id, 'timestamp': time.time() - 0})
         self._subfeed = feed.load_subfeed({'log_id': self._log_id})
+        # job ID -> [console stream, time of last report]
+        self._console_streams: Dict[str, list] = {}
     @property
     def log_id(self):
         return self._log_id
@@ -36,25 +39,71 @@ class Log:
             'timestamp': time.time() - 0,
             'job_id': job.job_id
         })
+    def _report_job_console(self, job: Job, final: bool=False):
+        # the console lines are reported in chunks while the job is running
+        x = self._console_streams.get(job.job_id, None)
+        if x is None:
+            x = [job.console_stream(), 0]
+            self._console_streams[job.job_id] = x
+        if (not final) and (time.time() - x[1] < consolecapture.console_stream_interval_sec):
+            return
+        x[1] = time.time()
+        while True:
+            lines = x[0].read()
+            if len(lines) == 0:
+                break
+            self._subfeed.append_message({
+                'type': 'jobConsole',
+                'timestamp': time.time() - 0,
+                'job_id': job.job_id,
+                'console_lines': lines
+            })
+        if final:
+            del self._console_streams[job.job_id]
     def _report_job_finished(self, job: Job):
+        cl_uri = _cached_console_lines_uri(job)
+        if cl_uri is None:
+            self._report_job_console(job, final=True)
         self._subfeed.append_message({
             'type': 'jobFinished',
             'timestamp': time.time() - 0,
             'job_id': job.job_id,
-            'console_lines_uri': kc.store_json(job.result.console_lines) if job.result.console_lines is not None else None
+            'console_lines_uri': cl_uri
         })
     def _report_job_error(self, job: Job):
+        self._report_job_console(job, final=True)
         self._subfeed.append_message({
             'type': 'jobError',
             'timestamp': time.time() - 0,
             'job_id': job.job_id,
             'error_message': str(job.result.error),
-            'console_lines_uri': kc.store_json(job.result.console_lines) if job.result.console_lines is not None else None
+            'console_lines_uri': None
         })
+    def _report_worker_recycled(self, *, worker_id: str, reason: str, num_tasks: int, rss_mb: Union[float, None], job_id: Union[str, None]):
+        self._subfeed.append_message({
+            'type': 'workerRecycled',
+            'timestamp': time.time() - 0,
+            'worker_id': worker_id,
+            'reason': reason,
+            'num_tasks': num_tasks,
+            'rss_mb': rss_mb,
+            'last_job_id': job_id
+        })
+
+def _cached_console_lines_uri(job: Job):
+    # cached results already have their console lines stored (reuse them if they are uncompressed)
+    if (job.result._console_lines_uri is not None) and (job.result._console_lines_codec is None):
+        return job.result._console_lines_uri
+    return None
 
 class LogReader:
-    def __init__(self, log_id: str) -> None:
+    """
+    console_max_lines / console_overflow: limit the streamed console lines of each job kept in memory (see ConsoleLines)
+    """
+    def __init__(self, log_id: str, *, console_max_lines: Union[int, None]=10000, console_overflow: str='spill') -> None:
         self._log_id = log_id
+        self._console_max_lines = console_max_lines
+        self._console_overflow = console_overflow
         feed = kc.load_feed('hither-logs', create=True)
         self._subfeed = feed.load_subfeed({'log_id': self._log_id})
         self._jobs: Dict[str, LogReaderJob] = {}
@@ -63,6 +112,10 @@ class LogReader:
         for m in messages:
             self._process_message(m)
             t = m.get('type', None)
+            if t == 'workerRecycled':
+                if job_id is None:
+                    print(f'{_fmt_time(m.get("timestamp", None))} WORKER-RECYCLED {m.get("worker_id", "")} - {m.get("reason", "")}')
+                continue
             _job_id = m.get('job_id', '')
             if (job_id is None) or (_job_id == '') or (job_id == _job_id):
                 j = self._jobs.get(_job_id, None)
@@ -79,11 +132,12 @@ class LogReader:
                     print(f'{_fmt_time(ts)} JOB-FINISHED  {_job_id} {j.function_name} ({j.function_version})')
                 elif t == 'jobError':
                     print(f'{_fmt_time(ts)} JOB-ERROR     {_job_id} {j.function_name} ({j.function_version}) - {j.error_message}')
-                if t in ['jobFinished', 'jobError']:
-                    if print_console:
-                        cl = j.console_lines
-                        if cl is not None:
-                            _print_console_lines(cl, label=f'[{_job_id}]')
+                if print_console:
+                    if t == 'jobConsole':
+                        _print_console_lines(m.get('console_lines', []), label=f'[{_job_id}]')
+                    elif (t in ['jobFinished', 'jobError']) and (j._console_lines_uri is not None):
+                        # not streamed (from the job cache, or written by an older version)
+                        _print_console_lines(j.console_lines, label=f'[{_job_id}]')
     @property
     def log_id(self):
         return self._log_id
@@ -92,16 +146,16 @@ class LogReader:
         t = m.get('type', None)
         if t == 'jobCreated':
             job_id = m.get('job_id', '')
-            j = LogReaderJob(created_message=m)
+            j = LogReaderJob(created_message=m, console_max_lines=self._console_max_lines, console_overflow=self._console_overflow)
             self._jobs[job_id] = j
-        elif t in ['jobQueued', 'jobRunning', 'jobFinished', 'jobError']:
+        elif t in ['jobQueued', 'jobRunning', 'jobConsole', 'jobFinished', 'jobError']:
             job_id = m.get('job_id', '')
             j = self._jobs.get(job_id, None)
             if j is not None:
                 j._process_message(m)
 
 class LogReaderJob:
-    def __init__(self, created_message: dict):
+    def __init__(self, created_message: dict, *, console_max_lines: Union[int, None]=None, console_overflow: str='spill'):
         m = created_message
         self._timestamps = {
             'created': None,
@@ -118,9 +172,13 @@ class LogReaderJob:
         self._status = 'pending'
         self._error_message: Union[None, str] = None
         self._console_lines_uri: Union[None, str] = None
+        self._streamed_console_lines = consolecapture.ConsoleLines(max_lines_in_memory=console_max_lines, overflow=console_overflow)
     def _process_message(self, m: dict):
         t = m.get('type', None)
-        if t == 'jobQueued':
+        if t == 'jobConsole':
+            for line in m.get('console_lines', []):
+                self._streamed_console_lines.append(line['timestamp'], line['text'], line.get('stderr', False))
+        elif t == 'jobQueued':
             timestamp = m.get('timestamp', None)
             self._timestamps['queued'] = timestamp
             self._status = 'queued'
@@ -155,6 +213,8 @@ class LogReaderJob:
     def console_lines(self) -> Union[None, List[dict]]:
         if self._console_lines_uri is not None:
             return cast(Union[None, List[dict]], kc.load_json(self._console_lines_uri))
+        elif (len(self._streamed_console_lines) > 0) or (self._status in ['finished', 'error']):
+            return self._streamed_console_lines.to_list()
         else:
             return None
     @property
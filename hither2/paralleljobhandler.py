@@ -1,29 +1,74 @@
 from multiprocessing.context import Process
 from hither2.dockerimage import DockerImage
 from .function import FunctionWrapper
-from typing import List, Dict, Any, Union
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Union
+import os
+import sys
 import time
+import uuid
 import multiprocessing
+import multiprocessing.connection
 import threading
 from multiprocessing.connection import Connection
 import time
 import atexit
 from ._config import ConfigEntry
+from .log import Log
 from ._job_handler import JobHandler
 from ._job import Job
 from ._run_function import _run_function
+from ._serialization import _serialize, _deserialize
+from .consolecapture import ConsoleLines, _ConsoleStreamWriter
+from ._activity import _notify_activity, _watch_connection, _unwatch_connection
+from ._resources import _check_resources, _resources_fit, _add_resources, _format_resources
 
 class ParallelJobHandler(JobHandler):
-    def __init__(self, num_workers):
+    def __init__(self, num_workers, resources: Union[Dict[str, float], None]=None, *,
+        worker_processes: bool=False,
+        recycle_after_tasks: Union[int, None]=None,
+        recycle_above_rss_mb: Union[float, None]=None,
+        recycle_after_idle_sec: Union[float, None]=None
+    ):
+        """
+        num_workers: maximum number of jobs running at the same time
+        resources: the capacity available to the jobs (e.g., {'cpus': 16, 'memory_gb': 64}).
+            Jobs are started as long as the resources they declare (see hi.function and hi.Config)
+            fit in what remains. Resources not listed here are not constrained.
+        worker_processes: run the jobs in a pool of long-lived worker processes rather than in threads.
+            The worker processes are started with the forkserver (or spawn) start method, so the functions
+            must be importable by the workers, and a script that uses them must guard its main code with
+            if __name__ == '__main__':
+        recycle_after_tasks: replace a worker process after it has run this many jobs
+        recycle_above_rss_mb: replace a worker process when its resident memory exceeds this after a job
+        recycle_after_idle_sec: replace a worker process (that has run jobs) after it has been idle this long
+        """
         super().__init__()
+        if (not worker_processes) and ((recycle_after_tasks is not None) or (recycle_above_rss_mb is not None) or (recycle_after_idle_sec is not None)):
+            raise Exception('Worker recycling requires worker_processes=True')
         self._num_workers = num_workers
-        self._processes: List[dict] = []
+        self._worker_processes = worker_processes
+        self._recycle_after_tasks = recycle_after_tasks
+        self._recycle_above_rss_mb = recycle_above_rss_mb
+        self._recycle_after_idle_sec = recycle_after_idle_sec
+        self._idle_workers: Deque[_PJHWorker] = deque()
+        self._capacity = _check_resources(resources)
+        self._available = dict(self._capacity)
+        # Entries are removed as soon as their jobs complete, so that the overhead does not grow with the number of jobs handled.
+        # Cancelled pending entries are marked, and skipped when they reach the front of the queue.
+        self._pending: Deque[dict] = deque()
+        self._pending_by_job_id: Dict[str, dict] = {}
+        self._running: Dict[str, dict] = {}
+        # the pending queue only needs to be scanned when a job is queued or resources are released
+        self._dispatch_needed = False
         self._halted = False
         _all_parallel_job_handlers.append(self)
 
     def cleanup(self):
         self._halted = True
-        for p in self._processes:
+        while len(self._idle_workers) > 0:
+            self._idle_workers.popleft().stop()
+        for p in list(self._running.values()):
             pp: Process = p['process']
             if pp is not None:
                 if _safe_is_alive(pp):
@@ -37,112 +82,195 @@ class ParallelJobHandler(JobHandler):
                         print('WARNING: unable to join process in cleanup')
     
     def queue_job(self, job: Job):
-        self._processes.append(dict(
+        p = dict(
             job=job,
             process=None,
             pipe_to_child=None,
-            pjh_status='pending'
-        ))
+            pjh_status='pending',
+            resources={k: v for k, v in job.resources.items() if k in self._capacity}
+        )
+        self._pending.append(p)
+        self._pending_by_job_id[job.job_id] = p
+        self._dispatch_needed = True
     
     def cancel_job(self, job_id: str, reason: str):
-        for p in self._processes:
-            if p['job']._job_id == job_id:
-                if p['pjh_status'] == 'running':
-                    print(f'ParallelJobHandler: Terminating job.')
-                    pp: Process = p['process']
-                    if _safe_is_alive(pp):
-                        try:
-                            pp.terminate()
-                        except:
-                            print('WARNING: unable to terminate process in cleanup *')
-                        try:
-                            pp.join()
-                        except:
-                            print('WARNING: unable to join process for job being cancelled *')
-                    j: Job = p['job']
-                    j._set_error(Exception(f'job cancelled: {reason}'))
-                    p['pjh_status'] = 'error'
-                else:
-                    # TODO: Consider if existing ERROR or FINISHED status should change this behavior
-                    j: Job = p['job']
-                    j._set_error(Exception(f'Job cancelled prior to running: {reason}'))
-                    p['pjh_status'] = 'error'
+        if job_id in self._running:
+            p = self._running[job_id]
+            print(f'ParallelJobHandler: Terminating job.')
+            pp: Process = p['process']
+            if _safe_is_alive(pp):
+                try:
+                    pp.terminate()
+                except:
+                    print('WARNING: unable to terminate process in cleanup *')
+                try:
+                    pp.join()
+                except:
+                    print('WARNING: unable to join process for job being cancelled *')
+            j: Job = p['job']
+            j._set_error(Exception(f'job cancelled: {reason}'))
+            self._retire(p, 'error')
+        elif job_id in self._pending_by_job_id:
+            p = self._pending_by_job_id.pop(job_id)
+            self._pending = deque([a for a in self._pending if a is not p])
+            j: Job = p['job']
+            j._set_error(Exception(f'Job cancelled prior to running: {reason}'))
+            p['pjh_status'] = 'error'
     
     def iterate(self):
         if self._halted:
             return
 
-        for p in self._processes:
-            if p['pjh_status'] == 'running':
-                # pp: multiprocessing.Process = p['process']
-                pp: threading.Thread = p['process']
-                j: Job = p['job']
-                if pp.is_alive():
-                    if p['pipe_to_child'].poll():
-                        try:
-                            ret = p['pipe_to_child'].recv()
-                        except:
-                            ret = None
-                        if ret is not None:
-                            p['pipe_to_child'].send('okay!')
-                            rv = ret['return_value']
-                            e: Union[None, str] = ret['error']
-                            console_lines: Union[None, List[dict]] = ret['console_lines']
-                            if console_lines is not None:
-                                j._set_console_lines(console_lines)
-                            if e is None:
-                                j._set_finished(rv)
-                                p['pjh_status'] = 'finished'
-                                try:
-                                    p['process'].join()
-                                except:
-                                    # raise Exception('pjh: Problem joining finished job process')
-                                    raise Exception('pjh: Problem joining finished job thread')
-                                # try:
-                                #     p['process'].close()
-                                # except:
-                                #     raise Exception('pjh: Problem closing finished job process')
-                            else:
-                                j._set_error(Exception(f'Error running job (pjh): {e}'))
-                                p['pjh_status'] = 'error'
-                                try:
-                                    p['process'].join()
-                                except:
-                                    print('WARNING: problem joining errored job process')
-                                try:
-                                    p['process'].close()
-                                except:
-                                    print('WARNING: problem closing errored job process')
-                else:
-                    j._set_error(Exception(f'Job process is not alive'))
-                    p['pjh_status'] = 'error'
-                    try:
-                        p['process'].close()
-                    except:
-                        print('WARNING: problem closing job process that is no longer alive (probably crashed)')
-        
-        num_running = 0
-        for p in self._processes:
-            if p['pjh_status'] == 'running':
-                num_running = num_running + 1
-
-        for p in self._processes:
-            if p['pjh_status'] == 'pending':
-                if num_running < self._num_workers:
-                    job: Job = p['job']
-                    pipe_to_parent, pipe_to_child = multiprocessing.Pipe()
-                    kwargs = job.get_resolved_kwargs()
-                    image = job.get_image(kwargs) if job.config.use_container else None
-                    # process = multiprocessing.Process(target=_pjh_run_job, args=(pipe_to_parent, job.function_wrapper, kwargs, image, job.config))
-                    process = threading.Thread(target=_pjh_run_job, args=(pipe_to_parent, job.function_wrapper, kwargs, image, job.config))
-                    p['process'] = process
-                    p['pipe_to_child'] = pipe_to_child
-
-                    p['pjh_status'] = 'running'
-                    j: Job = p['job']
-                    j._set_running()
-                    p['process'].start()
-                    num_running = num_running + 1
+        if len(self._running) > 0:
+            running = list(self._running.values())
+            # a single wait over all of the worker connections
+            ready = set(multiprocessing.connection.wait([p['pipe_to_child'] for p in running], timeout=0))
+            for p in running:
+                if p['pipe_to_child'] in ready:
+                    self._receive_messages(p)
+                if p['pjh_status'] == 'running':
+                    pp: threading.Thread = p['process']
+                    if not pp.is_alive():
+                        # the worker may have exited right after sending its result
+                        self._receive_messages(p)
+                        if p['pjh_status'] == 'running':
+                            j: Job = p['job']
+                            j._set_error(Exception(f'Job process is not alive'))
+                            self._retire(p, 'error')
+
+        if self._recycle_after_idle_sec is not None:
+            self._recycle_idle_workers()
+
+        if self._dispatch_needed:
+            self._dispatch_needed = False
+            self._dispatch_pending_jobs()
+
+    def _dispatch_pending_jobs(self):
+        # first fit: jobs that do not fit in the available resources keep their place in the queue
+        # while later (smaller) jobs are started
+        skipped: Deque[dict] = deque()
+        while (len(self._running) < self._num_workers) and (len(self._pending) > 0):
+            p = self._pending.popleft()
+            job: Job = p['job']
+            if not _resources_fit(p['resources'], self._capacity):
+                del self._pending_by_job_id[job.job_id]
+                p['pjh_status'] = 'error'
+                job._set_error(Exception(f'Job requires more resources ({_format_resources(p["resources"])}) than the capacity of the parallel job handler ({_format_resources(self._capacity)})'))
+                continue
+            if not _resources_fit(p['resources'], self._available):
+                skipped.append(p)
+                continue
+            del self._pending_by_job_id[job.job_id]
+            _add_resources(self._available, p['resources'], -1)
+            kwargs = job.get_resolved_kwargs()
+            image = job.get_image(kwargs) if job.config.use_container else None
+            p['pjh_status'] = 'running'
+            self._running[job.job_id] = p
+            if self._worker_processes:
+                w = self._take_idle_worker()
+                p['worker'] = w
+                p['process'] = w.process
+                p['pipe_to_child'] = w.conn
+                job._set_running()
+                try:
+                    w.run_job(job, kwargs, image)
+                except Exception as e:
+                    # for example, the kwargs could not be pickled (nothing was sent, so the worker can be reused)
+                    job._set_error(Exception(f'Unable to send job to worker process: {str(e)}'))
+                    self._retire(p, 'error', worker_ok=True)
+            else:
+                pipe_to_parent, pipe_to_child = multiprocessing.Pipe()
+                process = threading.Thread(target=_pjh_run_job, args=(pipe_to_parent, job.function_wrapper, kwargs, image, job.config))
+                p['process'] = process
+                p['pipe_to_child'] = pipe_to_child
+                job._set_running()
+                p['process'].start()
+        skipped.extend(self._pending)
+        self._pending = skipped
+
+    def _retire(self, p: dict, status: str, worker_ok: bool=False):
+        p['pjh_status'] = status
+        del self._running[p['job'].job_id]
+        w: Union[_PJHWorker, None] = p.get('worker', None)
+        if w is None:
+            p['pipe_to_child'].close()
+        elif worker_ok:
+            self._release_worker(w)
+        else:
+            w.terminate()
+        _add_resources(self._available, p['resources'])
+        self._dispatch_needed = True
+
+    def _take_idle_worker(self) -> '_PJHWorker':
+        w: Union[_PJHWorker, None] = None
+        while (w is None) and (len(self._idle_workers) > 0):
+            w = self._idle_workers.popleft()
+            if not _safe_is_alive(w.process):
+                w.terminate()
+                w = None
+        if w is None:
+            w = _PJHWorker()
+        if (self._recycle_after_tasks is not None) and (w.num_tasks + 1 >= self._recycle_after_tasks):
+            # this is the last job for the worker, so start its replacement now
+            self._idle_workers.append(_PJHWorker())
+            w.replacement_spawned = True
+        return w
+
+    def _release_worker(self, w: '_PJHWorker'):
+        if (self._recycle_after_tasks is not None) and (w.num_tasks >= self._recycle_after_tasks):
+            self._recycle_worker(w, f'ran {w.num_tasks} jobs')
+        elif (self._recycle_above_rss_mb is not None) and (w.rss_mb is not None) and (w.rss_mb > self._recycle_above_rss_mb):
+            self._recycle_worker(w, f'resident memory {w.rss_mb:.0f} MB exceeds {self._recycle_above_rss_mb} MB')
+        else:
+            w.set_idle()
+            self._idle_workers.append(w)
+
+    def _recycle_idle_workers(self):
+        assert self._recycle_after_idle_sec is not None
+        t = time.time()
+        to_recycle = [w for w in self._idle_workers if (w.num_tasks > 0) and (t - w.timestamp_idle > self._recycle_after_idle_sec)]
+        for w in to_recycle:
+            self._idle_workers.remove(w)
+            self._recycle_worker(w, f'idle for {t - w.timestamp_idle:.0f} sec')
+
+    def _recycle_worker(self, w: '_PJHWorker', reason: str):
+        if not w.replacement_spawned:
+            self._idle_workers.append(_PJHWorker())
+        w.stop()
+        if w.last_log is not None:
+            w.last_log._report_worker_recycled(worker_id=w.worker_id, reason=reason, num_tasks=w.num_tasks, rss_mb=w.rss_mb, job_id=w.last_job_id)
+
+    def _receive_messages(self, p: dict):
+        j: Job = p['job']
+        conn: Connection = p['pipe_to_child']
+        while conn.poll():
+            try:
+                msg = conn.recv()
+            except:
+                return
+            if msg.get('type', None) == 'console':
+                j._append_console_rows(msg['rows'])
+            else:
+                self._handle_result(p, msg)
+                return
+    def _handle_result(self, p: dict, ret: dict):
+        j: Job = p['job']
+        e: Union[None, str] = ret['error']
+        w: Union[_PJHWorker, None] = p.get('worker', None)
+        if w is None:
+            try:
+                p['process'].join()
+            except:
+                print('WARNING: problem joining job thread')
+        else:
+            w.rss_mb = ret.get('rss_mb', None)
+        if e is None:
+            rv = _deserialize(ret['return_value']) if ret['return_value'] is not None else None
+            j._set_finished(rv)
+            self._retire(p, 'finished', worker_ok=True)
+        else:
+            j._set_error(Exception(f'Error running job (pjh): {e}'))
+            self._retire(p, 'error', worker_ok=True)
 
 def _safe_is_alive(p: Process):
     try:
@@ -151,26 +279,151 @@ def _safe_is_alive(p: Process):
         return False
 
 def _pjh_run_job(pipe_to_parent: Connection, function_wrapper: FunctionWrapper, kwargs: Dict[str, Any], image: Union[DockerImage, None], config: ConfigEntry) -> None:
-    return_value, error, console_lines = _run_function(
+    ret = _pjh_execute(
+        send=pipe_to_parent.send,
         function_wrapper=function_wrapper,
-        image=image,
         kwargs=kwargs,
-        show_console=config.show_console
+        image=image,
+        show_console=config.show_console,
+        console_max_lines=config.console_max_lines,
+        console_overflow=config.console_overflow
     )
+    pipe_to_parent.send(ret)
+    pipe_to_parent.close()
+    _notify_activity()
+
+def _pjh_execute(*, send: Callable[[dict], None], function_wrapper: FunctionWrapper, kwargs: Dict[str, Any], image: Union[DockerImage, None], show_console: bool, console_max_lines: Union[int, None], console_overflow: str) -> dict:
+    # the console lines are sent to the parent in chunks while the function runs
+    console_lines = ConsoleLines(max_lines_in_memory=console_max_lines, overflow=console_overflow)
+    with _ConsoleStreamWriter(console_lines, send=lambda rows: send(dict(type='console', rows=rows))):
+        return_value, error, _ = _run_function(
+            function_wrapper=function_wrapper,
+            image=image,
+            kwargs=kwargs,
+            show_console=show_console,
+            console_lines=console_lines
+        )
 
-    ret = dict(
-        return_value=return_value,
-        error=str(error) if error is not None else None,
-        console_lines=console_lines
+    serialized_return_value: Union[bytes, None] = None
+    if error is None:
+        try:
+            serialized_return_value = _serialize(return_value, serializer=function_wrapper.serializer)
+        except Exception as e:
+            error = Exception(f'Unable to serialize return value: {str(e)}')
+
+    return dict(
+        type='result',
+        return_value=serialized_return_value,
+        error=str(error) if error is not None else None
     )
 
-    pipe_to_parent.send(ret)
-    # wait for message to return
+def _get_worker_context():
+    # Forking a process that has threads running (job handler threads, job cache checks, ...) is unsafe,
+    # and fork will no longer be the default start method on Linux as of Python 3.14, so the start method
+    # is chosen explicitly. The workers import the modules of the functions when they receive the jobs.
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('forkserver')
+        # so that the new workers do not each need to import hither2 (only effective before the server is started)
+        ctx.set_forkserver_preload(['__main__', 'hither2'])
+        return ctx
+    return multiprocessing.get_context('spawn')
+
+class _PJHWorker:
+    def __init__(self):
+        ctx = _get_worker_context()
+        self._worker_id = 'w-' + str(uuid.uuid4())[-8:]
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=_pjh_worker_main, args=(child_conn,), daemon=True)
+        self._process.start()
+        child_conn.close()
+        self.num_tasks = 0
+        self.rss_mb: Union[float, None] = None
+        self.timestamp_idle = time.time()
+        self.replacement_spawned = False
+        self.last_log: Union[Log, None] = None
+        self.last_job_id: Union[str, None] = None
+    @property
+    def worker_id(self):
+        return self._worker_id
+    @property
+    def process(self):
+        return self._process
+    @property
+    def conn(self):
+        return self._conn
+    def run_job(self, job: Job, kwargs: Dict[str, Any], image: Union[DockerImage, None]):
+        # the job manager is woken up when the worker sends something
+        _watch_connection(self._conn)
+        self._conn.send(dict(
+            type='job',
+            function_wrapper=job.function_wrapper,
+            kwargs=kwargs,
+            image=image,
+            show_console=job.config.show_console,
+            console_max_lines=job.config.console_max_lines,
+            console_overflow=job.config.console_overflow
+        ))
+        self.num_tasks += 1
+        self.last_log = job.config.log
+        self.last_job_id = job.job_id
+    def set_idle(self):
+        _unwatch_connection(self._conn)
+        self.timestamp_idle = time.time()
+    def stop(self):
+        # the worker exits after receiving this (it is not waited for)
+        _unwatch_connection(self._conn)
+        try:
+            self._conn.send(dict(type='stop'))
+        except:
+            pass
+        self._conn.close()
+    def terminate(self):
+        _unwatch_connection(self._conn)
+        if _safe_is_alive(self._process):
+            try:
+                self._process.terminate()
+                self._process.join()
+            except:
+                print('WARNING: unable to terminate worker process')
+        self._conn.close()
+
+def _pjh_worker_main(conn: Connection):
     while True:
-        if pipe_to_parent.poll():
-            pipe_to_parent.recv()
+        try:
+            msg = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        except Exception as e:
+            # for example, the function is not importable (defined interactively)
+            conn.send(dict(type='result', return_value=None, error=f'Unable to receive job in worker process: {str(e)}'))
+            continue
+        if msg['type'] == 'stop':
             return
-        time.sleep(0.02)
+        ret = _pjh_execute(
+            send=conn.send,
+            function_wrapper=msg['function_wrapper'],
+            kwargs=msg['kwargs'],
+            image=msg['image'],
+            show_console=msg['show_console'],
+            console_max_lines=msg['console_max_lines'],
+            console_overflow=msg['console_overflow']
+        )
+        ret['rss_mb'] = _get_rss_mb()
+        conn.send(ret)
+
+def _get_rss_mb() -> Union[float, None]:
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except:
+        pass
+    try:
+        import resource
+        # the high-water mark (in kilobytes, or bytes on macOS)
+        x = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return x / (1024 * 1024) if sys.platform == 'darwin' else x / 1024
+    except:
+        return None
 
 _all_parallel_job_handlers: List[ParallelJobHandler] = []
 def cleanup_all():
@@ -8,18 +8,24 @@ import fnmatch
 from typing import Any, Callable, Dict, List, Tuple, Union
 from .run_scriptdir_in_container import DockerImage, BindMount, run_scriptdir_in_container
 from ._safe_pickle import _safe_unpickle
+from ._serialization import _deserialize_from_file
+from .consolecapture import ConsoleLines
 from .create_scriptdir_for_function_run import _update_bind_mounts_and_environment_for_kachery_support
+from ._warm_container_pool import _warm_containers_enabled, _run_scriptdir_in_warm_container
 
 def run_function_in_container(
     function_wrapper: FunctionWrapper, *,
     image: Union[DockerImage, bool],
     kwargs: dict,
     show_console: bool,
+    console_max_lines: Union[int, None] = None,
+    console_overflow: str = 'spill',
+    console_lines: Union[ConsoleLines, None] = None,
     _environment: Dict[str, str] = dict(),
     _bind_mounts: List[BindMount] = [],
     _kachery_support: Union[None, bool] = None,
     _nvidia_support: Union[None, bool] = None
-) -> Tuple[Any, Union[None, Exception], Union[None, List[dict]]]:
+) -> Tuple[Any, Union[None, Exception], Union[None, ConsoleLines, List[dict]]]:
     import kachery_client as kc
     if _kachery_support is None:
         _kachery_support = function_wrapper.kachery_support
@@ -28,6 +34,9 @@ def run_function_in_container(
     if _nvidia_support is None:
         _nvidia_support = function_wrapper.nvidia_support
 
+    if console_lines is None:
+        console_lines = ConsoleLines(max_lines_in_memory=console_max_lines, overflow=console_overflow)
+
     with kc.TemporaryDirectory(remove=True) as tmpdir:
         create_scriptdir_for_function_run(
             directory=tmpdir,
@@ -35,19 +44,27 @@ def run_function_in_container(
             image=image,
             kwargs=kwargs,
             show_console=show_console,
+            console_max_lines=console_max_lines,
+            console_overflow=console_overflow,
             _environment=_environment,
             _bind_mounts=_bind_mounts,
             _kachery_support=False,
             _nvidia_support=_nvidia_support
         )
         output_dir = f'{tmpdir}/output'
-        j = run_scriptdir(scriptdir=tmpdir)
+        if _warm_containers_enabled():
+            _run_scriptdir_in_warm_container(scriptdir=tmpdir, console_lines=console_lines, show_console=show_console)
+            status = 'complete'
+        else:
+            # the console lines are streamed while the function runs
+            j = run_scriptdir(scriptdir=tmpdir, console_lines=console_lines)
+            status = j.status
 
-        if j.status == 'complete':
+        if status == 'complete':
             return_value_path = output_dir + '/return_value.pkl'
             error_message_path = output_dir + '/error_message.pkl'
             if os.path.isfile(return_value_path):
-                return_value = _safe_unpickle(return_value_path)
+                return_value = _deserialize_from_file(return_value_path, safe=True)
                 error = None
             elif os.path.isfile(error_message_path):
                 return_value = None
@@ -58,12 +75,7 @@ def run_function_in_container(
                 error_message = 'Not found: error_message.pkl'
                 error = Exception(error_message)
         else:
-            raise Exception(f'Unexpected status for scriptdir job: {j.status}')
-        console_lines_path = output_dir + '/console_lines.pkl'
-        if os.path.isfile(console_lines_path):
-            console_lines = _safe_unpickle(console_lines_path)
-        else:
-            console_lines = None
+            raise Exception(f'Unexpected status for scriptdir job: {status}')
         
         # postcontainer
         if error is None:
@@ -1,17 +1,26 @@
 import time
+from typing import Union
 from .scriptdir_runner import ScriptDirRunnerJob
+from .consolecapture import ConsoleLines, _ConsoleStreamReader, _console_stream_fname
 
 from numpy import source
 from .dockerimage import DockerImage, RemoteDockerImage
 
 def run_scriptdir(*,
-    scriptdir: str
+    scriptdir: str,
+    console_lines: Union[ConsoleLines, None]=None
 ):
+    # console_lines: append the console lines streamed by the script as it runs
+    stream_reader = _ConsoleStreamReader(f'{scriptdir}/output/{_console_stream_fname}')
     j = ScriptDirRunnerJob(scriptdir)
     j.start()
     while True:
         j.iterate()
+        if console_lines is not None:
+            console_lines._extend_rows(stream_reader.read_new())
         if j.status == 'complete':
             break
         time.sleep(0.1)
+    if console_lines is not None:
+        console_lines._extend_rows(stream_reader.read_new())
     return j
\ No newline at end of file
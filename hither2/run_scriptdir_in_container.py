@@ -2,12 +2,15 @@ from abc import abstractmethod
 import json
 import os
 import shutil
-from typing import List, Union, cast
+from typing import Iterable, List, Union, cast
+import queue
 import tarfile
+import threading
 
 from numpy import source
 from .dockerimage import DockerImage, RemoteDockerImage
 from ._bindmount import BindMount
+from .consolecapture import _console_stream_fname, _console_stream_marker
 
 def run_scriptdir_in_container(*,
     scriptdir: str,
@@ -109,6 +112,16 @@ def _run_script_in_container_docker(*,
 
     client = docker.from_env()
 
+    # on a local docker daemon, the input and output directories are bind-mounted (as with singularity),
+    # otherwise they are transferred as uncompressed streamed archives
+    bind_io = _docker_scriptdir_io_mode() == 'bind'
+    if bind_io:
+        all_bind_mounts = list(all_bind_mounts)
+        if input_dir:
+            all_bind_mounts.append(BindMount(source=input_dir, target='/working/input', read_only=True))
+        if output_dir:
+            all_bind_mounts.append(BindMount(source=output_dir, target='/working/output', read_only=False))
+
     # create the mounts
     mounts = [
         Mount(target=x.target, source=x.source, type='bind', read_only=x.read_only)
@@ -116,62 +129,134 @@ def _run_script_in_container_docker(*,
     ]
 
     # create the container
+    # (with the output directory bind-mounted, the console lines are streamed directly to the file)
     container = cast(Container, client.containers.create(
         image_name,
         [script_path],
         mounts=mounts,
-        network_mode='host'
+        network_mode='host',
+        environment={} if (bind_io and output_dir) else {'HITHER_CONSOLE_STREAM_TO_STDOUT': '1'}
     ))
 
     # copy input directory to /working/input
-    if input_dir:
-        input_tar_path = tmpdir + '/input.tar.gz'
-        with tarfile.open(input_tar_path, 'w:gz') as tar:
-            tar.add(input_dir, arcname='input')
-        with open(input_tar_path, 'rb') as tarf:
-            container.put_archive('/working/', tarf)
+    if input_dir and (not bind_io):
+        container.put_archive('/working/', _stream_tar_archive(input_dir, arcname='input'))
 
     # run the container
     container.start()
     logs = container.logs(stream=True)
+    # the streamed console lines are appended to the console stream file, so that they can be followed from outside
+    console_stream_path = f'{output_dir}/{_console_stream_fname}' if output_dir else None
+    partial = b''
     for a in logs:
-        for b in a.split(b'\n'):
-            if b:
-                print(b.decode())
+        lines = (partial + a).split(b'\n')
+        partial = lines.pop()
+        _handle_container_log_lines(lines, console_stream_path)
+    _handle_container_log_lines([partial], console_stream_path)
     
     # copy output from /working/output
-    if output_dir:
+    if output_dir and (not bind_io):
         strm, st = container.get_archive(path='/working/output/')
-        output_tar_path = tmpdir + '/output.tar.gz'
-        with open(output_tar_path, 'wb') as f:
-            for d in strm:
-                f.write(d)
-        with tarfile.open(output_tar_path) as tar:
-            def is_within_directory(directory, target):
-                
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-            
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-                
-                return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-            
-                tar.extractall(path, members, numeric_owner=numeric_owner) 
-                
-            
-            safe_extract(tar, tmpdir)
-        for fname in os.listdir(tmpdir + '/output'):
-            shutil.move(tmpdir + '/output/' + fname, output_dir + '/' + fname)
+        _extract_tar_stream(strm, prefix='output/', directory=output_dir)
     
     container.remove()
 
+def _docker_scriptdir_io_mode():
+    # HITHER_DOCKER_SCRIPTDIR_IO: 'bind' or 'archive' (by default, 'bind' unless the docker daemon is remote)
+    mode = os.getenv('HITHER_DOCKER_SCRIPTDIR_IO', None)
+    if mode is None:
+        docker_host = os.getenv('DOCKER_HOST', None)
+        return 'bind' if (docker_host is None) or docker_host.startswith('unix://') else 'archive'
+    if mode not in ['bind', 'archive']:
+        raise Exception(f'Unexpected value of HITHER_DOCKER_SCRIPTDIR_IO environment variable: {mode}')
+    return mode
+
+class _ChunkQueue:
+    # a file-like object written by a thread and consumed as a generator of chunks
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue(maxsize=16)
+    def write(self, data: bytes):
+        if len(data) > 0:
+            self._queue.put(bytes(data))
+        return len(data)
+    def close(self):
+        self._queue.put(None)
+    def chunks(self):
+        while True:
+            a = self._queue.get()
+            if a is None:
+                return
+            yield a
+
+def _stream_tar_archive(path: str, *, arcname: str):
+    q = _ChunkQueue()
+    errors: List[Exception] = []
+    def write_archive():
+        try:
+            with tarfile.open(fileobj=q, mode='w|', bufsize=_tar_stream_chunk_size) as tar:
+                tar.add(path, arcname=arcname)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            q.close()
+    t = threading.Thread(target=write_archive, daemon=True)
+    t.start()
+    for a in q.chunks():
+        yield a
+    t.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+class _ChunkReader:
+    # a file-like object reading from a generator of chunks
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buf = b''
+    def read(self, n: int=-1):
+        while (n < 0) or (len(self._buf) < n):
+            try:
+                self._buf = self._buf + next(self._chunks)
+            except StopIteration:
+                break
+        if n < 0:
+            n = len(self._buf)
+        ret = self._buf[:n]
+        self._buf = self._buf[n:]
+        return ret
+
+def _extract_tar_stream(chunks: Iterable[bytes], *, prefix: str, directory: str):
+    # extract the members under prefix into directory, as the archive is received
+    abs_directory = os.path.abspath(directory)
+    with tarfile.open(fileobj=_ChunkReader(chunks), mode='r|', bufsize=_tar_stream_chunk_size) as tar:
+        for member in tar:
+            if not member.name.startswith(prefix):
+                continue
+            member.name = member.name[len(prefix):]
+            if member.name == '':
+                continue
+            target = os.path.abspath(os.path.join(abs_directory, member.name))
+            if os.path.commonprefix([abs_directory, target]) != abs_directory:
+                raise Exception("Attempted Path Traversal in Tar File")
+            if not (member.isfile() or member.isdir()):
+                continue
+            tar.extract(member, abs_directory)
+
+_tar_stream_chunk_size = 1024 * 1024
+
+def _handle_container_log_lines(lines: List[bytes], console_stream_path: Union[str, None]):
+    stream_lines: List[str] = []
+    for b in lines:
+        if b:
+            txt = b.decode()
+            if txt.startswith(_console_stream_marker) and (console_stream_path is not None):
+                stream_lines.append(txt[len(_console_stream_marker):] + '\n')
+            else:
+                print(txt)
+    if len(stream_lines) > 0:
+        assert console_stream_path is not None
+        with open(console_stream_path, 'a') as f:
+            f.write(''.join(stream_lines))
+
 def _run_script_in_container_singularity(*,
     all_bind_mounts: List[BindMount],
     image_name: str,
@@ -7,14 +7,19 @@ from typing import Dict, Union
 from ._job import Job
 from .create_scriptdir_for_function_run import create_scriptdir_for_function_run
 from ._safe_pickle import _safe_unpickle
+from ._serialization import _deserialize_from_file
+from .consolecapture import _ConsoleStreamReader, _console_stream_fname
+from ._resources import _add_resources
 
 class SlurmAllocation:
-    def __init__(self, *, directory: str, srun_command: str, allocation_id: str):
+    def __init__(self, *, directory: str, srun_command: str, allocation_id: str, resources: Dict[str, float]={}):
         import kachery_client as kc
         self._directory = directory
+        self._resources = resources
         self._srun_command = srun_command
         self._allocation_id = allocation_id
         self._jobs: Dict[str, Job] = {}
+        self._console_stream_readers: Dict[str, _ConsoleStreamReader] = {}
         self._jobs_dir = f'{self._directory}/jobs'
         self._script: Union[kc.ShellScript, None] = None
         self._status: str = 'pending'
@@ -69,8 +74,11 @@ class SlurmAllocation:
             function_wrapper=function_wrapper,
             image=image,
             kwargs=kwargs,
-            show_console=job.config.show_console
+            show_console=job.config.show_console,
+            console_max_lines=job.config.console_max_lines,
+            console_overflow=job.config.console_overflow
         )
+        self._console_stream_readers[job.job_id] = _ConsoleStreamReader(f'{self._jobs_dir}/{job.job_id}/output/{_console_stream_fname}')
     def has_job(self, job_id: str):
         return job_id in self._jobs
     def cancel_job(self, job_id: str, reason: str):
@@ -96,6 +104,13 @@ class SlurmAllocation:
     def allocation_id(self):
         return self._allocation_id
     @property
+    def available_resources(self) -> Dict[str, float]:
+        ret = dict(self._resources)
+        for j in self._jobs.values():
+            if j.status in ['queued', 'running']:
+                _add_resources(ret, j.resources, -1)
+        return ret
+    @property
     def num_queued_jobs(self):
         return len([j for j in self._jobs.values() if j.status == 'queued'])
     @property
@@ -131,16 +146,14 @@ class SlurmAllocation:
                 elif s == 'running':
                     if j.status != 'running':
                         j._set_running()
+                    j._append_console_rows(self._console_stream_readers[job_id].read_new())
                 elif s == 'complete':
                     if j.status not in ['finished', 'error']:
-                        console_lines_path = f'{self._jobs_dir}/{job_id}/output/console_lines.pkl'
-                        if os.path.isfile(console_lines_path):
-                            console_lines = _safe_unpickle(console_lines_path)
-                            j._set_console_lines(console_lines)
+                        j._append_console_rows(self._console_stream_readers[job_id].read_new())
                         return_value_path = f'{self._jobs_dir}/{job_id}/output/return_value.pkl'
                         error_message_path = f'{self._jobs_dir}/{job_id}/output/error_message.pkl'
                         if os.path.isfile(return_value_path):
-                            return_value = _safe_unpickle(return_value_path)
+                            return_value = _deserialize_from_file(return_value_path, safe=True)
 
                             # postcontainer
                             kwargs=j.get_resolved_kwargs()
@@ -7,12 +7,19 @@ import os
 from ._job_handler import JobHandler
 from ._job import Job
 from .slurmallocation import SlurmAllocation
+from ._resources import _check_resources, _resources_fit, _format_resources
 
 class SlurmJobHandler(JobHandler):
-    def __init__(self, *, num_jobs_per_allocation: int, max_simultaneous_allocations: Union[int, None], srun_command: str):
+    def __init__(self, *, num_jobs_per_allocation: int, max_simultaneous_allocations: Union[int, None], srun_command: str, resources_per_allocation: Union[Dict[str, float], None]=None):
+        """
+        resources_per_allocation: the capacity of each allocation (e.g., {'cpus': 32, 'memory_gb': 128}),
+            which should match what the srun command requests. Jobs are packed into allocations
+            according to the resources they declare (see hi.function and hi.Config).
+        """
         import kachery_client as kc
         super().__init__()
         self._num_jobs_per_allocation = num_jobs_per_allocation
+        self._resources_per_allocation = _check_resources(resources_per_allocation)
         self._max_num_allocations = max_simultaneous_allocations
         self._srun_command = srun_command
         self._pending_jobs: Dict[str, Job] = {}
@@ -37,7 +44,7 @@ class SlurmJobHandler(JobHandler):
     def queue_job(self, job: Job):
         self._pending_jobs[job.job_id] = job
     
-    def _find_running_allocation_with_empty_slot(self):
+    def _find_running_allocation_with_empty_slot(self, resources: Dict[str, float]):
         num_running_allocations = 0
         num_pending_allocations = 0
         num_starting_allocations = 0
@@ -46,7 +53,8 @@ class SlurmJobHandler(JobHandler):
                 num_running_allocations += 1
                 n = b.num_queued_jobs + b.num_running_jobs
                 if n < self._num_jobs_per_allocation:
-                    return b
+                    if _resources_fit(resources, b.available_resources):
+                        return b
             elif b.status == 'pending':
                 num_pending_allocations += 1
             elif b.status == 'starting':
@@ -61,7 +69,7 @@ class SlurmJobHandler(JobHandler):
         allocation_id = 'a-' + str(uuid.uuid4())[-8:]
         allocationdir = f'{self._directory}/{allocation_id}'
         os.mkdir(allocationdir)
-        b = SlurmAllocation(directory=allocationdir, srun_command=self._srun_command, allocation_id=allocation_id)
+        b = SlurmAllocation(directory=allocationdir, srun_command=self._srun_command, allocation_id=allocation_id, resources=self._resources_per_allocation)
         self._allocations.append(b)
         b.start()
     
@@ -84,7 +92,11 @@ class SlurmJobHandler(JobHandler):
         pending_job_ids = list(self._pending_jobs.keys())
         for job_id in pending_job_ids:
             job = self._pending_jobs[job_id]
-            b = self._find_running_allocation_with_empty_slot()
+            if not _resources_fit(job.resources, self._resources_per_allocation):
+                job._set_error(Exception(f'Job requires more resources ({_format_resources(job.resources)}) than an allocation provides ({_format_resources(self._resources_per_allocation)})'))
+                del self._pending_jobs[job_id]
+                continue
+            b = self._find_running_allocation_with_empty_slot(job.resources)
             if b is not None:
                 b.add_job(job)
                 del self._pending_jobs[job_id]
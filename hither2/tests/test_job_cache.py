@@ -0,0 +1,46 @@
+import random
+import time
+import hither2 as hi
+from hither2 import _check_job_cache
+from hither2._job import JobResult
+from hither2._job_cache import _compute_job_dag_hash
+
+_num_upstream_runs = [0]
+
+@hi.function('upstream_job', '0.1.0')
+def upstream_job(x: int):
+    _num_upstream_runs[0] += 1
+    return x + 1
+
+@hi.function('consumer_job', '0.1.0')
+def consumer_job(y: int):
+    return y * 2
+
+class _StubJobCache:
+    # a job cache in dag hashing mode (the lookups are done by _probe_job_cache_batch, replaced below)
+    hash_mode = 'dag'
+    compression = None
+    def __init__(self):
+        self.results = {}
+    def _get_pending_job_result(self, job_hash: str):
+        return None
+    def _record_accesses(self, job_hashes):
+        pass
+    def _store_job_result(self, job_hash: str, job_result: JobResult, **kwargs):
+        pass
+
+def test_dag_mode_skips_upstream_of_cache_hit(monkeypatch):
+    def probe_with_latency(job_cache: _StubJobCache, job_hashes):
+        time.sleep(random.uniform(0.01, 0.1))
+        return {job_hash: job_cache.results.get(job_hash, None) for job_hash in job_hashes}
+    monkeypatch.setattr(_check_job_cache, '_probe_job_cache_batch', probe_with_latency)
+    jc = _StubJobCache()
+    for trial in range(10):
+        with hi.Config(job_cache=jc):
+            a = upstream_job.run(x=trial)
+            b = consumer_job.run(y=a)
+        jc.results[_compute_job_dag_hash(b)] = JobResult(return_value=(trial + 1) * 2, status='finished')
+        assert b.wait().return_value == (trial + 1) * 2
+        assert b.result_is_from_cache
+        hi.wait(0.3)
+        assert _num_upstream_runs[0] == 0
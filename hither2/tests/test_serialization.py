@@ -0,0 +1,36 @@
+import io
+import numpy as np
+import hither2 as hi
+from hither2._serialization import _serialize, _deserialize, _serialize_to_file, _deserialize_from_file
+from hither2._safe_pickler import _SafePickler, _SafeUnpickler
+
+@hi.function('double_array', '0.1.0')
+def double_array(x: np.ndarray):
+    return x * 2
+
+def test_memmap_kwarg_round_trip():
+    # the (memory-mapped) result of a job that ran in a container is passed to another one
+    from hither2.run_function_in_container import run_function_in_container
+    fw = hi._get_hither_function_wrapper(double_array)
+    x = np.arange(100000.0)
+    y, err, _ = run_function_in_container(fw, image=False, kwargs=dict(x=x), show_console=False)
+    assert err is None
+    assert isinstance(y, np.memmap)
+    z, err, _ = run_function_in_container(fw, image=False, kwargs=dict(x=y), show_console=False)
+    assert err is None
+    assert np.array_equal(z, x * 4)
+
+def test_safe_pickle_memmap(tmp_path):
+    x = np.arange(12.0).reshape(3, 4)
+    _serialize_to_file(str(tmp_path / 'x.npy'), x, safe=True)
+    y = _deserialize_from_file(str(tmp_path / 'x.npy'), safe=True)
+    assert isinstance(y, np.memmap)
+    f = io.BytesIO()
+    _SafePickler(f, protocol=4).dump({'y': y, 'z': y[:, ::2]})
+    a = _SafeUnpickler(io.BytesIO(f.getvalue())).load()
+    assert type(a['y']) is np.ndarray
+    assert np.array_equal(a['y'], x) and np.array_equal(a['z'], x[:, ::2])
+
+def test_npy_deserialize():
+    x = np.arange(10, dtype='int32')
+    assert np.array_equal(_deserialize(_serialize(x, serializer='npy')), x)
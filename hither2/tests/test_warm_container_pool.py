@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+import time
+from hither2._warm_container_pool import _worker_script
+
+_job_script = '''
+import os
+import subprocess
+import time
+p = subprocess.Popen(['sleep', '1000'])
+with open('pids.txt.tmp', 'w') as f:
+    f.write(f'{os.getpid()} {p.pid}')
+os.rename('pids.txt.tmp', 'pids.txt')
+time.sleep(1000)
+'''
+
+def _is_running(pid: int):
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            state = f.read().split(')')[-1].split()[0]
+    except FileNotFoundError:
+        return False
+    return state not in ['Z', 'X']
+
+def test_job_that_times_out_is_killed(tmp_path):
+    # The job handler terminates the host process of a job that times out, which then stops touching
+    # the job's running.txt: the worker kills the job (and the processes it started) and exits.
+    pool_dir = str(tmp_path)
+    os.mkdir(f'{pool_dir}/jobs')
+    with open(f'{pool_dir}/worker.py', 'w') as f:
+        f.write(_worker_script)
+    with open(f'{pool_dir}/running.txt', 'w') as f:
+        f.write('')
+    hither2_parent_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    env = {**os.environ, 'HITHER_POOL_DIR': pool_dir, 'PYTHONPATH': os.pathsep.join([hither2_parent_dir] + sys.path)}
+    worker = subprocess.Popen([sys.executable, f'{pool_dir}/worker.py', '60', '1'], env=env)
+    try:
+        job_dir = f'{pool_dir}/jobs/j-1'
+        os.mkdir(job_dir + '.tmp')
+        with open(job_dir + '.tmp/env', 'w') as f:
+            f.write('')
+        with open(job_dir + '.tmp/run', 'w') as f:
+            f.write(_job_script)
+        with open(job_dir + '.tmp/running.txt', 'w') as f:
+            f.write('')
+        os.rename(job_dir + '.tmp', job_dir)
+        # the host process waits for the job
+        timer = time.time()
+        while not os.path.exists(f'{job_dir}/pids.txt'):
+            assert time.time() - timer < 30
+            os.utime(f'{job_dir}/running.txt')
+            time.sleep(0.1)
+        with open(f'{job_dir}/pids.txt', 'r') as f:
+            pids = [int(a) for a in f.read().split()]
+        for i in range(10):
+            os.utime(f'{job_dir}/running.txt')
+            time.sleep(0.1)
+        assert all([_is_running(pid) for pid in pids])
+        # the host process is terminated
+        worker.wait(timeout=10)
+        assert not any([_is_running(pid) for pid in pids])
+    finally:
+        if worker.poll() is None:
+            worker.kill()
@@ -6,7 +6,8 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     include_package_data=True,
     scripts=[
-        "bin/hither-scriptdir-runner"
+        "bin/hither-scriptdir-runner",
+        "bin/hither-job-cache"
     ],
     install_requires=[
         "click",